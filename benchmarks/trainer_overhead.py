@@ -0,0 +1,383 @@
+"""
+Measures how much time the Trainer adds to each training step compared with a hand-written PyTorch loop.
+
+    # run and save the results
+    python -m benchmarks.trainer_overhead --out results.json
+
+    # run again later and compare against the saved results
+    python -m benchmarks.trainer_overhead --out new_results.json --baseline results.json
+
+Everything runs on the cpu on synthetic in-memory data, so nothing is downloaded.
+Each run happens in a forked process so peak RSS is measured per run.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from test_tube import Experiment
+from torch import optim
+from torch.utils.data import DataLoader, TensorDataset
+
+from pytorch_lightning import Trainer
+from pytorch_lightning.root_module.root_module import LightningModule
+
+MODEL_SIZES = OrderedDict([
+    ('small', dict(in_features=32, hidden_dim=32, nb_layers=1)),
+    ('medium', dict(in_features=256, hidden_dim=512, nb_layers=2)),
+    ('large', dict(in_features=784, hidden_dim=1024, nb_layers=3)),
+])
+
+SEED = 2334
+
+
+# ------------------------------------------------------------------------
+# MODELS
+# ------------------------------------------------------------------------
+def build_network(hparams):
+    """
+    Same MLP for both loops
+    :param hparams:
+    :return:
+    """
+    layers = []
+    in_features = hparams.in_features
+    for _ in range(hparams.nb_layers):
+        layers += [nn.Linear(in_features, hparams.hidden_dim), nn.ReLU()]
+        in_features = hparams.hidden_dim
+
+    layers += [nn.Linear(in_features, hparams.out_features), nn.LogSoftmax(dim=1)]
+    return nn.Sequential(*layers)
+
+
+def build_dataset(hparams):
+    generator = torch.Generator().manual_seed(SEED)
+    nb_samples = hparams.nb_steps * hparams.batch_size
+    x = torch.randn(nb_samples, hparams.in_features, generator=generator)
+    y = torch.randint(0, hparams.out_features, (nb_samples,), generator=generator)
+    return TensorDataset(x, y)
+
+
+class SyntheticModel(LightningModule):
+    """
+    Minimal LightningModule around build_network. Records when each training step ends
+    """
+
+    def __init__(self, hparams):
+        super(SyntheticModel, self).__init__(hparams)
+        self.network = build_network(hparams)
+        self.step_end_times = []
+
+    def forward(self, x):
+        return self.network(x)
+
+    def training_step(self, data_batch, batch_i):
+        x, y = data_batch
+        loss = F.nll_loss(self.forward(x), y)
+        return {'loss': loss}
+
+    def validation_step(self, data_batch, batch_i):
+        x, y = data_batch
+        return {'val_loss': F.nll_loss(self.forward(x), y)}
+
+    def validation_end(self, outputs):
+        # validation is turned off in the benchmark
+        return {}
+
+    def on_batch_end(self):
+        self.step_end_times.append(time.perf_counter())
+
+    def get_save_dict(self):
+        return {'state_dict': self.state_dict()}
+
+    def load_model_specific(self, checkpoint):
+        self.load_state_dict(checkpoint['state_dict'])
+
+    def configure_optimizers(self):
+        return [optim.SGD(self.parameters(), lr=self.hparams.learning_rate)]
+
+    def __dataloader(self):
+        return DataLoader(build_dataset(self.hparams), batch_size=self.hparams.batch_size, shuffle=True)
+
+    @property
+    def tng_dataloader(self):
+        if self._tng_dataloader is None:
+            self._tng_dataloader = self.__dataloader()
+        return self._tng_dataloader
+
+    @property
+    def val_dataloader(self):
+        if self._val_dataloader is None:
+            self._val_dataloader = self.__dataloader()
+        return self._val_dataloader
+
+    @property
+    def test_dataloader(self):
+        if self._test_dataloader is None:
+            self._test_dataloader = self.__dataloader()
+        return self._test_dataloader
+
+
+# ------------------------------------------------------------------------
+# LOOPS
+# ------------------------------------------------------------------------
+def run_raw_loop(hparams):
+    """
+    The loop a user would write without lightning
+    :param hparams:
+    :return: time at the end of each step
+    """
+    torch.manual_seed(SEED)
+    model = build_network(hparams)
+    optimizer = optim.SGD(model.parameters(), lr=hparams.learning_rate)
+    dataloader = DataLoader(build_dataset(hparams), batch_size=hparams.batch_size, shuffle=True)
+
+    step_end_times = []
+    model.train()
+    for x, y in dataloader:
+        loss = F.nll_loss(model(x), y)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        step_end_times.append(time.perf_counter())
+
+    return step_end_times
+
+
+def run_lightning(hparams):
+    """
+    Same work through Trainer.fit with validation, checkpointing and the progress bar turned off
+    :param hparams:
+    :return: time at the end of each step
+    """
+    torch.manual_seed(SEED)
+    model = SyntheticModel(hparams)
+
+    save_dir = tempfile.mkdtemp()
+    try:
+        trainer = Trainer(
+            experiment=Experiment(save_dir=save_dir, name='benchmark'),
+            progress_bar=False,
+            max_nb_epochs=1,
+            check_val_every_n_epoch=2,
+            nb_sanity_val_steps=0,
+            print_weights_summary=False
+        )
+        trainer.fit(model)
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    return model.step_end_times
+
+
+LOOPS = OrderedDict([
+    ('raw', run_raw_loop),
+    ('lightning', run_lightning),
+])
+
+
+# ------------------------------------------------------------------------
+# MEASURING
+# ------------------------------------------------------------------------
+def peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on linux, bytes on mac
+    if sys.platform == 'darwin':
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+
+def summarize_steps(step_end_times, warmup_steps):
+    """
+    Steady state step time, skipping the first warmup_steps
+    :param step_end_times:
+    :param warmup_steps:
+    :return:
+    """
+    if len(step_end_times) < warmup_steps + 2:
+        raise ValueError('need at least {} steps to skip {} warmup steps, got {}'.format(
+            warmup_steps + 2, warmup_steps, len(step_end_times)))
+
+    timed = step_end_times[warmup_steps:]
+    nb_steps = len(timed) - 1
+    step_time = (timed[-1] - timed[0]) / nb_steps
+    return {
+        'nb_steps': nb_steps,
+        'us_per_step': step_time * 1e6,
+        'steps_per_sec': 1. / step_time,
+    }
+
+
+def _run_in_child(loop_name, hparams, conn):
+    try:
+        torch.set_num_threads(hparams.nb_threads)
+        step_end_times = LOOPS[loop_name](hparams)
+        result = summarize_steps(step_end_times, hparams.warmup_steps)
+        result['peak_rss_mb'] = peak_rss_mb()
+        conn.send((result, None))
+    except Exception as e:
+        conn.send((None, repr(e)))
+    finally:
+        conn.close()
+
+
+def run_loop(loop_name, hparams):
+    """
+    Runs one loop in a fresh forked process
+    :param loop_name: key of LOOPS
+    :param hparams:
+    :return:
+    """
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_in_child, args=(loop_name, hparams, child_conn))
+    process.start()
+    child_conn.close()
+
+    result, error = parent_conn.recv()
+    process.join()
+
+    if error is not None:
+        raise RuntimeError('{} loop failed: {}'.format(loop_name, error))
+    return result
+
+
+def run_benchmark(model_sizes=None, nb_steps=200, warmup_steps=20, batch_size=32, repeats=3, nb_threads=1):
+    """
+    Times every loop on every model size. The fastest of `repeats` runs is kept
+    :return: dict that can be saved as json
+    """
+    model_sizes = MODEL_SIZES if model_sizes is None else model_sizes
+
+    cases = OrderedDict()
+    for size_name, size in model_sizes.items():
+        hparams = Namespace(out_features=10, learning_rate=0.01, batch_size=batch_size, nb_steps=nb_steps,
+                            warmup_steps=warmup_steps, nb_threads=nb_threads, **size)
+
+        case = OrderedDict()
+        for loop_name in LOOPS:
+            runs = [run_loop(loop_name, hparams) for _ in range(repeats)]
+            case[loop_name] = min(runs, key=lambda run: run['us_per_step'])
+
+        case['overhead_us_per_step'] = case['lightning']['us_per_step'] - case['raw']['us_per_step']
+        case['overhead_pct'] = 100. * case['overhead_us_per_step'] / case['raw']['us_per_step']
+        cases[size_name] = case
+
+    return {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'nb_steps': nb_steps,
+            'warmup_steps': warmup_steps,
+            'batch_size': batch_size,
+            'repeats': repeats,
+            'nb_threads': nb_threads,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'cases': cases,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """
+    A case regresses when its overhead grew by more than `tolerance` x the baseline lightning step time
+    :param results:
+    :param baseline:
+    :param tolerance:
+    :return: dict of case name -> comparison
+    """
+    comparison = OrderedDict()
+    for name, case in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+
+        base_case = baseline['cases'][name]
+        delta = case['overhead_us_per_step'] - base_case['overhead_us_per_step']
+        comparison[name] = {
+            'baseline_overhead_us_per_step': base_case['overhead_us_per_step'],
+            'overhead_us_per_step': case['overhead_us_per_step'],
+            'delta_us_per_step': delta,
+            'regressed': delta > tolerance * base_case['lightning']['us_per_step'],
+        }
+
+    return comparison
+
+
+def format_results(results, comparison=None):
+    header = '{:<10}{:>14}{:>14}{:>14}{:>10}{:>14}{:>12}'.format(
+        'model', 'raw us/step', 'pl us/step', 'overhead us', 'pl it/s', 'pl rss MB', 'vs base')
+    lines = [header, '-' * len(header)]
+
+    for name, case in results['cases'].items():
+        vs_base = ''
+        if comparison is not None and name in comparison:
+            vs_base = '{:+.1f}'.format(comparison[name]['delta_us_per_step'])
+            if comparison[name]['regressed']:
+                vs_base += ' !'
+
+        lines.append('{:<10}{:>14.1f}{:>14.1f}{:>14.1f}{:>10.1f}{:>14.1f}{:>12}'.format(
+            name,
+            case['raw']['us_per_step'],
+            case['lightning']['us_per_step'],
+            case['overhead_us_per_step'],
+            case['lightning']['steps_per_sec'],
+            case['lightning']['peak_rss_mb'],
+            vs_base))
+
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Trainer overhead vs a raw pytorch loop')
+    parser.add_argument('--out', default=None, type=str, help='save the results to this json file')
+    parser.add_argument('--baseline', default=None, type=str, help='compare against this json file')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='allowed overhead growth, as a fraction of the baseline step time')
+    parser.add_argument('--sizes', default=list(MODEL_SIZES.keys()), nargs='+', choices=list(MODEL_SIZES.keys()))
+    parser.add_argument('--nb_steps', default=200, type=int)
+    parser.add_argument('--warmup_steps', default=20, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--nb_threads', default=1, type=int)
+    args = parser.parse_args(args)
+
+    results = run_benchmark(
+        model_sizes=OrderedDict((name, MODEL_SIZES[name]) for name in args.sizes),
+        nb_steps=args.nb_steps,
+        warmup_steps=args.warmup_steps,
+        batch_size=args.batch_size,
+        repeats=args.repeats,
+        nb_threads=args.nb_threads
+    )
+
+    comparison = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            comparison = compare_to_baseline(results, json.load(f), tolerance=args.tolerance)
+        results['comparison'] = comparison
+
+    print(format_results(results, comparison))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    # non zero exit code so CI can catch regressions
+    regressed = comparison is not None and any(c['regressed'] for c in comparison.values())
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,10 @@
+import heapq
+import json
+import math
 import numpy as np
 import os, shutil
 from pytorch_lightning.pt_overrides.override_data_parallel import LightningDistributedDataParallel
+from pytorch_lightning.utils.checkpoint_io import remove_checkpoint
 
 
 class Callback(object):
@@ -168,11 +172,16 @@ class ModelCheckpoint(Callback):
             saved (`model.save_weights(filepath)`), else the full model
             is saved (`model.save(filepath)`).
         period: Interval (number of epochs) between checkpoints.
+        prefix: added to the start of the checkpoint file names.
+        save_top_k: keep only the k best checkpoints according to `monitor`.
+            The checkpoint that falls out of the top k is the only one deleted.
+            The kept checkpoints are listed in `{prefix}_top_k.json` in filepath so a resumed run picks them up.
+            `save_best_only=True` is the same as `save_top_k=1`.
     """
 
     def __init__(self, filepath, monitor='val_loss', verbose=0,
                  save_best_only=False, save_weights_only=False,
-                 mode='auto', period=1, prefix=''):
+                 mode='auto', period=1, prefix='', save_top_k=None):
         super(ModelCheckpoint, self).__init__()
         self.monitor = monitor
         self.verbose = verbose
@@ -183,6 +192,15 @@ class ModelCheckpoint(Callback):
         self.epochs_since_last_save = 0
         self.prefix = prefix
 
+        if save_top_k is None and save_best_only:
+            save_top_k = 1
+        if save_top_k is not None and save_top_k < 1:
+            raise ValueError('save_top_k must be >= 1, got {}'.format(save_top_k))
+        self.save_top_k = save_top_k
+
+        # set by the trainer. Deletes a checkpoint after the writes queued before it (ie: async checkpointing)
+        self.delete_function = None
+
         if mode not in ['auto', 'min', 'max']:
             print('ModelCheckpoint mode %s is unknown, '
                           'fallback to auto mode.' % (mode),
@@ -191,65 +209,139 @@ class ModelCheckpoint(Callback):
 
         if mode == 'min':
             self.monitor_op = np.less
-            self.best = np.Inf
+            self.best = np.inf
         elif mode == 'max':
             self.monitor_op = np.greater
-            self.best = -np.Inf
+            self.best = -np.inf
         else:
             if 'acc' in self.monitor or self.monitor.startswith('fmeasure'):
                 self.monitor_op = np.greater
-                self.best = -np.Inf
+                self.best = -np.inf
             else:
                 self.monitor_op = np.less
-                self.best = np.Inf
-
-    def save_model(self, filepath, overwrite):
-        dirpath = '/'.join(filepath.split('/')[:-1])
-
+                self.best = np.inf
+
+        # min-heap of (score, seq, metric, path) where a higher score is better, so heap[0] is the worst kept
+        self.top_k = []
+        self.seq = 0
+        if self.save_top_k is not None:
+            self.__load_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.filepath, '{}_top_k.json'.format(self.prefix))
+
+    def __score(self, metric):
+        # nan compares false both ways, so nan and inf rank below every real value
+        if not math.isfinite(metric):
+            return -np.inf
+        return metric if self.monitor_op is np.greater else -metric
+
+    def __push(self, metric, filepath):
+        heapq.heappush(self.top_k, (self.__score(metric), self.seq, metric, filepath))
+        self.seq += 1
+
+    def __load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        for entry in manifest['checkpoints']:
+            self.__push(entry['metric'], entry['path'])
+
+        if len(self.top_k) > 0 and math.isfinite(max(self.top_k)[2]):
+            self.best = max(self.top_k)[2]
+
+    def __save_manifest(self):
+        # best first. Written to a temp file and renamed, so it's never half written
+        entries = sorted(self.top_k, reverse=True)
+        manifest = {
+            'monitor': self.monitor,
+            'save_top_k': self.save_top_k,
+            'checkpoints': [{'metric': metric, 'path': path} for _, _, metric, path in entries],
+        }
+
+        tmp_path = '{}.tmp'.format(self.manifest_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def save_model(self, filepath):
         # make paths
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-        if overwrite:
-            for filename in os.listdir(dirpath):
-                if self.prefix in filename:
-                    path_to_delete = os.path.join(dirpath, filename)
-                    try:
-                        shutil.rmtree(path_to_delete)
-                    except OSError:
-                        os.remove(path_to_delete)
-
         # delegate the saving to the model
         self.save_function(filepath)
 
+    def delete_model(self, filepath):
+        if self.delete_function is not None:
+            self.delete_function(filepath)
+        else:
+            remove_checkpoint(filepath)
+
     def on_epoch_end(self, epoch, logs=None):
+        filepath = '{}/{}_ckpt_epoch_{}.ckpt'.format(self.filepath, self.prefix, epoch + 1)
+        self.__check_and_save(filepath, 'Epoch %05d' % (epoch + 1), logs)
+
+    def on_step_end(self, step, logs=None):
+        """
+        Used by step based training (ie: streaming datasets without epochs).
+        `period` then counts validation checks instead of epochs
+        """
+        filepath = '{}/{}_ckpt_step_{}.ckpt'.format(self.filepath, self.prefix, step)
+        self.__check_and_save(filepath, 'Step %07d' % step, logs)
+
+    def __check_and_save(self, filepath, label, logs):
         logs = logs or {}
         self.epochs_since_last_save += 1
         if self.epochs_since_last_save >= self.period:
             self.epochs_since_last_save = 0
-            filepath = '{}/{}_ckpt_epoch_{}.ckpt'.format(self.filepath, self.prefix, epoch + 1)
-            if self.save_best_only:
+            if self.save_top_k is not None:
                 current = logs.get(self.monitor)
                 if current is None:
                     print('Can save best model only with %s available, '
                                   'skipping.' % (self.monitor), RuntimeWarning)
                 else:
-                    if self.monitor_op(current, self.best):
-                        if self.verbose > 0:
-                            print('\nEpoch %05d: %s improved from %0.5f to %0.5f,'
-                                  ' saving model to %s'
-                                  % (epoch + 1, self.monitor, self.best,
-                                     current, filepath))
-                        self.best = current
-                        self.save_model(filepath, overwrite=True)
-
-                    else:
-                        if self.verbose > 0:
-                            print('\nEpoch %05d: %s did not improve' %
-                                  (epoch + 1, self.monitor))
+                    self.__save_top_k(filepath, label, float(current))
             else:
                 if self.verbose > 0:
-                    print('\nEpoch %05d: saving model to %s' % (epoch + 1, filepath))
-                self.save_model(filepath, overwrite=False)
+                    print('\n%s: saving model to %s' % (label, filepath))
+                self.save_model(filepath)
+
+    def __save_top_k(self, filepath, label, current):
+        is_full = len(self.top_k) >= self.save_top_k
+        if is_full and self.__score(current) <= self.top_k[0][0]:
+            if self.verbose > 0:
+                print('\n%s: %s was not in the top %d' % (label, self.monitor, self.save_top_k))
+            return
+
+        if self.monitor_op(current, self.best):
+            if self.verbose > 0:
+                print('\n%s: %s improved from %0.5f to %0.5f,'
+                      ' saving model to %s'
+                      % (label, self.monitor, self.best,
+                         current, filepath))
+            self.best = current
+        elif self.verbose > 0:
+            print('\n%s: %s is in the top %d, saving model to %s' % (label, self.monitor, self.save_top_k, filepath))
+
+        self.save_model(filepath)
+
+        # saving to a path that's already kept (ie: after resuming) replaces that entry
+        if any(path == filepath for _, _, _, path in self.top_k):
+            self.top_k = [entry for entry in self.top_k if entry[3] != filepath]
+            heapq.heapify(self.top_k)
+        self.__push(current, filepath)
+
+        # only the checkpoint that just fell out of the top k gets deleted
+        if len(self.top_k) > self.save_top_k:
+            _, _, _, worst_path = heapq.heappop(self.top_k)
+            if worst_path != filepath:
+                self.delete_model(worst_path)
+
+        self.__save_manifest()
 
 
 if __name__ == '__main__':
@@ -0,0 +1 @@
+from .accumulators import Accumulator, Sum, Mean, Accuracy, ConfusionMatrix, AUC
@@ -0,0 +1,203 @@
+import torch
+
+"""
+Accumulators fold validation outputs in batch by batch, so memory doesn't grow with the validation set.
+
+Return them from LightningModule.validation_accumulators():
+
+    def validation_accumulators(self):
+        return {
+            'val_loss': Mean('val_loss'),
+            'val_acc': Accuracy(preds_key='y_hat', target_key='y'),
+        }
+
+All state stays on the device of the outputs. Nothing is synced with the host until compute().
+"""
+
+
+def _get_value(output, key):
+    # validation_step may return a dict or a single tensor
+    if key is None:
+        return output
+    return output[key]
+
+
+class Accumulator(object):
+    """
+    Base class. Subclasses implement update() and compute()
+    """
+
+    def reset(self):
+        raise NotImplementedError
+
+    def update(self, output):
+        """
+        Fold one validation_step output into the running state
+        :param output: whatever validation_step returned
+        :return:
+        """
+        raise NotImplementedError
+
+    def compute(self):
+        """
+        Final reduced value
+        :return:
+        """
+        raise NotImplementedError
+
+
+class Sum(Accumulator):
+
+    def __init__(self, key=None):
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        self.total = None
+
+    def update(self, output):
+        value = _get_value(output, self.key).detach()
+        batch_sum = value.sum()
+        self.total = batch_sum if self.total is None else self.total + batch_sum
+
+    def compute(self):
+        if self.total is None:
+            return 0.0
+        return self.total.item()
+
+
+class Mean(Accumulator):
+    """
+    Mean over every element seen, so batches of different sizes are weighted correctly
+    when validation_step returns per-sample values
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        self.total = None
+        self.count = 0
+
+    def update(self, output):
+        value = _get_value(output, self.key).detach()
+        batch_sum = value.sum()
+        self.total = batch_sum if self.total is None else self.total + batch_sum
+        self.count += value.numel()
+
+    def compute(self):
+        if self.count == 0:
+            return 0.0
+        return (self.total / self.count).item()
+
+
+def _to_labels(preds):
+    # (N, C) scores become predicted class ids
+    if preds.dim() > 1:
+        return preds.argmax(dim=1)
+    return preds
+
+
+class Accuracy(Accumulator):
+    """
+    Fraction of correct predictions. preds can be (N, C) scores or (N,) class ids
+    """
+
+    def __init__(self, preds_key='y_hat', target_key='y'):
+        self.preds_key = preds_key
+        self.target_key = target_key
+        self.reset()
+
+    def reset(self):
+        self.correct = None
+        self.total = 0
+
+    def update(self, output):
+        preds = _to_labels(_get_value(output, self.preds_key).detach())
+        target = _get_value(output, self.target_key).detach()
+
+        correct = (preds == target).sum()
+        self.correct = correct if self.correct is None else self.correct + correct
+        self.total += target.numel()
+
+    def compute(self):
+        if self.total == 0:
+            return 0.0
+        return self.correct.item() / self.total
+
+
+class ConfusionMatrix(Accumulator):
+    """
+    (nb_classes, nb_classes) counts. Rows are targets, columns are predictions
+    """
+
+    def __init__(self, nb_classes, preds_key='y_hat', target_key='y'):
+        self.nb_classes = nb_classes
+        self.preds_key = preds_key
+        self.target_key = target_key
+        self.reset()
+
+    def reset(self):
+        self.matrix = None
+
+    def update(self, output):
+        preds = _to_labels(_get_value(output, self.preds_key).detach()).long().view(-1)
+        target = _get_value(output, self.target_key).detach().long().view(-1)
+
+        # one bincount over the flattened (target, pred) pairs
+        idx = target * self.nb_classes + preds
+        counts = torch.bincount(idx, minlength=self.nb_classes ** 2)
+        counts = counts.view(self.nb_classes, self.nb_classes)
+        self.matrix = counts if self.matrix is None else self.matrix + counts
+
+    def compute(self):
+        if self.matrix is None:
+            return torch.zeros(self.nb_classes, self.nb_classes, dtype=torch.long)
+        return self.matrix.cpu()
+
+
+class AUC(Accumulator):
+    """
+    Approximate ROC AUC for binary targets.
+    Scores (probabilities in [0, 1]) are bucketed into nb_bins histograms for the positive and negative class,
+    so memory is O(nb_bins) no matter how many samples are seen
+    """
+
+    def __init__(self, scores_key='y_hat', target_key='y', nb_bins=1000):
+        self.scores_key = scores_key
+        self.target_key = target_key
+        self.nb_bins = nb_bins
+        self.reset()
+
+    def reset(self):
+        self.pos_hist = None
+        self.neg_hist = None
+
+    def update(self, output):
+        scores = _get_value(output, self.scores_key).detach().float().view(-1)
+        target = _get_value(output, self.target_key).detach().view(-1)
+
+        bins = (scores.clamp(0, 1) * (self.nb_bins - 1)).round().long()
+        is_pos = target > 0
+        pos = torch.bincount(bins[is_pos], minlength=self.nb_bins)
+        neg = torch.bincount(bins[~is_pos], minlength=self.nb_bins)
+
+        self.pos_hist = pos if self.pos_hist is None else self.pos_hist + pos
+        self.neg_hist = neg if self.neg_hist is None else self.neg_hist + neg
+
+    def compute(self):
+        if self.pos_hist is None:
+            return 0.0
+
+        pos = self.pos_hist.double()
+        neg = self.neg_hist.double()
+        nb_pos = pos.sum()
+        nb_neg = neg.sum()
+        if nb_pos == 0 or nb_neg == 0:
+            return 0.0
+
+        # P(score_pos > score_neg) + 0.5 * P(tie), computed per bin
+        neg_below = torch.cumsum(neg, dim=0) - neg
+        auc = (pos * (neg_below + 0.5 * neg)).sum() / (nb_pos * nb_neg)
+        return auc.item()
@@ -7,19 +7,33 @@ import warnings
 import os
 import pdb
 import re
+import math
+import copy
+import queue
+import time
 
 import torch
 from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import IterableDataset
 from torch.optim.lr_scheduler import MultiStepLR
 import torch.multiprocessing as mp
 import torch.distributed as dist
 import numpy as np
 import tqdm
 
-from pytorch_lightning.root_module.memory import get_gpu_memory_map
 from pytorch_lightning.root_module.model_saving import TrainerIO
+from pytorch_lightning.root_module.hooks import ModelHooks
+from pytorch_lightning.root_module.grads import grad_norms, clip_grad_norms
 from pytorch_lightning.pt_overrides.override_data_parallel import LightningDistributedDataParallel, LightningDataParallel
 from pytorch_lightning.utils.debugging import MisconfigurationException
+from pytorch_lightning.utils.running_stats import TensorRunningMean, RunningMean
+from pytorch_lightning.utils.prefetch import BatchPrefetcher
+from pytorch_lightning.utils.metrics_writer import MetricsWriter
+from pytorch_lightning.utils.system_metrics import SystemMetricsSampler
+from pytorch_lightning.utils.checkpoint_io import AsyncCheckpointWriter, snapshot_to_host
+from pytorch_lightning.utils.frozen_weights import FrozenWeightsBase
+from pytorch_lightning.utils.compressed_checkpoint import CODECS
+from pytorch_lightning.profiler import Profiler, PassThroughProfiler
 
 try:
     from apex import amp
@@ -49,6 +63,44 @@ def reduce_distributed_output(output, nb_gpus):
     return output
 
 
+def metrics_to_scalars(metrics, blacklist=()):
+    """
+    Flattens nested dicts ({'a': {'b': x}} becomes {'a/b': x}) and turns every tensor into a python number.
+    All tensors on the same device go to the host in a single transfer instead of one .item() each
+    :param metrics: dict
+    :param blacklist: top level keys to drop
+    :return: flat dict
+    """
+    flat = {}
+
+    def flatten(d, prefix):
+        for k, v in d.items():
+            if isinstance(v, dict):
+                flatten(v, '{}{}/'.format(prefix, k))
+            else:
+                flat['{}{}'.format(prefix, k)] = v
+
+    flatten({k: v for k, v in metrics.items() if k not in blacklist}, '')
+
+    keys_by_device = {}
+    for k, v in flat.items():
+        if isinstance(v, torch.Tensor):
+            keys_by_device.setdefault(v.device, []).append(k)
+
+    for keys in keys_by_device.values():
+        # float64 holds every float32/16 value (and any int below 2**53) exactly
+        stacked = torch.stack([flat[k].detach().reshape(()).to(torch.float64) for k in keys])
+        for k, v in zip(keys, stacked.tolist()):
+            dtype = flat[k].dtype
+            if dtype == torch.bool:
+                v = bool(v)
+            elif not dtype.is_floating_point:
+                v = int(v)
+            flat[k] = v
+
+    return flat
+
+
 class Trainer(TrainerIO):
 
     def __init__(self,
@@ -77,7 +129,23 @@ class Trainer(TrainerIO):
                  print_nan_grads=False,
                  print_weights_summary=True,
                  amp_level='O2',
-                 nb_sanity_val_steps=5):
+                 nb_sanity_val_steps=5,
+                 running_loss_window=100,
+                 prefetch_batches=0,
+                 max_steps=None,
+                 val_check_every_n_steps=None,
+                 async_validation=False,
+                 profiler=None,
+                 throughput_window=20,
+                 system_metrics=False,
+                 grad_norm_group_depth=None,
+                 skip_nonfinite_grads=False,
+                 async_checkpoint=False,
+                 max_checkpoints_in_flight=2,
+                 checkpoint_format='torch',
+                 dedup_frozen_weights=False,
+                 checkpoint_compression=None,
+                 max_val_batches=None):
 
         """
 
@@ -107,10 +175,38 @@ class Trainer(TrainerIO):
         :param lr_scheduler_milestones:
         :param distributed_backend: 'np' to use DistributedParallel, 'ddp' to use DistributedDataParallel
         :param use_amp:
-        :param print_nan_grads:
+        :param print_nan_grads: print the parameters whose gradients are nan or inf (only when there are some)
         :param print_weights_summary:
         :param amp_level:
         :param nb_sanity_val_steps:
+        :param running_loss_window: number of optimizer steps averaged into the tng_loss shown in the progress bar
+        :param prefetch_batches: when > 0, load this many batches ahead in a background thread
+            (and copy them to the gpu)
+        :param max_steps: stop training after this many batches (global steps), regardless of epochs
+        :param val_check_every_n_steps: run validation (and checkpointing, early stopping) every n global steps.
+            Required when the training dataloader has no length (ie: streaming IterableDataset)
+        :param async_validation: validate a snapshot of the weights in a background cpu process while training continues
+        :param profiler: True (or a Profiler) to time each stage of the training loop and print a report after fit
+        :param throughput_window: number of batches averaged into the samples/sec, batches/sec, step time
+            and ETA metrics
+        :param system_metrics: log memory, cpu, open files and gpu memory sampled in a background thread
+            (on proc 0 only). True for the defaults, a SystemMetricsSampler to pick what gets sampled, False (default)
+            to turn off
+        :param grad_norm_group_depth: with track_grad_norm, log one norm per module prefix of this many name parts
+            (ie: 1 for one norm per top level module) instead of one per parameter
+        :param skip_nonfinite_grads: skip the optimizer step when any gradient is nan or inf
+            (counted in nb_skipped_steps)
+        :param async_checkpoint: copy checkpoints to host memory and write them from a background thread
+        :param max_checkpoints_in_flight: with async_checkpoint, max checkpoints held in memory waiting to be written.
+            Saving another one waits for the oldest to finish
+        :param checkpoint_format: 'torch' for a single torch.save file, 'sharded' for a folder of memory-mappable
+            tensor shards that can be partially loaded (see pytorch_lightning.utils.sharded_checkpoint)
+        :param dedup_frozen_weights: write the frozen weights (requires_grad=False) once to a frozen_<hash>.pt file
+            next to the checkpoints. Checkpoints then only hold the trained weights, optimizer and trainer state
+        :param checkpoint_compression: 'zlib', 'bz2' or 'lzma' to compress the checkpoint tensors in parallel threads.
+            The compression ratio and write speed are logged as ckpt_compression_ratio and ckpt_write_mb_per_s
+        :param max_val_batches: validate on at most this many batches. Required when the validation dataloader
+            has no length (ie: streaming IterableDataset), since val_percent_check can't be applied to it
         """
 
         # Transfer params
@@ -120,6 +216,8 @@ class Trainer(TrainerIO):
         self.check_val_every_n_epoch = check_val_every_n_epoch
         self.enable_early_stop = early_stop_callback is not None
         self.track_grad_norm = track_grad_norm
+        self.grad_norm_group_depth = grad_norm_group_depth
+        self.last_grad_norms = None
         self.fast_dev_run = fast_dev_run
         self.on_gpu = gpus is not None and torch.cuda.is_available()
         self.progress_bar = progress_bar
@@ -133,11 +231,51 @@ class Trainer(TrainerIO):
 
         if self.checkpoint_callback is not None:
             self.checkpoint_callback.save_function = self.save_checkpoint
+            self.checkpoint_callback.delete_function = self.delete_checkpoint
+
+        if checkpoint_format not in ('torch', 'sharded'):
+            m = "checkpoint_format has to be 'torch' or 'sharded', got {}".format(checkpoint_format)
+            raise MisconfigurationException(m)
+        self.checkpoint_format = checkpoint_format
+
+        if checkpoint_compression is not None and checkpoint_compression not in CODECS:
+            m = 'checkpoint_compression has to be one of {}, got {}'.format(CODECS, checkpoint_compression)
+            raise MisconfigurationException(m)
+        if checkpoint_compression is not None and checkpoint_format == 'sharded':
+            m = "checkpoint_compression isn't supported with checkpoint_format='sharded' (shards are memory-mapped)"
+            raise MisconfigurationException(m)
+        self.checkpoint_compression = checkpoint_compression
+        self.last_checkpoint_stats = None
+        self.frozen_weights = FrozenWeightsBase() if dedup_frozen_weights else None
+
+        self.checkpoint_writer = None
+        if async_checkpoint:
+            self.checkpoint_writer = AsyncCheckpointWriter(max_in_flight=max_checkpoints_in_flight)
 
         self.early_stop = early_stop_callback
         self.model = None
         self.max_nb_epochs = max_nb_epochs
+        self.max_steps = max_steps
+        self.val_check_every_n_steps = val_check_every_n_steps
+        self.max_val_batches = max_val_batches
+        self.async_validation = async_validation
+
+        # (epoch, global_step, state_dict, optimizer_states) a checkpoint should hold instead of the live ones
+        self.validated_snapshot = None
+        self.async_val_worker = None
+        self.async_val_pending = 0
+        self.async_val_snapshot = None
+        self.metrics_writer = None
         self.accumulate_grad_batches = accumulate_grad_batches
+
+        # when off, the profiler calls are no-ops
+        if profiler is True:
+            profiler = Profiler()
+        self.profiler = profiler or PassThroughProfiler()
+
+        if system_metrics is True:
+            system_metrics = SystemMetricsSampler()
+        self.system_metrics = system_metrics or None
         self.early_stop_callback = early_stop_callback
         self.min_nb_epochs = min_nb_epochs
         self.nb_sanity_val_steps = nb_sanity_val_steps
@@ -145,15 +283,22 @@ class Trainer(TrainerIO):
         self.lr_schedulers = []
         self.amp_level = amp_level
         self.print_nan_grads = print_nan_grads
+        self.skip_nonfinite_grads = skip_nonfinite_grads
+        self.nb_skipped_steps = 0
+        self.prefetch_batches = prefetch_batches
         self.data_parallel_device_ids = None
         self.world_size = 1
         self.node_rank = 0
         self.use_ddp = False
         self.use_dp = False
+        self.model_hooks = {}
 
         # training bookeeping
         self.total_batch_nb = 0
-        self.running_loss = []
+        self.running_loss = TensorRunningMean(window_length=running_loss_window)
+        self.step_times = RunningMean(window_length=throughput_window)
+        self.step_samples = RunningMean(window_length=throughput_window)
+        self.last_batch_time = None
         self.avg_loss = 0
         self.batch_nb = 0
         self.tqdm_metrics = {}
@@ -268,27 +413,87 @@ class Trainer(TrainerIO):
     def __get_model(self):
         return self.model.module if self.data_parallel else self.model
 
-    def __is_function_implemented(self, f_name):
-        model = self.__get_model()
-        f_op = getattr(model, f_name, None)
-        return callable(f_op)
+    def __resolve_model_hooks(self, model):
+        """
+        Build a table with only the hooks the model overrides.
+        Hooks left at the ModelHooks default are no-ops, so the training loop skips them entirely
+        :param model: the LightningModule (not the DP/DDP wrapper)
+        :return:
+        """
+        self.model_hooks = {}
+        for hook_name, default_hook in vars(ModelHooks).items():
+            if not hook_name.startswith('on_') or not callable(default_hook):
+                continue
+
+            hook = getattr(model, hook_name, None)
+            if callable(hook) and getattr(hook, '__func__', None) is not default_hook:
+                self.model_hooks[hook_name] = hook
+
+    def __sync_avg_loss(self):
+        """
+        Pull the running loss off the device.
+        Only called at logging / progress bar boundaries so the training step never waits on the device
+        :return:
+        """
+        if len(self.running_loss) > 0:
+            self.avg_loss = self.running_loss.mean().item()
 
     @property
     def __tng_tqdm_dic(self):
         # ForkedPdb().set_trace()
+        self.__sync_avg_loss()
         tqdm_dic = {
             'tng_loss': '{0:.3f}'.format(self.avg_loss),
             'v_nb': '{}'.format(self.experiment.version),
             'epoch': '{}'.format(self.current_epoch),
             'batch_nb':'{}'.format(self.batch_nb),
         }
+        tqdm_dic.update(self.__throughput_metrics())
         tqdm_dic.update(self.tqdm_metrics)
 
+        if self.skip_nonfinite_grads:
+            tqdm_dic['skipped_steps'] = '{}'.format(self.nb_skipped_steps)
+
         if self.on_gpu:
             tqdm_dic['gpu'] = '{}'.format(self.current_gpu_name)
 
         return tqdm_dic
 
+    def __track_throughput(self, data_batch):
+        """
+        Time between consecutive training batches (which includes fetching, logging and validation)
+        :param data_batch:
+        :return:
+        """
+        now = time.perf_counter()
+        if self.last_batch_time is not None:
+            self.step_times.append(now - self.last_batch_time)
+
+            batch_size = self.__get_model().get_batch_size(data_batch)
+            self.step_samples.append(batch_size or 0)
+
+        self.last_batch_time = now
+
+    def __throughput_metrics(self):
+        if len(self.step_times) == 0 or self.step_times.total <= 0:
+            return {}
+
+        step_time = self.step_times.mean()
+        metrics = {
+            'step_time_ms': '{0:.1f}'.format(step_time * 1000),
+            'batches_per_sec': '{0:.2f}'.format(1. / step_time),
+        }
+
+        if self.step_samples.total > 0:
+            metrics['samples_per_sec'] = '{0:.1f}'.format(self.step_samples.total / self.step_times.total)
+
+        # batches left this epoch (the loop runs batches 0..nb_tng_batches)
+        if not math.isinf(self.nb_tng_batches):
+            batches_left = max(0, self.nb_tng_batches - self.batch_nb)
+            metrics['epoch_eta_s'] = '{0:.0f}'.format(batches_left * step_time)
+
+        return metrics
+
     @property
     def tng_tqdm_dic(self):
         """
@@ -297,31 +502,49 @@ class Trainer(TrainerIO):
         """
         return self.__tng_tqdm_dic
 
+    @property
+    def step_based_validation(self):
+        return self.val_check_every_n_steps is not None
+
+    def __nb_batches(self, dataloader, percent_check):
+        try:
+            nb_batches = len(dataloader)
+        except TypeError:
+            # streaming datasets (ie: IterableDataset) have no length
+            return float('inf')
+
+        return int(nb_batches * percent_check)
+
     def __layout_bookeeping(self):
 
         # determine number of training batches
-        self.nb_tng_batches = len(self.tng_dataloader)
-        self.nb_tng_batches = int(self.nb_tng_batches * self.train_percent_check)
+        self.nb_tng_batches = self.__nb_batches(self.tng_dataloader, self.train_percent_check)
 
         # determine number of validation batches
-        self.nb_val_batches = len(self.val_dataloader)
-        self.nb_val_batches = int(self.nb_val_batches * self.val_percent_check)
+        self.nb_val_batches = self.__nb_batches(self.val_dataloader, self.val_percent_check)
+        if math.isinf(self.nb_val_batches) and self.max_val_batches is None:
+            m = 'The validation dataloader has no length so val_percent_check can\'t be used. ' \
+                'Set max_val_batches to choose how many batches to validate on.'
+            raise MisconfigurationException(m)
+        if self.max_val_batches is not None:
+            self.nb_val_batches = min(self.nb_val_batches, self.max_val_batches)
         self.nb_val_batches = max(1, self.nb_val_batches)
-        self.nb_val_batches = self.nb_val_batches
 
         # determine number of test batches
-        self.nb_test_batches = len(self.test_dataloader)
-        self.nb_test_batches = int(self.nb_test_batches * self.test_percent_check)
+        self.nb_test_batches = self.__nb_batches(self.test_dataloader, self.test_percent_check)
 
         # determine when to check validation
-        self.val_check_batch = int(self.nb_tng_batches * self.val_check_interval)
+        if self.step_based_validation:
+            self.val_check_batch = None
+        elif math.isinf(self.nb_tng_batches):
+            m = 'The training dataloader has no length so val_check_interval can\'t be used. ' \
+                'Set val_check_every_n_steps to choose when to run validation.'
+            raise MisconfigurationException(m)
+        else:
+            self.val_check_batch = int(self.nb_tng_batches * self.val_check_interval)
 
     def __add_tqdm_metrics(self, metrics):
-        for k, v in metrics.items():
-            if type(v) is torch.Tensor:
-                v = v.item()
-
-            self.tqdm_metrics[k] = v
+        self.tqdm_metrics.update(metrics_to_scalars(metrics))
 
     def validate(self, model, dataloader, max_batches):
         """
@@ -339,10 +562,18 @@ class Trainer(TrainerIO):
         torch.set_grad_enabled(False)
 
         # bookkeeping
+        # with accumulators, each output is reduced right away and nothing is kept around
+        ref_model = model.module if self.data_parallel else model
+        accumulators = ref_model.validation_accumulators()
         outputs = []
 
+        # a model may hand back the same accumulators every time, start each run from scratch
+        if accumulators is not None:
+            for accumulator in accumulators.values():
+                accumulator.reset()
+
         # run training
-        for batch_i, data_batch in enumerate(dataloader):
+        for batch_i, data_batch in enumerate(self.profiler.profile_iterable(dataloader, 'get_val_batch')):
 
             if data_batch is None:  # pragma: no cover
                 continue
@@ -354,26 +585,32 @@ class Trainer(TrainerIO):
             # -----------------
             # RUN VALIDATION STEP
             # -----------------
-            if self.use_ddp:
-                output = model(data_batch, batch_i)
-            elif self.use_dp:
-                output = model(data_batch, batch_i)
-                output = reduce_distributed_output(output, len(self.data_parallel_device_ids))
+            with self.profiler.profile('validation_step'):
+                if self.use_ddp:
+                    output = model(data_batch, batch_i)
+                elif self.use_dp:
+                    output = model(data_batch, batch_i)
+                    output = reduce_distributed_output(output, len(self.data_parallel_device_ids))
 
-            else:
-                output = model.validation_step(data_batch, batch_i)
+                else:
+                    output = model.validation_step(data_batch, batch_i)
 
-            outputs.append(output)
+            if accumulators is not None:
+                for accumulator in accumulators.values():
+                    accumulator.update(output)
+            else:
+                outputs.append(output)
 
-            # batch done
-            if self.progress_bar and self.prog_bar is not None:
+            # batch done (a step based progress bar only counts training steps)
+            if self.progress_bar and self.prog_bar is not None and self.max_steps is None:
                 self.prog_bar.update(1)
 
+        if accumulators is not None:
+            outputs = {name: accumulator.compute() for name, accumulator in accumulators.items()}
+
         # give model a chance to do something with the outputs
-        if self.data_parallel:
-            val_results = model.module.validation_end(outputs)
-        else:
-            val_results = model.validation_end(outputs)
+        with self.profiler.profile('validation_end'):
+            val_results = ref_model.validation_end(outputs)
 
         # enable train mode again
         model.train()
@@ -393,7 +630,9 @@ class Trainer(TrainerIO):
         self.test_dataloader = model.test_dataloader
         self.val_dataloader = model.val_dataloader
 
-        if self.use_ddp and not isinstance(self.tng_dataloader.sampler, DistributedSampler):
+        # streaming datasets shard themselves across processes
+        is_iterable_ds = isinstance(self.tng_dataloader.dataset, IterableDataset)
+        if self.use_ddp and not is_iterable_ds and not isinstance(self.tng_dataloader.sampler, DistributedSampler):
             msg = '''
             when using multiple gpus and multiple nodes you must pass a DistributedSampler to DataLoader(sampler).
             
@@ -408,6 +647,20 @@ class Trainer(TrainerIO):
             '''
             raise MisconfigurationException(msg)
 
+    def __prefetch_dataloaders(self, model):
+        """
+        Wrap the dataloaders so the next batches load in the background while the model computes
+        :param model: the LightningModule (not the DP/DDP wrapper)
+        :return:
+        """
+        device = None
+        if self.on_gpu:
+            device = next(model.parameters()).device
+
+        self.tng_dataloader = BatchPrefetcher(self.tng_dataloader, self.prefetch_batches, device)
+        self.val_dataloader = BatchPrefetcher(self.val_dataloader, self.prefetch_batches, device)
+        self.test_dataloader = BatchPrefetcher(self.test_dataloader, self.prefetch_batches, device)
+
     # -----------------------------
     # MODEL TRAINING
     # -----------------------------
@@ -581,8 +834,13 @@ class Trainer(TrainerIO):
         # set local properties on the model
         ref_model.on_gpu = self.on_gpu
 
+        # only dispatch to the hooks the model actually overrides
+        self.__resolve_model_hooks(ref_model)
+
         # transfer data loaders from model
         self.get_dataloaders(ref_model)
+        if self.prefetch_batches > 0:
+            self.__prefetch_dataloaders(ref_model)
 
         # init training constants
         self.__layout_bookeeping()
@@ -601,24 +859,69 @@ class Trainer(TrainerIO):
         ref_model.trainer = self
         ref_model.experiment = self.experiment
 
-        # run tiny validation to make sure program won't crash during val
-        _ = self.validate(model, self.val_dataloader, max_batches=self.nb_sanity_val_steps)
+        # fork the validation worker before any background thread starts (system metrics, metrics writer).
+        # A forked child only gets the calling thread, and could deadlock on a lock another thread held
+        self.model = model
+        if self.async_validation:
+            self.__start_async_validation(ref_model)
 
-        # save exp to get started
-        if self.proc_rank == 0:
-            self.experiment.save()
+        try:
+            # only the process that logs needs to sample
+            if self.proc_rank == 0 and self.system_metrics is not None:
+                self.system_metrics.start()
+
+            # run tiny validation to make sure program won't crash during val
+            _ = self.validate(model, self.val_dataloader, max_batches=self.nb_sanity_val_steps)
+
+            # save exp to get started
+            if self.proc_rank == 0:
+                self.experiment.save()
+
+            # rows logged during training get appended in the background instead of re-saving the experiment.
+            # metrics.csv is kept up to date from the same thread, so a killed run still has it
+            if self.proc_rank == 0 and not self.experiment.debug:
+                exp_path = self.experiment.get_data_path(self.experiment.name, self.experiment.version)
+                self.metrics_writer = MetricsWriter(os.path.join(exp_path, 'metrics.jsonl'),
+                                                    csv_path=os.path.join(exp_path, 'metrics.csv'))
+
+            # enable cluster checkpointing
+            if self.cluster is not None:  # pragma: no cover
+                self.enable_auto_hpc_walltime_manager()
+
+            # ---------------------------
+            # CORE TRAINING LOOP
+            # ---------------------------
+            self.__train()
+        finally:
+            if self.async_val_worker is not None:
+                self.__stop_async_validation()
+
+            if self.system_metrics is not None:
+                self.system_metrics.stop()
+
+            # every checkpoint is on disk when fit returns
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.close()
+
+            # write out the last rows and save the full experiment once
+            if self.metrics_writer is not None:
+                self.metrics_writer.close()
+                self.metrics_writer = None
+                with self.profiler.profile('experiment_save'):
+                    self.experiment.save()
+
+        # report where the time went
+        if self.profiler.enabled and self.proc_rank == 0:
+            print(self.profiler.summary())
 
-        # enable cluster checkpointing
-        if self.cluster is not None:  # pragma: no cover
-            self.enable_auto_hpc_walltime_manager()
+    def __train(self):
+        # when training for a number of steps, a single progress bar tracks steps across epochs
+        if self.progress_bar and self.max_steps is not None:
+            self.prog_bar = tqdm.tqdm(total=self.max_steps, initial=self.global_step, position=self.process_position)
 
-        # ---------------------------
-        # CORE TRAINING LOOP
-        # ---------------------------
-        self.model = model
-        self.__train()
+        # set when step based training should end
+        stop_training = False
 
-    def __train(self):
         # run all epochs
         for epoch_nb in range(self.current_epoch, self.max_nb_epochs):
             # update the lr scheduler
@@ -629,19 +932,27 @@ class Trainer(TrainerIO):
             model.current_epoch = epoch_nb
 
             # hook
-            if self.__is_function_implemented('on_epoch_start'):
-                model = self.__get_model()
-                model.on_epoch_start()
+            if 'on_epoch_start' in self.model_hooks:
+                with self.profiler.profile('on_epoch_start'):
+                    self.model_hooks['on_epoch_start']()
 
             self.current_epoch = epoch_nb
             self.total_batches = self.nb_tng_batches + self.nb_val_batches
             self.batch_loss_value = 0  # accumulated grads
 
+            if self.prefetch_batches > 0:
+                self.tng_dataloader.reset_stats()
+
+            # the first interval of an epoch would include starting up the dataloader
+            self.last_batch_time = None
+
             # init progbar when requested
-            if self.progress_bar:
-                self.prog_bar = tqdm.tqdm(range(self.total_batches), position=self.process_position)
+            if self.progress_bar and self.max_steps is None:
+                total = None if math.isinf(self.total_batches) else self.total_batches
+                self.prog_bar = tqdm.tqdm(total=total, position=self.process_position)
 
-            for batch_nb, data_batch in enumerate(self.tng_dataloader):
+            tng_batches = self.profiler.profile_iterable(self.tng_dataloader, 'get_tng_batch')
+            for batch_nb, data_batch in enumerate(tng_batches):
                 self.batch_nb = batch_nb
                 self.global_step += 1
 
@@ -654,23 +965,39 @@ class Trainer(TrainerIO):
                 if met_batch_limit:
                     break
 
+                self.__track_throughput(data_batch)
+
                 # ---------------
                 # RUN TRAIN STEP
                 # ---------------
-                batch_result = self.__run_tng_batch(data_batch, batch_nb)
+                with self.profiler.profile('run_tng_batch'):
+                    batch_result = self.__run_tng_batch(data_batch, batch_nb)
                 early_stop_epoch = batch_result == -1
 
                 # ---------------
                 # RUN VAL STEP
                 # ---------------
-                is_val_check_batch = (batch_nb + 1) % self.val_check_batch == 0
+                if self.step_based_validation:
+                    is_val_check_batch = self.global_step % self.val_check_every_n_steps == 0
+                else:
+                    is_val_check_batch = (batch_nb + 1) % self.val_check_batch == 0
+
                 if self.fast_dev_run or is_val_check_batch or early_stop_epoch:
-                    self.__run_validation()
+                    with self.profiler.profile('run_validation'):
+                        new_val_results = self.__run_validation()
+                else:
+                    # results from the async validation worker get merged as soon as they arrive
+                    new_val_results = self.async_validation and self.__collect_async_validation()
+
+                # without epochs to go by, early stopping is checked after each validation
+                if new_val_results and self.step_based_validation and self.enable_early_stop:
+                    stop_training = self.early_stop_callback.on_epoch_end(epoch=self.global_step,
+                                                                          logs=self.__tng_tqdm_dic)
 
-                # when batch should be saved
+                # when logged rows should be written out (doesn't wait for the disk)
                 if (batch_nb + 1) % self.log_save_interval == 0 or early_stop_epoch:
-                    if self.proc_rank == 0:
-                        self.experiment.save()
+                    if self.metrics_writer is not None:
+                        self.metrics_writer.flush()
 
                 # when metrics should be logged
                 if batch_nb % self.add_log_row_interval == 0 or early_stop_epoch:
@@ -680,43 +1007,64 @@ class Trainer(TrainerIO):
                     model = self.__get_model()
                     metrics = self.__tng_tqdm_dic
 
-                    # add gpu memory
-                    if self.on_gpu:
-                        mem_map = get_gpu_memory_map()
-                        metrics.update(mem_map)
+                    # latest system metrics snapshot (sampled in the background)
+                    if self.system_metrics is not None and self.proc_rank == 0:
+                        metrics.update(self.system_metrics.latest())
+
+                    # time the loop still spent waiting on the prefetcher this epoch
+                    if self.prefetch_batches > 0:
+                        metrics['tng_data_wait_ms'] = self.tng_dataloader.avg_wait_time * 1000
 
-                    # add norms
-                    if self.track_grad_norm > 0:
-                        model = self.__get_model()
-                        grad_norm_dic = model.grad_norm(self.track_grad_norm)
+                    # size ratio and write speed of the last compressed checkpoint
+                    if self.last_checkpoint_stats is not None:
+                        metrics.update(self.last_checkpoint_stats)
+
+                    # add norms (computed at the last optimizer step, the gradients are gone by now)
+                    if self.track_grad_norm > 0 and self.last_grad_norms is not None:
+                        with self.profiler.profile('grad_norm'):
+                            grad_norm_dic = self.last_grad_norms.to_dict(group_depth=self.grad_norm_group_depth)
                         metrics.update(grad_norm_dic)
 
-                    if self.__is_function_implemented('on_tng_metrics'):
-                        model.on_tng_metrics(metrics)
+                    if 'on_tng_metrics' in self.model_hooks:
+                        with self.profiler.profile('on_tng_metrics'):
+                            self.model_hooks['on_tng_metrics'](metrics)
 
                     # log metrics
                     scalar_metrics = self.__metrics_to_scalars(metrics, blacklist=self.__log_vals_blacklist())
                     if self.proc_rank == 0:
-                        self.experiment.log(scalar_metrics, global_step=self.global_step)
-                        self.experiment.save()
+                        with self.profiler.profile('experiment_log'):
+                            self.experiment.log(scalar_metrics, global_step=self.global_step)
+                            if self.metrics_writer is not None:
+                                self.metrics_writer.write(dict(scalar_metrics, global_step=self.global_step))
 
                 # hook
-                if self.__is_function_implemented('on_batch_end'):
-                    model = self.__get_model()
-                    model.on_batch_end()
+                if 'on_batch_end' in self.model_hooks:
+                    with self.profiler.profile('on_batch_end'):
+                        self.model_hooks['on_batch_end']()
+
+                # stop training once the requested number of steps is done
+                if self.max_steps is not None and self.global_step >= self.max_steps:
+                    stop_training = True
 
                 # end epoch early
-                if early_stop_epoch:
+                if early_stop_epoch or stop_training:
                     break
 
+            # this epoch's validation results are in before anything decides on them
+            if self.async_validation:
+                self.__collect_async_validation(block=True)
+
             # hook
-            if self.__is_function_implemented('on_epoch_end'):
-                model = self.__get_model()
-                model.on_epoch_end()
+            if 'on_epoch_end' in self.model_hooks:
+                with self.profiler.profile('on_epoch_end'):
+                    self.model_hooks['on_epoch_end']()
+
+            if stop_training:
+                return
 
             # early stopping
             met_min_epochs = epoch_nb > self.min_nb_epochs
-            if self.enable_early_stop and met_min_epochs:
+            if self.enable_early_stop and met_min_epochs and not self.step_based_validation:
                 should_stop = self.early_stop_callback.on_epoch_end(epoch=epoch_nb, logs=self.__tng_tqdm_dic)
 
                 # stop training
@@ -724,19 +1072,8 @@ class Trainer(TrainerIO):
                 if stop:
                     return
 
-    def __metrics_to_scalars(self, metrics, blacklist=[]):
-        new_metrics = {}
-        for k, v in metrics.items():
-            if type(v) is torch.Tensor:
-                v = v.item()
-
-            if type(v) is dict:
-                v = self.__metrics_to_scalars(v)
-
-            if k not in blacklist:
-                new_metrics[k] = float(v)
-
-        return new_metrics
+    def __metrics_to_scalars(self, metrics, blacklist=()):
+        return {k: float(v) for k, v in metrics_to_scalars(metrics, blacklist).items()}
 
     def __log_vals_blacklist(self):
         """avoid logging some vals lightning uses to maintain state"""
@@ -748,9 +1085,9 @@ class Trainer(TrainerIO):
             return 0
 
         # hook
-        if self.__is_function_implemented('on_batch_start'):
-            model_ref = self.__get_model()
-            response = model_ref.on_batch_start(data_batch)
+        if 'on_batch_start' in self.model_hooks:
+            with self.profiler.profile('on_batch_start'):
+                response = self.model_hooks['on_batch_start'](data_batch)
 
             if response == -1:
                 return -1
@@ -758,69 +1095,56 @@ class Trainer(TrainerIO):
         if self.progress_bar:
             self.prog_bar.update(1)
 
-        # forward pass
-        # return a scalar value and a dic with tqdm metrics
-        if self.use_ddp:
-            output = self.model(data_batch, batch_nb)
-        elif self.use_dp:
-            output = self.model(data_batch, batch_nb)
-            output = reduce_distributed_output(output, len(self.data_parallel_device_ids))
-        else:
-            output = self.model.training_step(data_batch, batch_nb)
-
-        try:
-            model_specific_tqdm_metrics_dic = output['tqdm_metrics']
-        except Exception as e:
-            model_specific_tqdm_metrics_dic = {}
-
-        # if output dict doesn't have the keyword loss
-        # then assume the output=loss if scalar
-        try:
-            loss = output['loss']
-        except Exception as e:
-            if type(output) is torch.Tensor:
-                loss = output
-
-        self.__add_tqdm_metrics(model_specific_tqdm_metrics_dic)
-
-        # backward pass
-        if self.use_amp:
-            # scale loss when using amp
-            for optimizer in self.optimizers:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
+        # only the micro-batch that steps the optimizers needs DDP to all-reduce the gradients
+        is_optimizer_step = (self.batch_nb + 1) % self.accumulate_grad_batches == 0
+        if self.use_ddp and not is_optimizer_step:
+            with self.model.no_sync():
+                loss = self.__forward_backward(data_batch, batch_nb)
         else:
-            loss.backward()
+            loss = self.__forward_backward(data_batch, batch_nb)
 
         # insert after step hook
-        if self.__is_function_implemented('on_after_backward'):
-            model_ref = self.__get_model()
-            response = model_ref.on_after_backward()
-
-        if self.print_nan_grads:
-            model = self.__get_model()
-            for param in model.parameters():
-                print(param.grad.float().sum())
+        if 'on_after_backward' in self.model_hooks:
+            with self.profiler.profile('on_after_backward'):
+                self.model_hooks['on_after_backward']()
 
         # avoid memory leaks
-        self.batch_loss_value += loss.item()
+        # keep the loss on the device (in double precision), it only gets synced when logging
+        self.batch_loss_value += loss.detach().double().squeeze()
 
         # gradient update with accumulated gradients
-        if (self.batch_nb + 1) % self.accumulate_grad_batches == 0:
+        if is_optimizer_step:
+
+            # one pass over the gradients feeds logging, the hook, the nan check and clipping
+            model = self.__get_model()
+            norms = self.__compute_grad_norms(model)
+
+            # a nan or inf anywhere makes the total norm non finite, so one sync decides
+            skip_step = False
+            if self.print_nan_grads or self.skip_nonfinite_grads:
+                with self.profiler.profile('check_nonfinite_grads'):
+                    skip_step = self.__check_nonfinite_grads(norms) and self.skip_nonfinite_grads
 
             # clip gradients
-            if self.gradient_clip > 0:
-                model = self.__get_model()
-                torch.nn.utils.clip_grad_norm(model.parameters(), self.gradient_clip)
+            if self.gradient_clip > 0 and not skip_step:
+                with self.profiler.profile('clip_gradients'):
+                    if norms is None or norms.norm_type != 2:
+                        norms = grad_norms(model.named_parameters(), 2)
+                    clip_grad_norms(model.parameters(), norms.total, self.gradient_clip)
 
             # update gradients across all optimizers
             for optimizer in self.optimizers:
-                optimizer.step()
+                if skip_step:
+                    optimizer.zero_grad()
+                    continue
+
+                with self.profiler.profile('optimizer_step'):
+                    optimizer.step()
 
                 # insert after step hook
-                if self.__is_function_implemented('on_before_zero_grad'):
-                    model_ref = self.__get_model()
-                    response = model_ref.on_before_zero_grad(optimizer)
+                if 'on_before_zero_grad' in self.model_hooks:
+                    with self.profiler.profile('on_before_zero_grad'):
+                        self.model_hooks['on_before_zero_grad'](optimizer)
 
                 # clear gradients
                 optimizer.zero_grad()
@@ -828,41 +1152,126 @@ class Trainer(TrainerIO):
             # queuing loss across batches blows it up proportionally... divide out the number accumulated
             self.batch_loss_value = self.batch_loss_value / self.accumulate_grad_batches
 
-            # track loss
-            self.running_loss.append(self.batch_loss_value)
+            # track loss. A skipped step's loss is usually nan or inf too, so it stays out of tng_loss
+            if not skip_step:
+                self.running_loss.append(self.batch_loss_value)
             self.batch_loss_value = 0
-            self.avg_loss = np.mean(self.running_loss[-100:])
 
-            # update progbar
-            if self.progress_bar:
-                # add model specific metrics
-                tqdm_metrics = self.__tng_tqdm_dic
-                self.prog_bar.set_postfix(**tqdm_metrics)
-
-        # activate batch end hook
-        if self.__is_function_implemented('on_batch_end'):
-            model = self.__get_model()
-            model.on_batch_end()
+        # update progbar only at log row boundaries to avoid syncing the loss every step.
+        # Not tied to optimizer steps, which could never line up with the boundaries (ie: accumulate_grad_batches=2)
+        if self.progress_bar and self.batch_nb % self.add_log_row_interval == 0:
+            # add model specific metrics
+            tqdm_metrics = self.__tng_tqdm_dic
+            self.prog_bar.set_postfix(**tqdm_metrics)
 
         return 0
 
+    def __compute_grad_norms(self, model):
+        """
+        Gradient norms of this optimizer step, in the tracked norm type (2-norm when only clipping).
+        Stay on the device until they get logged
+        :param model:
+        :return: GradNorms or None when nothing uses them
+        """
+        needs_hook = 'on_grad_norms' in self.model_hooks
+        needs_check = self.print_nan_grads or self.skip_nonfinite_grads
+        if self.track_grad_norm <= 0 and self.gradient_clip <= 0 and not needs_hook and not needs_check:
+            return None
+
+        norm_type = self.track_grad_norm if self.track_grad_norm > 0 else 2
+        with self.profiler.profile('grad_norm'):
+            norms = grad_norms(model.named_parameters(), norm_type)
+
+        if self.track_grad_norm > 0:
+            self.last_grad_norms = norms
+
+        if needs_hook:
+            with self.profiler.profile('on_grad_norms'):
+                self.model_hooks['on_grad_norms'](norms)
+
+        return norms
+
+    def __check_nonfinite_grads(self, norms):
+        """
+        Only syncs the total norm. Names the offending parameters when there are some
+        :param norms: GradNorms
+        :return: True when a gradient has a nan or inf
+        """
+        if norms.norms is None or bool(torch.isfinite(norms.total)):
+            return False
+
+        if self.skip_nonfinite_grads:
+            self.nb_skipped_steps += 1
+
+        bad_params = [name for name, norm in zip(norms.names, norms.norms.tolist()) if not math.isfinite(norm)]
+        action = 'skipping the optimizer step' if self.skip_nonfinite_grads else 'stepping anyway'
+        print('step {}: nan or inf gradients in {}, {}'.format(self.global_step, ', '.join(bad_params), action))
+
+        return True
+
+    def __forward_backward(self, data_batch, batch_nb):
+        # forward pass
+        # return a scalar value and a dic with tqdm metrics
+        with self.profiler.profile('training_step'):
+            if self.use_ddp:
+                output = self.model(data_batch, batch_nb)
+            elif self.use_dp:
+                output = self.model(data_batch, batch_nb)
+                output = reduce_distributed_output(output, len(self.data_parallel_device_ids))
+            else:
+                output = self.model.training_step(data_batch, batch_nb)
+
+        try:
+            model_specific_tqdm_metrics_dic = output['tqdm_metrics']
+        except Exception as e:
+            model_specific_tqdm_metrics_dic = {}
+
+        # if output dict doesn't have the keyword loss
+        # then assume the output=loss if scalar
+        try:
+            loss = output['loss']
+        except Exception as e:
+            if type(output) is torch.Tensor:
+                loss = output
+
+        self.__add_tqdm_metrics(model_specific_tqdm_metrics_dic)
+
+        # backward pass
+        with self.profiler.profile('backward'):
+            if self.use_amp:
+                # scale loss when using amp
+                for optimizer in self.optimizers:
+                    with amp.scale_loss(loss, optimizer) as scaled_loss:
+                        scaled_loss.backward()
+            else:
+                loss.backward()
+
+        return loss
+
     def __run_validation(self):
+        """
+        Run validation (or hand it to the async worker)
+        :return: True when new validation results were reported
+        """
         # decide if can check epochs
         can_check_epoch = (self.current_epoch + 1) % self.check_val_every_n_epoch == 0
+        can_check_epoch = can_check_epoch or self.step_based_validation
         if self.fast_dev_run:
             print('skipping to check performance bc of --fast_dev_run')
         elif not can_check_epoch:
-            return
+            return False
+
+        # val_percent_check (or max_val_batches) of the val set. A single batch on fast dev run
+        max_batches = self.nb_val_batches if not self.fast_dev_run else 1
+
+        if self.async_validation:
+            return self.__submit_async_validation(max_batches)
 
         try:
             # hook
-            if self.__is_function_implemented('on_pre_performance_check'):
-                model = self.__get_model()
-                model.on_pre_performance_check()
+            if 'on_pre_performance_check' in self.model_hooks:
+                self.model_hooks['on_pre_performance_check']()
 
-            # use full val set on end of epoch
-            # use a small portion otherwise
-            max_batches = None if not self.fast_dev_run else 1
             model_specific_tqdm_metrics_dic = self.validate(
                 self.model,
                 self.val_dataloader,
@@ -871,14 +1280,25 @@ class Trainer(TrainerIO):
             self.__add_tqdm_metrics(model_specific_tqdm_metrics_dic)
 
             # hook
-            if self.__is_function_implemented('on_post_performance_check'):
-                model = self.__get_model()
-                model.on_post_performance_check()
+            if 'on_post_performance_check' in self.model_hooks:
+                self.model_hooks['on_post_performance_check']()
 
         except Exception as e:
             print(e)
             print(traceback.print_exc())
 
+        self.__on_validation_end(self.current_epoch, self.global_step)
+        return True
+
+    def __on_validation_end(self, epoch, global_step, snapshot=None):
+        """
+        Report new validation results to the progress bar and checkpoint callback
+        :param epoch: epoch the validated weights come from
+        :param global_step: step the validated weights come from
+        :param snapshot: (state_dict, optimizer_states) validated, when they aren't the live ones (async validation).
+            Those get checkpointed
+        :return:
+        """
         if self.progress_bar:
             # add model specific metrics
             tqdm_metrics = self.__tng_tqdm_dic
@@ -887,4 +1307,128 @@ class Trainer(TrainerIO):
         # model checkpointing
         if self.proc_rank == 0 and self.checkpoint_callback:
             print('save callback...')
-            self.checkpoint_callback.on_epoch_end(epoch=self.current_epoch, logs=self.__tng_tqdm_dic)
+            if snapshot is not None:
+                self.validated_snapshot = (epoch, global_step) + snapshot
+            try:
+                with self.profiler.profile('checkpoint'):
+                    if self.step_based_validation:
+                        self.checkpoint_callback.on_step_end(step=global_step, logs=self.__tng_tqdm_dic)
+                    else:
+                        self.checkpoint_callback.on_epoch_end(epoch=epoch, logs=self.__tng_tqdm_dic)
+            finally:
+                self.validated_snapshot = None
+
+    # -----------------------------
+    # ASYNC VALIDATION
+    # -----------------------------
+    def __start_async_validation(self, ref_model):
+        """
+        Fork a cpu process that validates weight snapshots while training continues.
+        The worker inherits the trainer, model and val dataloader through fork, so nothing needs to be pickled
+        :param ref_model: the LightningModule (not the DP/DDP wrapper)
+        :return:
+        """
+        val_model = ref_model
+        if self.on_gpu:
+            # the forked process can't touch cuda tensors, give it a cpu replica.
+            # the trainer, experiment and dataloaders are shared rather than copied
+            shared = [self, self.experiment, ref_model._tng_dataloader,
+                      ref_model._val_dataloader, ref_model._test_dataloader]
+            memo = {id(x): x for x in shared if x is not None}
+            val_model = copy.deepcopy(ref_model, memo).cpu()
+
+        ctx = mp.get_context('fork')
+        self.async_val_snapshots = ctx.Queue(maxsize=1)
+        self.async_val_results = ctx.Queue()
+        self.async_val_pending = 0
+        self.async_val_snapshot = None
+        self.async_val_worker = ctx.Process(
+            target=self.__async_validation_worker,
+            args=(val_model, self.async_val_snapshots, self.async_val_results),
+            daemon=True
+        )
+        self.async_val_worker.start()
+
+    def __async_validation_worker(self, model, snapshots, results):
+        # runs in the forked process: this trainer is a private copy and only ever uses the cpu
+        self.on_gpu = False
+        self.use_dp = False
+        self.use_ddp = False
+        self.progress_bar = False
+        self.prog_bar = None
+        model.on_gpu = False
+
+        while True:
+            snapshot = snapshots.get()
+            if snapshot is None:
+                return
+
+            epoch, global_step, max_batches, state_dict = snapshot
+            try:
+                model.load_state_dict(state_dict)
+                self.current_epoch = epoch
+                self.global_step = global_step
+                val_results = self.validate(model, self.val_dataloader, max_batches)
+                results.put((epoch, global_step, val_results, None))
+            except Exception as e:
+                results.put((epoch, global_step, None, traceback.format_exc()))
+
+    def __submit_async_validation(self, max_batches):
+        """
+        Snapshot the weights and queue them for the validation worker
+        :return: True if results of the previous validation were merged while waiting
+        """
+        # never queue up stale snapshots. If the last validation is still running, wait for it
+        new_val_results = self.__collect_async_validation(block=True)
+
+        # hook
+        if 'on_pre_performance_check' in self.model_hooks:
+            self.model_hooks['on_pre_performance_check']()
+
+        # copy the weights off the live parameters. The queue moves them to shared memory
+        model = self.__get_model()
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        self.async_val_snapshots.put((self.current_epoch, self.global_step, max_batches, state_dict))
+        self.async_val_pending += 1
+
+        # the queue moved the tensors to shared memory, so keeping them for the checkpoint doesn't copy anything.
+        # The optimizer states of the same step go with them, so resuming from that checkpoint is consistent
+        if self.checkpoint_callback is not None and self.proc_rank == 0:
+            optimizer_states = [snapshot_to_host(optimizer.state_dict()) for optimizer in self.optimizers]
+            self.async_val_snapshot = (state_dict, optimizer_states)
+        return new_val_results
+
+    def __collect_async_validation(self, block=False):
+        """
+        Merge results from the validation worker if there are any
+        :param block: wait for the pending validation to finish
+        :return: True when new results were merged
+        """
+        if self.async_val_pending == 0:
+            return False
+
+        try:
+            epoch, global_step, val_results, error = self.async_val_results.get(block=block)
+        except queue.Empty:
+            return False
+
+        self.async_val_pending -= 1
+        snapshot, self.async_val_snapshot = self.async_val_snapshot, None
+        if error is not None:
+            print(error)
+        else:
+            self.__add_tqdm_metrics(val_results)
+
+            # hook
+            if 'on_post_performance_check' in self.model_hooks:
+                self.model_hooks['on_post_performance_check']()
+
+        self.__on_validation_end(epoch, global_step, snapshot)
+        return True
+
+    def __stop_async_validation(self):
+        # report whatever is still running, then shut the worker down
+        self.__collect_async_validation(block=True)
+        self.async_val_snapshots.put(None)
+        self.async_val_worker.join()
+        self.async_val_worker = None
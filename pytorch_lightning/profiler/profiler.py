@@ -0,0 +1,135 @@
+import time
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+Timers for each stage of the training loop
+"""
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class PassThroughProfiler(object):
+    """
+    Used when profiling is off. Every call is a no-op so the training loop pays (almost) nothing
+    """
+
+    enabled = False
+
+    def start(self, action_name):
+        pass
+
+    def stop(self, action_name):
+        pass
+
+    def profile(self, action_name):
+        return _NULL_CONTEXT
+
+    def profile_iterable(self, iterable, action_name):
+        return iterable
+
+    def stats(self):
+        return {}
+
+    def summary(self):
+        return ''
+
+
+class Profiler(PassThroughProfiler):
+    """
+    Records the wall time of every call to each action.
+
+    Cuda kernels run asynchronously, so on gpu the time of a stage may show up in the next stage that syncs
+    (ie: optimizer.step() or a .item() call)
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.current_actions = {}
+        # array('d') stores raw doubles, 8 bytes per call.
+        # A plain dict (no lambda factory) keeps the profiler picklable for mp.spawn.
+        # Arrays are only allocated the first time an action stops
+        self.recorded_durations = {}
+
+    def start(self, action_name):
+        if action_name in self.current_actions:
+            raise ValueError('Attempted to start {} which has already started.'.format(action_name))
+        self.current_actions[action_name] = time.perf_counter()
+
+    def stop(self, action_name):
+        end_time = time.perf_counter()
+        if action_name not in self.current_actions:
+            raise ValueError('Attempting to stop recording an action ({}) which was never started.'.format(action_name))
+
+        start_time = self.current_actions.pop(action_name)
+        if action_name not in self.recorded_durations:
+            self.recorded_durations[action_name] = array('d')
+        self.recorded_durations[action_name].append(end_time - start_time)
+
+    @contextmanager
+    def profile(self, action_name):
+        try:
+            self.start(action_name)
+            yield action_name
+        finally:
+            self.stop(action_name)
+
+    def profile_iterable(self, iterable, action_name):
+        """
+        Time how long each next() call takes (ie: fetching a batch from a dataloader)
+        """
+        iterator = iter(iterable)
+        while True:
+            self.start(action_name)
+            try:
+                value = next(iterator)
+            except StopIteration:
+                self.stop(action_name)
+                return
+            self.stop(action_name)
+            yield value
+
+    def stats(self):
+        """
+        :return: dict of action -> dict(total, mean, p50, p99, count). Times in seconds
+        """
+        stats = {}
+        for action_name, durations in self.recorded_durations.items():
+            durations = np.frombuffer(durations, dtype=np.float64)
+            stats[action_name] = {
+                'total': float(durations.sum()),
+                'mean': float(durations.mean()),
+                'p50': float(np.percentile(durations, 50)),
+                'p99': float(np.percentile(durations, 99)),
+                'count': len(durations),
+            }
+        return stats
+
+    def summary(self):
+        """
+        :return: table with one row per action, slowest (total time) first
+        """
+        stats = self.stats()
+        rows = sorted(stats.items(), key=lambda x: x[1]['total'], reverse=True)
+
+        name_width = max([len('Action')] + [len(name) for name in stats.keys()])
+        header = '{:<{w}} | {:>12} | {:>12} | {:>12} | {:>12} | {:>10}'.format(
+            'Action', 'Total (s)', 'Mean (ms)', 'P50 (ms)', 'P99 (ms)', 'Calls', w=name_width)
+        lines = ['Profiler Report', header, '-' * len(header)]
+        for name, s in rows:
+            lines.append('{:<{w}} | {:>12.4f} | {:>12.4f} | {:>12.4f} | {:>12.4f} | {:>10}'.format(
+                name, s['total'], s['mean'] * 1000, s['p50'] * 1000, s['p99'] * 1000, s['count'], w=name_width))
+
+        return '\n'.join(lines)
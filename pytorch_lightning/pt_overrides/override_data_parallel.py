@@ -78,7 +78,9 @@ class LightningDistributedDataParallel(DistributedDataParallel):
         return parallel_apply(replicas, inputs, kwargs, self.device_ids[:len(replicas)])
 
     def forward(self, *inputs, **kwargs):  # pragma: no cover
-        self._sync_params()
+        # params only need a sync when the last backward reduced the gradients (ie: not inside no_sync())
+        if self.require_forward_param_sync:
+            self._sync_params()
         if self.device_ids:
             inputs, kwargs = self.scatter(inputs, kwargs, self.device_ids)
             if len(self.device_ids) == 1:
@@ -99,7 +101,8 @@ class LightningDistributedDataParallel(DistributedDataParallel):
         else:
             output = self.module(*inputs, **kwargs)
 
-        if torch.is_grad_enabled():
+        if torch.is_grad_enabled() and self.require_backward_grad_sync:
+            self.require_forward_param_sync = True
             # We'll return the output object verbatim since it is a freeform
             # object. We need to find any tensors in this object, though,
             # because we need to figure out which parameters were used during
@@ -109,6 +112,9 @@ class LightningDistributedDataParallel(DistributedDataParallel):
                 self.reducer.prepare_for_backward(list(_find_tensors(output)))
             else:
                 self.reducer.prepare_for_backward([])
+        else:
+            # inside no_sync() the reducer isn't armed, so backward only accumulates local gradients
+            self.require_forward_param_sync = False
         return output
 
 
@@ -1,4 +1,6 @@
-import numpy as np
+import math
+
+import torch
 from torch import nn
 
 """
@@ -6,24 +8,138 @@ Module to describe gradients
 """
 
 
-class GradInformation(nn.Module):
+def _norms(tensors, norm_type):
+    # one kernel launch for every tensor when foreach ops are available (torch >= 1.13)
+    if hasattr(torch, '_foreach_norm') and len({t.device for t in tensors}) == 1:
+        return torch.stack(torch._foreach_norm(tensors, norm_type))
+
+    device = tensors[0].device
+    return torch.stack([t.norm(norm_type).to(device) for t in tensors])
+
+
+def _combine_norms(norms, norm_type):
+    # the p-norm of a set of tensors is the p-norm of their individual p-norms
+    if math.isinf(norm_type):
+        return norms.max()
+
+    # half precision overflows on the pow (ie: 3000 ** 2 > 65504)
+    if norms.dtype in (torch.float16, torch.bfloat16):
+        norms = norms.float()
+    return norms.pow(norm_type).sum().pow(1. / norm_type)
+
+
+class GradNorms(object):
+    """
+    Gradient norms of every parameter for one optimizer step. Stays on the device until to_dict()
+    """
+
+    def __init__(self, names, indices, norms, norm_type):
+        """
+        :param names: name of each parameter that had a gradient
+        :param indices: position of each of those parameters in model.parameters()
+        :param norms: 1d tensor with the norm of each gradient (None when no parameter had a gradient)
+        :param norm_type: p of the p-norm
+        """
+        self.names = names
+        self.indices = indices
+        self.norms = norms
+        self.norm_type = norm_type
+        self.__total = None
+
+    @property
+    def total(self):
+        """
+        Norm over all the gradients together (0-dim tensor)
+        :return:
+        """
+        if self.__total is None and self.norms is not None:
+            self.__total = _combine_norms(self.norms, self.norm_type)
+        return self.__total
+
+    def to_dict(self, key='grad_{}_norm_{}', group_depth=None):
+        """
+        Rounded norms for logging, moved to the host in a single transfer
+        :param key: format string filled with the norm type and the parameter index, group name or 'total'
+        :param group_depth: when set, parameters are grouped by the first `group_depth` parts of their name
+            (ie: 1 gives one norm per top level module) instead of one norm per parameter
+        :return:
+        """
+        norm_type = int(self.norm_type) if self.norm_type.is_integer() else self.norm_type
+        if self.norms is None:
+            return {key.format(norm_type, 'total'): 0.0}
+
+        if group_depth is None:
+            keys = [key.format(norm_type, i) for i in self.indices]
+            values = [self.norms]
+        else:
+            groups = {}
+            for i, name in enumerate(self.names):
+                groups.setdefault('.'.join(name.split('.')[:group_depth]), []).append(i)
 
-    def grad_norm(self, norm_type):
-        results = {}
-        total_norm = 0
-        for i, p in enumerate(self.parameters()):
-            if p.requires_grad:
-                try:
-                    param_norm = p.grad.data.norm(norm_type)
-                    total_norm += param_norm ** norm_type
-                    norm = param_norm ** (1 / norm_type)
-
-                    results['grad_{}_norm_{}'.format(norm_type, i)] = round(norm.data.cpu().numpy().flatten()[0], 3)
-                except Exception as e:
-                    # this param had no grad
-                    pass
-
-        total_norm = total_norm ** (1. / norm_type)
-        results['grad_{}_norm_total'.format(norm_type)] = round(total_norm.data.cpu().numpy().flatten()[0], 3)
-        return results
+            keys = [key.format(norm_type, group) for group in groups]
+            values = [torch.stack([_combine_norms(self.norms[idx], self.norm_type) for idx in groups.values()])]
+
+        keys.append(key.format(norm_type, 'total'))
+        values.append(self.total.reshape(1))
+
+        # single sync with the host
+        host_values = torch.cat(values).cpu().tolist()
+        return {k: round(v, 3) for k, v in zip(keys, host_values)}
+
+
+def grad_norms(named_parameters, norm_type):
+    """
+    Norm of the gradient of every parameter, computed with batched ops. Nothing is synced with the host
+    :param named_parameters: iterable of (name, parameter)
+    :param norm_type: p of the p-norm (can be inf)
+    :return: GradNorms. Parameters without a gradient are skipped
+    """
+    names, indices, grads = [], [], []
+    for i, (name, p) in enumerate(named_parameters):
+        if p.requires_grad and p.grad is not None:
+            names.append(name)
+            indices.append(i)
+            grads.append(p.grad.detach())
+
+    norm_type = float(norm_type)
+    norms = _norms(grads, norm_type) if len(grads) > 0 else None
+    return GradNorms(names, indices, norms, norm_type)
+
+
+def clip_grad_norms(parameters, total_norm, max_norm):
+    """
+    Same as torch.nn.utils.clip_grad_norm_ but reuses an already computed total norm.
+    Doesn't sync with the host
+    :param parameters:
+    :param total_norm: 0-dim tensor
+    :param max_norm:
+    :return:
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if len(grads) == 0 or total_norm is None:
+        return
+
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    if hasattr(torch, '_foreach_mul_') and len({g.device for g in grads}) == 1:
+        try:
+            torch._foreach_mul_(grads, clip_coef.to(grads[0].device))
+            return
+        except (TypeError, RuntimeError):
+            # older versions only multiply by python numbers
+            pass
+
+    for g in grads:
+        g.mul_(clip_coef.to(g.device))
+
+
+class GradInformation(nn.Module):
 
+    def grad_norm(self, norm_type, group_depth=None):
+        """
+        Gradient norms for logging, moved to the host in a single transfer
+        :param norm_type: p of the p-norm (can be inf)
+        :param group_depth: when set, parameters are grouped by the first `group_depth` parts of their name
+            (ie: 1 gives one norm per top level module) instead of logging one norm per parameter
+        :return: dict of rounded norms, including the total norm
+        """
+        return grad_norms(self.named_parameters(), norm_type).to_dict(group_depth=group_depth)
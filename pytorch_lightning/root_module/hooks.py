@@ -43,3 +43,13 @@ class ModelHooks(torch.nn.Module):
         """
         pass
 
+    def on_grad_norms(self, grad_norms):
+        """
+        Called once per optimizer step, before gradients get clipped.
+        grad_norms.norms holds the norm of each gradient and grad_norms.total the overall norm, both still on the
+        device. Call grad_norms.to_dict() to get python numbers
+
+        :param grad_norms: GradNorms
+        :return:
+        """
+        pass
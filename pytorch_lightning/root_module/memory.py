@@ -1,8 +1,7 @@
 import torch
 import gc
 import subprocess
-import numpy as np
-import pandas as pd
+from torch import nn
 
 
 '''
@@ -10,141 +9,245 @@ Generates a summary of a model's layers and dimensionality
 '''
 
 
+def _tensors(x):
+    # every tensor in a (nested) module input or output
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        return [t for item in x for t in _tensors(item)]
+    return []
+
+
+def _sizes(x):
+    sizes = [list(t.size()) for t in _tensors(x)]
+    return sizes[0] if len(sizes) == 1 else sizes
+
+
+def _nb_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+# one op per output element. GELU is torch >= 1.4
+_ELEMENTWISE_MODULES = tuple(m for m in [
+    nn.ReLU, nn.Tanh, nn.Sigmoid, nn.LeakyReLU, nn.ELU, getattr(nn, 'GELU', None), nn.Softmax, nn.LogSoftmax,
+    nn.modules.pooling._MaxPoolNd, nn.modules.pooling._AvgPoolNd,
+] if m is not None)
+
+
+def estimate_flops(module, inputs, output):
+    """
+    Approximate multiply-adds x 2 of one forward call of a leaf module. 0 for unknown module types
+    :param module:
+    :param inputs: tuple of inputs passed to forward
+    :param output:
+    :return:
+    """
+    out = _tensors(output)
+    if len(out) == 0:
+        return 0
+    out_numel = out[0].numel()
+
+    if isinstance(module, nn.Linear):
+        return 2 * module.in_features * out_numel
+
+    if isinstance(module, nn.modules.conv._ConvNd):
+        kernel_numel = 1
+        for k in module.kernel_size:
+            kernel_numel *= k
+        return 2 * out_numel * kernel_numel * module.in_channels // module.groups
+
+    if isinstance(module, (nn.modules.batchnorm._BatchNorm, nn.LayerNorm, nn.GroupNorm)):
+        return 4 * out_numel
+
+    if isinstance(module, _ELEMENTWISE_MODULES):
+        return out_numel
+
+    return 0
+
+
 class ModelSummary(object):
 
-    def __init__(self, model):
+    def __init__(self, model, batch_size=None):
         '''
         Generates summaries of model layers and dimensions.
+        Shapes, activation memory and FLOPs come from one forward pass of model.example_input_array
+        :param model:
+        :param batch_size: batch size used for the peak memory estimate (defaults to the example input's)
         '''
         self.model = model
+        self.batch_size = batch_size
         self.in_sizes = []
         self.out_sizes = []
+        self.example_batch_size = None
 
         self.summarize()
 
     def __str__(self):
-        return self.summary.__str__()
+        return self.summary
 
     def __repr__(self):
-        return self.summary.__str__()
+        return self.summary
+
+    def get_layer_names(self):
+        '''Collect Layer Names'''
+        mods = list(self.model.named_modules())[1:]
+        self.layer_names = [name for name, _ in mods]
+        self.layer_types = [m.__class__.__name__ for _, m in mods]
+        self.modules = [m for _, m in mods]
+        return
+
+    def get_parameter_nums(self):
+        '''Number of parameters (and their bytes) in each layer, including its submodules'''
+        index_of = {name: i for i, name in enumerate(self.layer_names)}
+        param_nums = [0] * len(self.layer_names)
+        param_bytes = [0] * len(self.layer_names)
+
+        # count each module's own parameters once, then add them to every parent
+        # (linear in the number of modules x depth instead of re-walking every subtree)
+        for name, m in zip(self.layer_names, self.modules):
+            own = list(m.parameters(recurse=False))
+            if len(own) == 0:
+                continue
+
+            nb, nb_bytes = sum(p.numel() for p in own), _nb_bytes(own)
+            parts = name.split('.')
+            for depth in range(1, len(parts) + 1):
+                i = index_of.get('.'.join(parts[:depth]))
+                if i is not None:
+                    param_nums[i] += nb
+                    param_bytes[i] += nb_bytes
+
+        self.param_nums = param_nums
+        self.param_bytes = param_bytes
+        return
 
     def get_variable_sizes(self):
-        '''Run sample input through each layer to get output sizes'''
-        mods = list(self.model.modules())
-        in_sizes = []
-        out_sizes = []
-        input_ = self.model.example_input_array
+        '''Run the example input through the model once, recording every module with forward hooks'''
+        nb_modules = len(self.modules)
+        in_sizes = [None] * nb_modules
+        out_sizes = [None] * nb_modules
+        act_bytes = [0] * nb_modules
+        flops = [0] * nb_modules
+        is_leaf = [len(list(m.children())) == 0 for m in self.modules]
+
+        def make_hook(i):
+            def hook(module, inputs, output):
+                # shapes of the first call, costs of every call (shared modules run more than once)
+                if in_sizes[i] is None:
+                    in_sizes[i] = _sizes(inputs)
+                    out_sizes[i] = _sizes(output)
+                if is_leaf[i]:
+                    act_bytes[i] += _nb_bytes(_tensors(output))
+                    flops[i] += estimate_flops(module, inputs, output)
+            return hook
 
-        if self.model.on_gpu:
+        input_ = self.model.example_input_array
+        trainer = getattr(self.model, 'trainer', None)
+        if getattr(self.model, 'on_gpu', False):
             input_ = input_.cuda(0)
 
-        if self.model.trainer.use_amp:
+        if trainer is not None and trainer.use_amp:
             input_ = input_.half()
 
-        with torch.no_grad():
-
-            for i in range(1, len(mods)):
-                m = mods[i]
-                if type(input_) is list or type(input_) is tuple:  # pragma: no cover
-                    out = m(*input_)
-                else:
-                    out = m(input_)
-
-                if type(input_) is tuple or type(input_) is list:  # pragma: no cover
-                    in_size = []
-                    for x in input_:
-                        if type(x) is list:
-                            in_size.append(len(x))
-                        else:
-                            in_size.append(x.size())
-                else:
-                    in_size = np.array(input_.size())
+        example_tensors = _tensors(input_)
+        if len(example_tensors) > 0 and example_tensors[0].dim() > 0:
+            self.example_batch_size = example_tensors[0].size(0)
 
-                in_sizes.append(in_size)
+        handles = [m.register_forward_hook(make_hook(i)) for i, m in enumerate(self.modules)]
 
-                if type(out) is tuple or type(out) is list:  # pragma: no cover
-                    out_size = np.asarray([x.size() for x in out])
+        # eval mode so the summary doesn't update batchnorm statistics
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                if isinstance(input_, (list, tuple)):
+                    self.model(*input_)
                 else:
-                    out_size = np.array(out.size())
-
-                out_sizes.append(out_size)
-                input_ = out
+                    self.model(input_)
+        finally:
+            self.model.train(was_training)
+            for handle in handles:
+                handle.remove()
+
+        # containers report the totals of their children
+        index_of = {name: i for i, name in enumerate(self.layer_names)}
+        for i, name in enumerate(self.layer_names):
+            if not is_leaf[i] or (act_bytes[i] == 0 and flops[i] == 0):
+                continue
+            parts = name.split('.')
+            for depth in range(1, len(parts)):
+                parent = index_of.get('.'.join(parts[:depth]))
+                if parent is not None:
+                    act_bytes[parent] += act_bytes[i]
+                    flops[parent] += flops[i]
 
         self.in_sizes = in_sizes
         self.out_sizes = out_sizes
+        self.act_bytes = act_bytes
+        self.flops = flops
+        self.total_act_bytes = sum(b for b, leaf in zip(act_bytes, is_leaf) if leaf)
+        self.total_flops = sum(f for f, leaf in zip(flops, is_leaf) if leaf)
         return
 
-    def get_layer_names(self):
-        '''Collect Layer Names'''
-        mods = list(self.model.named_modules())
-        names = []
-        layers = []
-        for m in mods[1:]:
-            names += [m[0]]
-            layers += [str(m[1].__class__)]
-
-        layer_types = [x.split('.')[-1][:-2] for x in layers]
-
-        self.layer_names = names
-        self.layer_types = layer_types
-        return
+    def peak_memory_estimate(self, batch_size=None):
+        '''
+        Rough bytes needed to train at batch_size: parameters, their gradients and every leaf module output
+        (kept for the backward pass). Optimizer state and framework overhead are not included
+        '''
+        params = list(self.model.parameters())
+        nb_bytes = _nb_bytes(params) + _nb_bytes([p for p in params if p.requires_grad])
 
-    def get_parameter_sizes(self):
-        '''Get sizes of all parameters in `model`'''
-        mods = list(self.model.modules())
-        sizes = []
+        if self.example_batch_size:
+            batch_size = batch_size or self.batch_size or self.example_batch_size
+            nb_bytes += int(self.total_act_bytes * batch_size / self.example_batch_size)
 
-        for i in range(1,len(mods)):
-            m = mods[i]
-            p = list(m.parameters())
-            modsz = []
-            for j in range(len(p)):
-                modsz.append(np.array(p[j].size()))
-            sizes.append(modsz)
-
-        self.param_sizes = sizes
-        return
-
-    def get_parameter_nums(self):
-        '''Get number of parameters in each layer'''
-        param_nums = []
-        for mod in self.param_sizes:
-            all_params = 0
-            for p in mod:
-                all_params += np.prod(p)
-            param_nums.append(all_params)
-        self.param_nums = param_nums
-        return
+        return nb_bytes
 
     def make_summary(self):
         '''
         Makes a summary listing with:
 
-        Layer Name, Layer Type, Input Size, Output Size, Number of Parameters
+        Layer Name, Layer Type, Number of Parameters and, with an example input,
+        Input Size, Output Size, Activation memory, FLOPs
         '''
-
-        cols = ['Name', 'Type', 'Params']
-        if self.model.example_input_array is not None:
-            cols.extend(['In_sizes', 'Out_sizes'])
-
-        df = pd.DataFrame(np.zeros( (len(self.layer_names), len(cols))))
-        df.columns = cols
-
-        df['Name'] = self.layer_names
-        df['Type'] = self.layer_types
-        df['Params'] = self.param_nums
-
-        if self.model.example_input_array is not None:
-
-            df['In_sizes'] = self.in_sizes
-            df['Out_sizes'] = self.out_sizes
-
-        self.summary = df
+        has_example = self.model.example_input_array is not None
+
+        cols = ['', 'Name', 'Type', 'Params']
+        if has_example:
+            cols.extend(['In_sizes', 'Out_sizes', 'Act_mem', 'FLOPs'])
+
+        rows = []
+        for i, (name, layer_type) in enumerate(zip(self.layer_names, self.layer_types)):
+            row = [str(i), name, layer_type, str(self.param_nums[i])]
+            if has_example:
+                row.extend([str(self.in_sizes[i]), str(self.out_sizes[i]),
+                            _human_bytes(self.act_bytes[i]), _human_count(self.flops[i])])
+            rows.append(row)
+
+        widths = [len(col) for col in cols]
+        for row in rows:
+            widths = [max(w, len(value)) for w, value in zip(widths, row)]
+
+        lines = ['  '.join(value.rjust(w) for value, w in zip(row, widths)) for row in [cols] + rows]
+
+        total_params = sum(p.numel() for p in self.model.parameters())
+        lines.append('')
+        lines.append('Params: {} ({})'.format(total_params, _human_bytes(_nb_bytes(list(self.model.parameters())))))
+        if has_example:
+            batch_size = self.batch_size or self.example_batch_size
+            lines.append('Forward FLOPs (batch of {}): {}'.format(self.example_batch_size,
+                                                                  _human_count(self.total_flops)))
+            lines.append('Estimated peak training memory (batch of {}): {}'.format(
+                batch_size, _human_bytes(self.peak_memory_estimate())))
+
+        self.rows = rows
+        self.summary = '\n'.join(lines)
         return
 
     def summarize(self):
         self.get_layer_names()
-        self.get_parameter_sizes()
         self.get_parameter_nums()
 
         if self.model.example_input_array is not None:
@@ -152,6 +255,22 @@ class ModelSummary(object):
         self.make_summary()
 
 
+def _human_bytes(nb_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nb_bytes) < 1024:
+            return '{:.1f} {}'.format(nb_bytes, unit) if unit != 'B' else '{} B'.format(nb_bytes)
+        nb_bytes /= 1024.
+    return '{:.1f} TB'.format(nb_bytes)
+
+
+def _human_count(n):
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(n) < 1000:
+            return '{:.1f}{}'.format(n, unit) if unit else str(n)
+        n /= 1000.
+    return '{:.1f}T'.format(n)
+
+
 def print_mem_stack(): # pragma: no cover
     for obj in gc.get_objects():
         try:
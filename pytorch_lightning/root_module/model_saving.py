@@ -1,8 +1,13 @@
+import contextlib
+import inspect
 import torch
 import os
-import re
 import pdb
 from pytorch_lightning.pt_overrides.override_data_parallel import LightningDistributedDataParallel, LightningDataParallel
+from pytorch_lightning.utils.checkpoint_io import atomic_save, remove_checkpoint, CheckpointManifest
+from pytorch_lightning.utils.sharded_checkpoint import save_sharded_checkpoint, load_checkpoint
+from pytorch_lightning.utils.frozen_weights import FrozenWeightsBase
+from pytorch_lightning.utils.compressed_checkpoint import save_compressed_checkpoint
 
 class ModelIO(object):
 
@@ -52,9 +57,51 @@ class TrainerIO(object):
     # --------------------
     def save_checkpoint(self, filepath):
         checkpoint = self.dump_checkpoint()
+        if self.checkpoint_format == 'sharded':
+            save_function = save_sharded_checkpoint
+        elif self.checkpoint_compression is not None:
+            save_function = self.__save_compressed
+        else:
+            save_function = atomic_save
+
+        # frozen weights go to a base file written only once. It has to be on disk before the checkpoint
+        if self.frozen_weights is not None:
+            dirpath = os.path.dirname(os.path.abspath(filepath))
+            checkpoint, base_path, base = self.frozen_weights.split(checkpoint, self.__get_model(), dirpath)
+            if base is not None:
+                self.__write(base, base_path, atomic_save)
+
+        self.__write(checkpoint, filepath, save_function)
+
+    def __save_compressed(self, checkpoint, filepath):
+        # size ratio and write speed get logged with the training metrics
+        self.last_checkpoint_stats = save_compressed_checkpoint(checkpoint, filepath, codec=self.checkpoint_compression)
+
+    def __write(self, checkpoint, filepath, save_function):
+        # do the actual save (in the background with async checkpointing)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.submit(checkpoint, filepath, save_function)
+        else:
+            save_function(checkpoint, filepath)
+
+    def delete_checkpoint(self, filepath):
+        """
+        Delete a checkpoint, after any pending background write (which could be that same checkpoint)
+        :param filepath:
+        :return:
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.run(remove_checkpoint, filepath)
+        else:
+            remove_checkpoint(filepath)
 
-        # do the actual save
-        torch.save(checkpoint, filepath)
+    def flush_checkpoints(self):
+        """
+        Wait for background checkpoint writes to finish
+        :return:
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
 
     def dump_checkpoint(self):
 
@@ -82,6 +129,17 @@ class TrainerIO(object):
 
         # merge trainer and model saving items
         checkpoint.update(checkpoint_dict)
+
+        # with async validation, checkpoint the weights that were validated rather than the live ones,
+        # along with the optimizer states of that step
+        if self.validated_snapshot is not None:
+            epoch, global_step, state_dict, optimizer_states = self.validated_snapshot
+            checkpoint['epoch'] = epoch
+            checkpoint['global_step'] = global_step
+            checkpoint['optimizer_states'] = optimizer_states
+            if 'state_dict' in checkpoint:
+                checkpoint['state_dict'] = state_dict
+
         return checkpoint
 
     # --------------------
@@ -142,11 +200,8 @@ class TrainerIO(object):
         # close experiment to avoid issues
         experiment.close()
 
-        ckpt_number = self.max_ckpt_in_folder(folderpath) + 1
-
-        if not os.path.exists(folderpath):
-            os.makedirs(folderpath, exist_ok=True)
-        filepath = '{}/hpc_ckpt_{}.ckpt'.format(folderpath, ckpt_number)
+        manifest = CheckpointManifest(folderpath)
+        filepath = manifest.checkpoint_path(manifest.next_seq())
 
         # give model a chance to do something on hpc_save
         model = self.__get_model()
@@ -155,16 +210,23 @@ class TrainerIO(object):
         # request what to save from the model
         checkpoint_dict = self.dump_checkpoint()
 
-        # do the actual save
-        torch.save(checkpoint_dict, filepath)
+        # the job is about to be requeued, so this one is written right away (after any pending ones)
+        self.flush_checkpoints()
+        atomic_save(checkpoint_dict, filepath)
+
+        # only listed once it's completely on disk
+        manifest.append(filepath, step=self.global_step)
 
     def hpc_load(self, folderpath, on_gpu):
-        filepath = '{}/hpc_ckpt_{}.ckpt'.format(folderpath, self.max_ckpt_in_folder(folderpath))
+        entry = CheckpointManifest(folderpath).latest()
+        if entry is None:
+            raise FileNotFoundError('no hpc checkpoint found in {}'.format(folderpath))
+        filepath = os.path.join(folderpath, entry['path'])
 
         if on_gpu:
-            checkpoint = torch.load(filepath)
+            checkpoint = load_checkpoint(filepath)
         else:
-            checkpoint = torch.load(filepath, map_location=lambda storage, loc: storage)
+            checkpoint = load_checkpoint(filepath, map_location=lambda storage, loc: storage)
 
         # load training state
         self.restore_training_state(checkpoint)
@@ -177,18 +239,62 @@ class TrainerIO(object):
         model.on_hpc_load()
 
     def max_ckpt_in_folder(self, path):
-        files = os.listdir(path)
-        files = [x for x in files if 'ckpt_' in x]
-        if len(files) == 0:
-            return 0
-
-        ckpt_vs = []
-        for name in files:
-            name = name.split('ckpt_')[-1]
-            name = re.sub('[^0-9]', '', name)
-            ckpt_vs.append(int(name))
-
-        return max(ckpt_vs)
+        entry = CheckpointManifest(path).latest()
+        return 0 if entry is None else entry['seq']
+
+
+# torch >= 2.0. Modes only apply to the thread that enters them
+_TorchFunctionMode = getattr(getattr(torch, 'overrides', None), 'TorchFunctionMode', None)
+
+# in-place ops torch.nn.init and reset_parameters() fill the weights with
+_INIT_OPS = {'uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+             'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_',
+             'fill_', 'zero_', 'random_', 'bernoulli_', 'exponential_', 'geometric_', 'log_normal_', 'cauchy_'}
+
+if _TorchFunctionMode is not None:
+    class _SkipParameterInit(_TorchFunctionMode):
+        def __torch_function__(self, func, types, args=(), kwargs=None):
+            kwargs = kwargs or {}
+            target = args[0] if len(args) > 0 else kwargs.get('tensor')
+            if getattr(func, '__name__', None) in _INIT_OPS and isinstance(target, torch.nn.Parameter):
+                return target
+            return func(*args, **kwargs)
+
+
+@contextlib.contextmanager
+def skip_init_weights():
+    """
+    Parameters of the modules built in this context skip their init, leaving them uninitialized
+    (the memory isn't even touched). Only for weights that get overwritten right after by assign_state_dict().
+    Everything else (buffers, other tensors) is built as usual, and other threads aren't affected.
+    Needs torch >= 2.0, older versions initialize the weights as usual
+    :return:
+    """
+    if _TorchFunctionMode is None:
+        yield
+        return
+
+    with _SkipParameterInit():
+        yield
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Load the state dict by making the model use its tensors (ie: memory-mapped ones) instead of copying them.
+    Every parameter and buffer of the model has to be in state_dict since none of them is initialized
+    :param model:
+    :param state_dict:
+    :return:
+    """
+    missing = [k for k in model.state_dict().keys() if k not in state_dict]
+    if len(missing) > 0:
+        raise RuntimeError('Missing key(s) in state_dict: {}'.format(', '.join(missing)))
+
+    # load_state_dict(assign=True) is torch >= 2.1. Before that the weights get copied
+    if 'assign' in inspect.signature(model.load_state_dict).parameters:
+        model.load_state_dict(state_dict, strict=False, assign=True)
+    else:
+        model.load_state_dict(state_dict, strict=False)
 
 
 def load_hparams_from_tags_csv(tags_csv):
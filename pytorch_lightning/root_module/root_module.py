@@ -4,8 +4,10 @@ import math
 
 from pytorch_lightning.root_module.memory import ModelSummary
 from pytorch_lightning.root_module.grads import GradInformation
-from pytorch_lightning.root_module.model_saving import ModelIO, load_hparams_from_tags_csv
+from pytorch_lightning.root_module.model_saving import ModelIO, load_hparams_from_tags_csv, skip_init_weights, \
+    assign_state_dict
 from pytorch_lightning.root_module.hooks import ModelHooks
+from pytorch_lightning.utils.sharded_checkpoint import load_checkpoint, load_weights
 
 
 class LightningModule(GradInformation, ModelIO, ModelHooks):
@@ -50,12 +52,21 @@ class LightningModule(GradInformation, ModelIO, ModelHooks):
 
     def validation_end(self, outputs):
         """
-        Outputs has the appended output after each validation step
+        Outputs has the appended output after each validation step.
+        If validation_accumulators is implemented, outputs is instead a dict with the reduced value of each accumulator
         :param outputs:
         :return: dic_with_metrics for tqdm
         """
         raise NotImplementedError
 
+    def validation_accumulators(self):
+        """
+        Optional. Return a dict of pytorch_lightning.metrics accumulators.
+        Each validation_step output is folded into them as soon as the step finishes instead of being kept in a list
+        :return: dict of name -> Accumulator, or None to keep the list of outputs
+        """
+        return None
+
     def training_step(self, data_batch, batch_nb):
         """
         return loss, dict with metrics for tqdm
@@ -79,6 +90,27 @@ class LightningModule(GradInformation, ModelIO, ModelHooks):
         """
         raise NotImplementedError
 
+    def get_batch_size(self, data_batch):
+        """
+        Number of samples in a batch, used for the samples/sec metric.
+        By default this is the first dim of the first tensor found in the batch. Override for anything else
+        :param data_batch:
+        :return: int or None if it can't be inferred
+        """
+        def infer(x):
+            if isinstance(x, torch.Tensor):
+                return x.size(0) if x.dim() > 0 else 1
+            if isinstance(x, dict):
+                x = list(x.values())
+            if isinstance(x, (list, tuple)):
+                for item in x:
+                    size = infer(item)
+                    if size is not None:
+                        return size
+            return None
+
+        return infer(data_batch)
+
     def summarize(self):
         model_summary = ModelSummary(self)
         print(model_summary)
@@ -116,25 +148,31 @@ class LightningModule(GradInformation, ModelIO, ModelHooks):
         raise NotImplementedError
 
     @classmethod
-    def load_from_metrics(cls, weights_path, tags_csv, on_gpu, map_location=None):
+    def load_from_metrics(cls, weights_path, tags_csv, on_gpu, map_location=None, mmap=False):
         """
         Primary way of loading model from csv weights path
         :param weights_path:
         :param tags_csv:
         :param on_gpu:
         :param map_location: dic for mapping storage {'cuda:1':'cuda:0'}
+        :param mmap: memory-map the weights instead of reading the checkpoint (ie: for inference on large models).
+            The optimizer states are skipped, the model isn't randomly initialized first and its weights use the
+            mapped file directly (on the cpu), so they're only read from disk when used
         :return:
         """
         hparams = load_hparams_from_tags_csv(tags_csv)
         hparams.__setattr__('on_gpu', on_gpu)
 
+        if mmap:
+            return cls.__load_mapped(hparams, weights_path)
+
         if on_gpu:
             if map_location is not None:
-                checkpoint = torch.load(weights_path, map_location=map_location)
+                checkpoint = load_checkpoint(weights_path, map_location=map_location)
             else:
-                checkpoint = torch.load(weights_path)
+                checkpoint = load_checkpoint(weights_path)
         else:
-            checkpoint = torch.load(weights_path, map_location=lambda storage, loc: storage)
+            checkpoint = load_checkpoint(weights_path, map_location=lambda storage, loc: storage)
 
         model = cls(hparams)
 
@@ -142,3 +180,16 @@ class LightningModule(GradInformation, ModelIO, ModelHooks):
         model.load_model_specific(checkpoint)
         model.load_state_dict(checkpoint['state_dict'], strict=False)
         return model
+
+    @classmethod
+    def __load_mapped(cls, hparams, weights_path):
+        state_dict = load_weights(weights_path)
+
+        # every weight gets replaced, so don't spend time and memory on the init
+        with skip_init_weights():
+            model = cls(hparams)
+        assign_state_dict(model, state_dict)
+
+        # the weights are already in place, so a load_state_dict in the hook doesn't copy anything
+        model.load_model_specific({'state_dict': state_dict})
+        return model
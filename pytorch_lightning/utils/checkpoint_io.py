@@ -0,0 +1,345 @@
+import collections
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+"""
+Checkpoint writing helpers: atomic saves and a background writer so training doesn't wait on storage
+"""
+
+
+def snapshot_to_host(obj):
+    """
+    Recursively copy every tensor to host memory, so the copy no longer shares storage with the live
+    parameters and optimizer state
+    :param obj: checkpoint dict (or any nesting of dicts, lists, tuples and tensors)
+    :return:
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_host(v)) for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_host(x) for x in obj)
+
+    return obj
+
+
+# placeholder left in a checkpoint dict where a tensor was taken out (ie: written to a shard)
+_TENSOR_REF_KEY = '__sharded_tensor__'
+
+
+def _dtype_name(dtype):
+    # 'torch.float32' -> 'float32'
+    return str(dtype).split('.')[-1]
+
+
+def _is_plain_tensor(obj):
+    # sparse and quantized tensors have no flat byte layout, those stay in the skeleton
+    return isinstance(obj, torch.Tensor) and obj.layout == torch.strided and not obj.is_quantized
+
+
+def _split_tensors(obj, path, tensors):
+    """
+    Replace every tensor with a reference, collecting (path, tensor) in tensors
+    :return: the skeleton
+    """
+    if _is_plain_tensor(obj):
+        tensors.append((path, obj))
+        return {_TENSOR_REF_KEY: len(tensors) - 1}
+
+    if isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, path + [k], tensors)) for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(x, path + [i], tensors) for i, x in enumerate(obj))
+
+    return obj
+
+
+def _fill_tensors(obj, load_tensor):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and _TENSOR_REF_KEY in obj:
+            return load_tensor(obj[_TENSOR_REF_KEY])
+        return type(obj)((k, _fill_tensors(v, load_tensor)) for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_fill_tensors(x, load_tensor) for x in obj)
+
+    return obj
+
+
+def _target_device(saved_device, map_location):
+    """
+    Device a tensor saved from saved_device is loaded on
+    :param saved_device: name of the device it was saved from
+    :param map_location: None (same device), a device (or device name) or a dict mapping saved devices to new ones
+    :return:
+    """
+    if isinstance(map_location, dict):
+        # {'cuda:1': 'cuda:0'}
+        device = torch.device(map_location.get(saved_device, saved_device))
+    elif map_location is not None:
+        return torch.device(map_location)
+    else:
+        device = torch.device(saved_device)
+
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        return torch.device('cpu')
+    return device
+
+
+def _fsync_dir(dirpath):
+    # makes the rename itself durable. Not every platform/filesystem allows opening a directory
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(filepath, write_function):
+    """
+    Write to a temp file in the same folder, fsync, then rename over filepath.
+    Readers see either the previous file or the complete new one, never a partial write
+    :param filepath:
+    :param write_function: called with the open (binary) temp file
+    :return: whatever write_function returned
+    """
+    dirpath = os.path.dirname(os.path.abspath(filepath))
+    tmp_path = '{}.tmp'.format(filepath)
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            result = write_function(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    _fsync_dir(dirpath)
+    return result
+
+
+def atomic_save(checkpoint, filepath):
+    """
+    torch.save the checkpoint with atomic_write
+    :param checkpoint:
+    :param filepath:
+    :return:
+    """
+    atomic_write(filepath, lambda f: torch.save(checkpoint, f))
+
+
+def remove_checkpoint(filepath):
+    """
+    Delete a checkpoint file (or checkpoint folder). Missing paths are ignored
+    :param filepath:
+    :return:
+    """
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    elif os.path.exists(filepath):
+        os.remove(filepath)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread, in the order they were submitted.
+    submit() copies the checkpoint to host memory first, so training can keep updating the weights.
+    At most `max_in_flight` snapshots are held in memory; submitting more waits for the oldest one to be written.
+    """
+
+    def __init__(self, max_in_flight=2):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be >= 1, got {}'.format(max_in_flight))
+
+        self.max_in_flight = max_in_flight
+        self.pending = collections.deque()
+
+        # created on first use so the trainer stays picklable (ie: for ddp spawn)
+        self.executor = None
+
+    def __wait_oldest(self):
+        future = self.pending.popleft()
+
+        # raises whatever the write raised
+        future.result()
+
+    def submit(self, checkpoint, filepath, save_function=atomic_save):
+        """
+        Snapshot the checkpoint and queue the write
+        :param checkpoint: dict from dump_checkpoint()
+        :param filepath:
+        :param save_function: called with (checkpoint, filepath) in the writer thread
+        :return:
+        """
+        # surface errors from finished writes right away
+        while len(self.pending) > 0 and self.pending[0].done():
+            self.__wait_oldest()
+
+        while len(self.pending) >= self.max_in_flight:
+            self.__wait_oldest()
+
+        self.run(save_function, snapshot_to_host(checkpoint), filepath)
+
+    def run(self, fn, *args):
+        """
+        Run fn(*args) in the writer thread once every write queued before it is done (ie: deleting a checkpoint)
+        :return:
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending.append(self.executor.submit(fn, *args))
+
+    @property
+    def nb_in_flight(self):
+        return len([f for f in self.pending if not f.done()])
+
+    def flush(self):
+        """
+        Wait until everything queued is on disk
+        :return:
+        """
+        while len(self.pending) > 0:
+            self.__wait_oldest()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+class CheckpointManifest(object):
+    """
+    Append-only index of the numbered checkpoints in a folder (ie: hpc_ckpt_3.ckpt), one json line each:
+    {"seq": 3, "path": "hpc_ckpt_3.ckpt", "size": 1234, "step": 500}
+    The latest checkpoint is read from the end of the manifest, so finding it doesn't list the folder.
+    A missing or unreadable manifest is rebuilt once by scanning the folder.
+    """
+
+    def __init__(self, folderpath, prefix='hpc_ckpt'):
+        self.folderpath = folderpath
+        self.prefix = prefix
+
+        # exact match, so other checkpoints in the same folder (ie: _ckpt_epoch_3.ckpt) are ignored
+        self.pattern = re.compile(r'^{}_(\d+)\.ckpt$'.format(re.escape(prefix)))
+
+    @property
+    def path(self):
+        return os.path.join(self.folderpath, '{}_manifest.jsonl'.format(self.prefix))
+
+    def checkpoint_path(self, seq):
+        return os.path.join(self.folderpath, '{}_{}.ckpt'.format(self.prefix, seq))
+
+    def __read_last_line(self, chunk_size=4096):
+        # only reads the tail of the file, growing the window until it holds a whole line
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            while True:
+                read_size = min(chunk_size, file_size)
+                f.seek(file_size - read_size)
+                lines = f.read(read_size).rstrip(b'\n').split(b'\n')
+                if len(lines) > 1 or read_size == file_size:
+                    return lines[-1].decode('utf-8')
+                chunk_size *= 2
+
+    def __read_latest(self):
+        """
+        :return: (is_valid, latest entry or None)
+        """
+        try:
+            line = self.__read_last_line()
+        except (IOError, OSError):
+            return False, None
+
+        if line == '':
+            return True, None
+
+        try:
+            entry = json.loads(line)
+            entry = {'seq': int(entry['seq']), 'path': entry['path'],
+                     'size': entry.get('size'), 'step': entry.get('step')}
+        except (ValueError, TypeError, KeyError):
+            return False, None
+
+        # the checkpoint it points to must still be there
+        is_valid = os.path.exists(os.path.join(self.folderpath, entry['path']))
+        return is_valid, entry
+
+    def latest(self):
+        """
+        Entry of the most recent checkpoint
+        :return: dict with seq, path (relative to the folder), size and step. None when there is no checkpoint
+        """
+        is_valid, entry = self.__read_latest()
+        if not is_valid:
+            entry = self.rebuild()
+        return entry
+
+    def next_seq(self):
+        entry = self.latest()
+        return 1 if entry is None else entry['seq'] + 1
+
+    def append(self, filepath, step=None):
+        """
+        Record a checkpoint that is already on disk
+        :param filepath: path of the checkpoint, named with checkpoint_path()
+        :param step: global step the checkpoint was taken at
+        :return: the new entry
+        """
+        name = os.path.basename(filepath)
+        match = self.pattern.match(name)
+        if match is None:
+            raise ValueError('{} is not named like {}'.format(name, self.checkpoint_path('<seq>')))
+
+        entry = {'seq': int(match.group(1)), 'path': name, 'size': os.path.getsize(filepath), 'step': step}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    def rebuild(self):
+        """
+        Recreate the manifest from the checkpoints in the folder. Steps of scanned checkpoints are unknown (None)
+        :return: the latest entry or None
+        """
+        if not os.path.isdir(self.folderpath):
+            return None
+
+        entries = []
+        for name in os.listdir(self.folderpath):
+            match = self.pattern.match(name)
+            if match is not None:
+                size = os.path.getsize(os.path.join(self.folderpath, name))
+                entries.append({'seq': int(match.group(1)), 'path': name, 'size': size, 'step': None})
+        entries.sort(key=lambda x: x['seq'])
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        return entries[-1] if len(entries) > 0 else None
@@ -0,0 +1,248 @@
+import bz2
+import collections
+import io
+import json
+import lzma
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from pytorch_lightning.utils.checkpoint_io import atomic_write, _split_tensors, _fill_tensors, _dtype_name, \
+    _target_device
+
+"""
+Single file checkpoint with every tensor compressed by a stdlib codec. Tensors are cut in chunks that are
+compressed (and decompressed) in parallel by a thread pool; zlib, bz2 and lzma release the GIL while they work.
+
+    MAGIC | compressed chunks ... | compressed skeleton | index (json) | index offset (uint64) | MAGIC
+
+The skeleton is the checkpoint dict with each tensor replaced by a reference into the index
+"""
+
+MAGIC = b'PLZCKPT1'
+FORMAT_VERSION = 1
+_FOOTER = struct.Struct('<Q')
+_MB = 1024 * 1024
+
+
+def _compressor(codec, level):
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, 6 if level is None else level)
+    if codec == 'bz2':
+        return lambda data: bz2.compress(data, 9 if level is None else level)
+    if codec == 'lzma':
+        return lambda data: lzma.compress(data, preset=level)
+    raise ValueError("codec has to be 'zlib', 'bz2' or 'lzma', got {}".format(codec))
+
+
+_DECOMPRESSORS = {
+    'zlib': zlib.decompress,
+    'bz2': bz2.decompress,
+    'lzma': lzma.decompress,
+}
+
+CODECS = tuple(_DECOMPRESSORS.keys())
+
+
+def _ordered_map(executor, fn, items, window):
+    # like executor.map, but holds at most `window` results in memory
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def is_compressed_checkpoint(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_compressed_checkpoint(checkpoint, filepath, codec='zlib', level=None, chunk_size=4 * _MB, nb_workers=4):
+    """
+    Compress every tensor of the checkpoint in parallel and write them (atomically) to a single file
+    :param checkpoint: dict from dump_checkpoint()
+    :param filepath:
+    :param codec: 'zlib', 'bz2' or 'lzma'
+    :param level: compression level of the codec (None for its default)
+    :param chunk_size: tensors are compressed in chunks of this many bytes
+    :param nb_workers: compression threads
+    :return: dict with the raw size, the compression ratio and the write throughput
+    """
+    compress = _compressor(codec, level)
+    start = time.time()
+
+    tensors = []
+    skeleton = _split_tensors(checkpoint, [], tensors)
+
+    index, chunks = [], []
+    for i, (path, original) in enumerate(tensors):
+        tensor = original.detach().to('cpu').contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        index.append({
+            'path': path,
+            'dtype': _dtype_name(tensor.dtype),
+            'shape': list(tensor.shape),
+            'device': str(original.device),
+            'nbytes': nbytes,
+            'chunks': [],
+        })
+
+        # memoryviews of the tensor, nothing is copied before compressing
+        data = memoryview(tensor.reshape(-1).view(torch.uint8).numpy()) if nbytes > 0 else memoryview(b'')
+        for offset in range(0, nbytes, chunk_size):
+            chunks.append((i, data[offset:offset + chunk_size]))
+
+    buffer = io.BytesIO()
+    torch.save(skeleton, buffer)
+    skeleton_bytes = buffer.getvalue()
+    raw_bytes = sum(entry['nbytes'] for entry in index) + len(skeleton_bytes)
+
+    def write(f):
+        f.write(MAGIC)
+        with ThreadPoolExecutor(max_workers=max(1, nb_workers)) as executor:
+            compressed_chunks = _ordered_map(executor, lambda chunk: (chunk[0], len(chunk[1]), compress(chunk[1])),
+                                             chunks, window=2 * max(1, nb_workers))
+            for i, raw_size, compressed in compressed_chunks:
+                index[i]['chunks'].append([f.tell(), len(compressed), raw_size])
+                f.write(compressed)
+
+        compressed = compress(skeleton_bytes)
+        skeleton_entry = [f.tell(), len(compressed), len(skeleton_bytes)]
+        f.write(compressed)
+
+        index_offset = f.tell()
+        metadata = {'version': FORMAT_VERSION, 'codec': codec, 'skeleton': skeleton_entry, 'tensors': index}
+        f.write(json.dumps(metadata).encode('utf-8'))
+        f.write(_FOOTER.pack(index_offset))
+        f.write(MAGIC)
+        return f.tell()
+
+    file_size = atomic_write(filepath, write)
+
+    seconds = max(time.time() - start, 1e-9)
+    return {
+        'ckpt_raw_mb': raw_bytes / _MB,
+        'ckpt_compression_ratio': raw_bytes / float(file_size),
+        'ckpt_write_mb_per_s': raw_bytes / _MB / seconds,
+    }
+
+
+class CompressedCheckpoint(object):
+    """
+    Reads a checkpoint written by save_compressed_checkpoint, one chunk at a time.
+    Chunks are decompressed in parallel, and only the tensors asked for are read
+    """
+
+    def __init__(self, filepath, map_location=None, nb_workers=4):
+        """
+        :param filepath:
+        :param map_location: device (or device name) for every tensor, or a dict mapping saved devices to new ones.
+            None puts each one back on the device it was saved from
+        :param nb_workers: decompression threads
+        """
+        self.filepath = filepath
+        self.map_location = map_location
+        self.nb_workers = max(1, nb_workers)
+
+        with open(filepath, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a compressed checkpoint'.format(filepath))
+
+            f.seek(-(_FOOTER.size + len(MAGIC)), os.SEEK_END)
+            footer = f.read(_FOOTER.size + len(MAGIC))
+            if footer[_FOOTER.size:] != MAGIC:
+                raise ValueError('{} is truncated'.format(filepath))
+
+            index_offset = _FOOTER.unpack(footer[:_FOOTER.size])[0]
+            f.seek(index_offset)
+            index_size = os.path.getsize(filepath) - index_offset - len(footer)
+            self.metadata = json.loads(f.read(index_size).decode('utf-8'))
+
+        if self.metadata['version'] > FORMAT_VERSION:
+            raise ValueError('{} was written by a newer version (format {})'.format(filepath, self.metadata['version']))
+
+        self.index = self.metadata['tensors']
+        self.decompress = _DECOMPRESSORS[self.metadata['codec']]
+
+    def __read_chunks(self, f, chunks):
+        # chunked reads, decompressed in the background while the next chunks are read
+        def read():
+            for offset, size, raw_size in chunks:
+                f.seek(offset)
+                yield f.read(size), raw_size
+
+        def decompress(chunk):
+            data = self.decompress(chunk[0])
+            if len(data) != chunk[1]:
+                raise ValueError('{} is corrupted'.format(self.filepath))
+            return data
+
+        with ThreadPoolExecutor(max_workers=self.nb_workers) as executor:
+            for data in _ordered_map(executor, decompress, read(), window=2 * self.nb_workers):
+                yield data
+
+    def tensors(self, indices):
+        """
+        :param indices: positions in the index
+        :return: {position: tensor}
+        """
+        indices = list(indices)
+        chunks = [chunk for i in indices for chunk in self.index[i]['chunks']]
+
+        buffers = {i: np.empty(self.index[i]['nbytes'], dtype=np.uint8) for i in indices}
+        targets = [(i, start) for i in indices for start in self.__chunk_starts(self.index[i])]
+
+        with open(self.filepath, 'rb') as f:
+            for (i, start), data in zip(targets, self.__read_chunks(f, chunks)):
+                buffers[i][start:start + len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+        tensors = {}
+        for i in indices:
+            entry = self.index[i]
+            dtype = getattr(torch, entry['dtype'])
+            if entry['nbytes'] == 0:
+                tensor = torch.empty(entry['shape'], dtype=dtype)
+            else:
+                tensor = torch.from_numpy(buffers[i]).view(dtype).reshape(entry['shape'])
+            tensors[i] = tensor.to(_target_device(entry['device'], self.map_location))
+        return tensors
+
+    @staticmethod
+    def __chunk_starts(entry):
+        start = 0
+        for _, _, raw_size in entry['chunks']:
+            yield start
+            start += raw_size
+
+    def skeleton(self):
+        with open(self.filepath, 'rb') as f:
+            data = b''.join(self.__read_chunks(f, [self.metadata['skeleton']]))
+        return torch.load(io.BytesIO(data))
+
+    def state_dict(self):
+        """
+        Model weights only. The other tensors aren't read
+        :return:
+        """
+        indices = [i for i, entry in enumerate(self.index) if len(entry['path']) == 2
+                   and entry['path'][0] == 'state_dict']
+        tensors = self.tensors(indices)
+        return collections.OrderedDict((str(self.index[i]['path'][1]), tensors[i]) for i in indices)
+
+    def load(self):
+        """
+        The whole checkpoint, as torch.load would return it for a regular checkpoint
+        :return:
+        """
+        tensors = self.tensors(range(len(self.index)))
+        return _fill_tensors(self.skeleton(), lambda i: tensors[i])
@@ -0,0 +1,120 @@
+import collections
+import hashlib
+import os
+
+import torch
+
+"""
+Frozen weights (requires_grad=False, ie: a pretrained backbone) are the same in every checkpoint.
+They're written once to a content addressed base file next to the checkpoints, and each checkpoint only keeps
+a reference to it:
+
+    checkpoint['frozen_base'] = {'path': 'frozen_<hash>.pt', 'hash': <hash>, 'keys': [...], 'order': [...]}
+"""
+
+FROZEN_BASE_KEY = 'frozen_base'
+
+
+def _tensor_digest(name, tensor):
+    digest = hashlib.sha256()
+    digest.update('{}|{}|{}'.format(name, tensor.dtype, tuple(tensor.shape)).encode('utf-8'))
+    data = tensor.detach().to('cpu').contiguous().reshape(-1)
+    if data.numel() > 0:
+        digest.update(memoryview(data.view(torch.uint8).numpy()))
+    return digest.hexdigest()
+
+
+class FrozenWeightsBase(object):
+    """
+    Moves the frozen weights of a checkpoint into a base file, written only when its content changes
+    """
+
+    def __init__(self):
+        # name -> ((data_ptr, version), digest). A tensor that wasn't modified isn't read again
+        self.digests = {}
+
+        # bases already handed out to be written (maybe not on disk yet with async checkpointing)
+        self.written = set()
+
+    def __digest(self, name, tensor):
+        key = (tensor.data_ptr(), tensor._version, tensor.dtype, tuple(tensor.shape))
+        cached = self.digests.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, _tensor_digest(name, tensor))
+            self.digests[name] = cached
+        return cached[1]
+
+    def split(self, checkpoint, model, dirpath):
+        """
+        Take the frozen parameters of model out of checkpoint['state_dict']
+        :param checkpoint: dict from dump_checkpoint()
+        :param model: model the state_dict came from
+        :param dirpath: folder of the checkpoint, where the base goes
+        :return: (checkpoint, base filepath, base checkpoint to write or None when it's already on disk)
+        """
+        state_dict = checkpoint.get('state_dict')
+        frozen = [name for name, p in model.named_parameters() if not p.requires_grad]
+        frozen = [name for name in frozen if state_dict is not None and name in state_dict]
+        if len(frozen) == 0:
+            return checkpoint, None, None
+
+        base_hash = hashlib.sha256()
+        for name in frozen:
+            base_hash.update(self.__digest(name, state_dict[name]).encode('utf-8'))
+        base_hash = base_hash.hexdigest()
+
+        base_name = 'frozen_{}.pt'.format(base_hash[:16])
+        base_path = os.path.join(dirpath, base_name)
+
+        frozen_set = set(frozen)
+        checkpoint = dict(checkpoint)
+        checkpoint['state_dict'] = collections.OrderedDict(
+            (k, v) for k, v in state_dict.items() if k not in frozen_set)
+        checkpoint[FROZEN_BASE_KEY] = {
+            'path': base_name,
+            'hash': base_hash,
+            'keys': frozen,
+            'order': list(state_dict.keys()),
+        }
+
+        base = None
+        if base_path not in self.written and not os.path.exists(base_path):
+            self.written.add(base_path)
+            base = {'hash': base_hash, 'state_dict': collections.OrderedDict((k, state_dict[k]) for k in frozen)}
+        return checkpoint, base_path, base
+
+
+def merge_frozen_base(checkpoint, dirpath, map_location=None, mmap=False):
+    """
+    Put the frozen weights back into checkpoint['state_dict'], in their original order.
+    Checkpoints without a base are returned as they are
+    :param checkpoint: loaded checkpoint
+    :param dirpath: folder of the checkpoint
+    :param map_location: same as torch.load
+    :param mmap: memory-map the base when torch supports it (torch >= 2.1). Older versions read it
+    :return:
+    """
+    info = checkpoint.get(FROZEN_BASE_KEY)
+    if info is None:
+        return checkpoint
+
+    base_path = os.path.join(dirpath, info['path'])
+    base = None
+    if mmap:
+        try:
+            base = torch.load(base_path, map_location=map_location, mmap=True)
+        except (TypeError, RuntimeError):
+            # no mmap argument, or a legacy (non zipfile) base that can't be mapped
+            pass
+    if base is None:
+        base = torch.load(base_path, map_location=map_location)
+    if base['hash'] != info['hash']:
+        raise ValueError('{} has hash {}, the checkpoint expects {}'.format(base_path, base['hash'], info['hash']))
+
+    frozen = base['state_dict']
+    state_dict = checkpoint['state_dict']
+    checkpoint = dict(checkpoint)
+    checkpoint['state_dict'] = collections.OrderedDict(
+        (k, frozen[k] if k in frozen else state_dict[k]) for k in info['order'])
+    del checkpoint[FROZEN_BASE_KEY]
+    return checkpoint
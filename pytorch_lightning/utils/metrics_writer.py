@@ -0,0 +1,148 @@
+import csv
+import io
+import json
+import queue
+import threading
+import time
+import warnings
+
+from pytorch_lightning.utils.checkpoint_io import atomic_write
+
+"""
+Appends metric rows to a json lines file from a background thread so logging never waits on the filesystem
+"""
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+def _to_json(value):
+    # numpy scalars and 0-dim tensors
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _to_csv(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+class MetricsWriter(object):
+    """
+    write() only puts the row on a queue. A background thread batches the rows and appends them to `path`
+    (one json dict per line) every `flush_interval` seconds, when flush() is called and on close().
+    With `csv_path`, the thread also rewrites every row so far to that csv file, at most every `flush_interval`
+    seconds and on close()
+    """
+
+    def __init__(self, path, flush_interval=10.0, csv_path=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.nb_rows_written = 0
+
+        # only touched by the thread
+        self.csv_path = csv_path
+        self.csv_rows = []
+        self.csv_columns = {}
+
+        # opened once up front so a bad path fails here and not in the thread
+        self.file = open(path, 'a')
+        self.rows = queue.Queue()
+        self.worker = threading.Thread(target=self.__worker, daemon=True)
+        self.worker.start()
+
+    def write(self, row):
+        """
+        Queue one row. Never blocks
+        :param row: dict of json serializable scalars
+        :return:
+        """
+        if self.worker is None:
+            raise ValueError('MetricsWriter for {} is closed'.format(self.path))
+        self.rows.put(dict(row))
+
+    def flush(self):
+        """
+        Ask the writer to write out what it has so far. Doesn't wait for it
+        :return:
+        """
+        if self.worker is not None:
+            self.rows.put(_FLUSH)
+
+    def close(self):
+        """
+        Write out everything still queued and stop the thread
+        :return:
+        """
+        if self.worker is None:
+            return
+
+        self.rows.put(_CLOSE)
+        self.worker.join()
+        self.worker = None
+
+    def __append(self, f, pending):
+        if len(pending) == 0:
+            return
+
+        try:
+            f.write(''.join(json.dumps(row, default=_to_json) + '\n' for row in pending))
+            f.flush()
+            self.nb_rows_written += len(pending)
+        except Exception as e:
+            warnings.warn('could not write {} metric rows to {}: {}'.format(len(pending), self.path, e))
+
+        if self.csv_path is not None:
+            self.csv_rows.extend(pending)
+            for row in pending:
+                self.csv_columns.update((k, None) for k in row)
+
+        del pending[:]
+
+    def __write_csv(self):
+        if self.csv_path is None or len(self.csv_rows) == 0:
+            return
+
+        def write(f):
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            writer = csv.DictWriter(text, fieldnames=list(self.csv_columns), restval='')
+            writer.writeheader()
+            writer.writerows({k: _to_csv(v) for k, v in row.items()} for row in self.csv_rows)
+            text.flush()
+            text.detach()
+
+        try:
+            atomic_write(self.csv_path, write)
+        except Exception as e:
+            warnings.warn('could not write the metrics to {}: {}'.format(self.csv_path, e))
+
+    def __worker(self):
+        pending = []
+        with self.file as f:
+            last_flush = time.monotonic()
+            last_csv_write = last_flush
+            while True:
+                timeout = max(0., last_flush + self.flush_interval - time.monotonic())
+                try:
+                    item = self.rows.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _CLOSE:
+                    self.__append(f, pending)
+                    self.__write_csv()
+                    return
+
+                if item is not None and item is not _FLUSH:
+                    pending.append(item)
+
+                if item is _FLUSH or time.monotonic() >= last_flush + self.flush_interval:
+                    self.__append(f, pending)
+                    last_flush = time.monotonic()
+
+                # rewriting the csv costs more, so it's done at most every flush_interval
+                if time.monotonic() >= last_csv_write + self.flush_interval:
+                    self.__write_csv()
+                    last_csv_write = time.monotonic()
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+
+import torch
+
+"""
+Loads batches in a background thread so data loading overlaps with compute
+"""
+
+
+def transfer_batch_to_device(batch, device):
+    """
+    Recursively pin and copy every tensor in a batch to the device
+    :param batch: tensor or (nested) list, tuple, dict of tensors
+    :param device: torch.device. When None (or cpu) the batch is returned unchanged
+    :return:
+    """
+    if device is None or device.type == 'cpu':
+        return batch
+
+    if isinstance(batch, torch.Tensor):
+        # pinned memory lets the copy run asynchronously
+        return batch.pin_memory().to(device, non_blocking=True)
+
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(transfer_batch_to_device(x, device) for x in batch)
+
+    if isinstance(batch, dict):
+        return type(batch)((k, transfer_batch_to_device(v, device)) for k, v in batch.items())
+
+    return batch
+
+
+class _ExceptionWrapper(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END_OF_DATA = object()
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a dataloader and keeps the next `nb_batches` batches ready in a background thread.
+    Anything not defined here (dataset, sampler, batch_size...) is forwarded to the wrapped dataloader.
+    """
+
+    def __init__(self, dataloader, nb_batches=2, device=None):
+        if nb_batches < 1:
+            raise ValueError('nb_batches must be >= 1, got {}'.format(nb_batches))
+
+        self.dataloader = dataloader
+        self.nb_batches = nb_batches
+        self.device = device
+
+        # seconds the consumer spent blocked waiting for a batch
+        self.wait_time = 0.0
+        self.nb_fetched = 0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails
+        if name == 'dataloader':
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+    @property
+    def avg_wait_time(self):
+        if self.nb_fetched == 0:
+            return 0.0
+        return self.wait_time / self.nb_fetched
+
+    def reset_stats(self):
+        self.wait_time = 0.0
+        self.nb_fetched = 0
+
+    def __worker(self, batches, stop_event):
+        def put(item):
+            # give up when the consumer stops early
+            while not stop_event.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.dataloader:
+                batch = transfer_batch_to_device(batch, self.device)
+                if not put(batch):
+                    return
+        except Exception as e:
+            put(_ExceptionWrapper(e))
+            return
+
+        put(_END_OF_DATA)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.nb_batches)
+        stop_event = threading.Event()
+        worker = threading.Thread(target=self.__worker, args=(batches, stop_event), daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = batches.get()
+                self.wait_time += time.perf_counter() - start
+
+                if batch is _END_OF_DATA:
+                    return
+
+                if isinstance(batch, _ExceptionWrapper):
+                    raise batch.exception
+
+                self.nb_fetched += 1
+                yield batch
+        finally:
+            # runs when the loop finishes or breaks early
+            stop_event.set()
+            worker.join()
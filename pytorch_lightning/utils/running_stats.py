@@ -0,0 +1,140 @@
+import math
+
+import torch
+
+"""
+Fixed-size trackers for values that get logged during training
+"""
+
+
+class TensorRunningMean(object):
+    """
+    Ring buffer holding the last `window_length` scalar tensors with an O(1) windowed mean.
+    nan and inf values are counted apart from the sum of the finite ones, so the mean recovers once they leave
+    the window. The sum is recomputed from the buffer once per wrap so float errors don't build up.
+
+    Values never leave the device they were created on. Call .item() on the result of mean()
+    to sync with the host.
+    """
+
+    def __init__(self, window_length=100):
+        if window_length < 1:
+            raise ValueError('window_length must be >= 1, got {}'.format(window_length))
+
+        self.window_length = window_length
+        self.reset()
+
+    def reset(self):
+        self.memory = None
+        self.finite_total = None
+        # number of nan, inf and -inf values in the window
+        self.nonfinite_counts = None
+        self.nonfinite_values = None
+        self.current_idx = 0
+        self.nb_values = 0
+
+    def append(self, x):
+        x = x.detach().reshape(())
+
+        # allocate lazily so the buffer lives on the same device / dtype as the values
+        if self.memory is None:
+            self.memory = torch.zeros(self.window_length, dtype=x.dtype, device=x.device)
+            self.finite_total = torch.zeros((), dtype=x.dtype, device=x.device)
+            self.nonfinite_counts = torch.zeros(3, dtype=torch.long, device=x.device)
+            self.nonfinite_values = torch.tensor([float('nan'), float('inf'), -float('inf')],
+                                                 dtype=x.dtype, device=x.device)
+
+        # replace the oldest value and update the sum incrementally
+        evicted = self.memory[self.current_idx]
+        self.finite_total += _finite(x) - _finite(evicted)
+        self.nonfinite_counts += _nonfinite_flags(x) - _nonfinite_flags(evicted)
+        self.memory[self.current_idx] = x
+
+        self.current_idx = (self.current_idx + 1) % self.window_length
+        self.nb_values = min(self.nb_values + 1, self.window_length)
+
+        # once per wrap, so amortized O(1)
+        if self.current_idx == 0:
+            self.finite_total = _finite(self.memory).sum()
+
+    def last(self):
+        if self.nb_values == 0:
+            return None
+        return self.memory[self.current_idx - 1]
+
+    @property
+    def total(self):
+        if self.nb_values == 0:
+            return None
+
+        # nan if there's a nan (or both inf and -inf), +-inf if there's an inf, like summing the window would give
+        present = self.nonfinite_counts > 0
+        nonfinite = torch.where(present, self.nonfinite_values, torch.zeros_like(self.nonfinite_values))
+        return self.finite_total + nonfinite.sum()
+
+    def mean(self):
+        if self.nb_values == 0:
+            return None
+        return self.total / self.nb_values
+
+    def __len__(self):
+        return self.nb_values
+
+
+def _finite(x):
+    return torch.where(torch.isfinite(x), x, torch.zeros_like(x))
+
+
+def _nonfinite_flags(x):
+    return torch.stack([torch.isnan(x), x == float('inf'), x == -float('inf')]).long()
+
+
+class RunningMean(object):
+    """
+    Host side counterpart of TensorRunningMean for plain python floats (ie: timings)
+    """
+
+    def __init__(self, window_length=100):
+        if window_length < 1:
+            raise ValueError('window_length must be >= 1, got {}'.format(window_length))
+
+        self.window_length = window_length
+        self.reset()
+
+    def reset(self):
+        self.memory = [0.0] * self.window_length
+        self.finite_total = 0.0
+        self.nb_nonfinite = 0
+        self.current_idx = 0
+        self.nb_values = 0
+
+    def append(self, x):
+        evicted = self.memory[self.current_idx]
+        for value, sign in ((x, 1), (evicted, -1)):
+            if math.isfinite(value):
+                self.finite_total += sign * value
+            else:
+                self.nb_nonfinite += sign
+        self.memory[self.current_idx] = x
+
+        self.current_idx = (self.current_idx + 1) % self.window_length
+        self.nb_values = min(self.nb_values + 1, self.window_length)
+
+        # once per wrap, so amortized O(1)
+        if self.current_idx == 0:
+            self.finite_total = sum(v for v in self.memory if math.isfinite(v))
+
+    @property
+    def total(self):
+        # only sums the window while there's a nan or inf in it
+        if self.nb_nonfinite > 0:
+            return sum(self.memory[:self.nb_values])
+        return self.finite_total
+
+    def mean(self):
+        if self.nb_values == 0:
+            return None
+        return self.total / self.nb_values
+
+    def __len__(self):
+        return self.nb_values
@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from pytorch_lightning.utils.checkpoint_io import _fsync_dir, _split_tensors, _fill_tensors, _dtype_name, \
+    _target_device
+from pytorch_lightning.utils.frozen_weights import merge_frozen_base, FROZEN_BASE_KEY
+from pytorch_lightning.utils.compressed_checkpoint import is_compressed_checkpoint, CompressedCheckpoint
+
+"""
+Directory checkpoint format. Every tensor is stored as raw bytes in a flat shard file, at an offset listed in
+metadata.json, so any tensor can be memory-mapped and loaded on its own:
+
+    epoch_3.ckpt/
+        metadata.json   version, and dtype/shape/shard/offset of every tensor
+        skeleton.pt     the checkpoint dict with each tensor replaced by a reference into metadata.json
+        shard_0.bin
+        shard_1.bin
+"""
+
+FORMAT_VERSION = 1
+METADATA_NAME = 'metadata.json'
+SKELETON_NAME = 'skeleton.pt'
+
+# tensors start at a multiple of this, so a mapped shard can be viewed as any dtype
+_ALIGNMENT = 64
+
+
+def is_sharded_checkpoint(path):
+    return os.path.isfile(os.path.join(path, METADATA_NAME))
+
+
+def _shard_name(shard):
+    return 'shard_{}.bin'.format(shard)
+
+
+def _write_shard(filepath, tensors):
+    with open(filepath, 'wb') as f:
+        for offset, tensor in tensors:
+            f.seek(offset)
+            f.write(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_sharded_checkpoint(checkpoint, dirpath, shard_size=256 * 1024 * 1024, nb_workers=4):
+    """
+    Write the checkpoint as a directory of flat tensor shards. The shards are written in parallel.
+    Like atomic_save, everything goes to a temp folder that is renamed into place at the end
+    :param checkpoint: dict from dump_checkpoint()
+    :param dirpath:
+    :param shard_size: a new shard is started once a shard holds this many bytes
+    :param nb_workers: threads writing shards
+    :return:
+    """
+    tensors = []
+    skeleton = _split_tensors(checkpoint, [], tensors)
+
+    # lay the tensors out in shards
+    index, shards = [], []
+    shard_bytes = shard_size
+    for path, original in tensors:
+        tensor = original.detach().to('cpu').contiguous()
+        if shard_bytes >= shard_size:
+            shards.append([])
+            shard_bytes = 0
+
+        offset = -(-shard_bytes // _ALIGNMENT) * _ALIGNMENT
+        nbytes = tensor.numel() * tensor.element_size()
+        shards[-1].append((offset, tensor))
+        shard_bytes = offset + nbytes
+
+        index.append({
+            'path': path,
+            'dtype': _dtype_name(tensor.dtype),
+            'shape': list(tensor.shape),
+            'device': str(original.device),
+            'shard': len(shards) - 1,
+            'offset': offset,
+            'nbytes': nbytes,
+        })
+
+    tmp_path = '{}.tmp'.format(dirpath)
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(nb_workers, len(shards)))) as executor:
+            futures = [executor.submit(_write_shard, os.path.join(tmp_path, _shard_name(i)), shard)
+                       for i, shard in enumerate(shards)]
+            torch.save(skeleton, os.path.join(tmp_path, SKELETON_NAME))
+
+            # raises whatever a write raised
+            for future in futures:
+                future.result()
+
+        # written last: a folder with metadata.json is a complete checkpoint
+        metadata = {'version': FORMAT_VERSION, 'nb_shards': len(shards), 'tensors': index}
+        with open(os.path.join(tmp_path, METADATA_NAME), 'w') as f:
+            json.dump(metadata, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_dir(tmp_path)
+
+        # a directory can't be renamed over a non empty one, so move the previous checkpoint out of the way first
+        old_path = None
+        if os.path.exists(dirpath):
+            old_path = '{}.old'.format(dirpath)
+            os.replace(dirpath, old_path)
+        os.replace(tmp_path, dirpath)
+        if old_path is not None:
+            shutil.rmtree(old_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    _fsync_dir(os.path.dirname(os.path.abspath(dirpath)))
+
+
+class ShardedCheckpoint(object):
+    """
+    Reads a checkpoint written by save_sharded_checkpoint.
+    Shards are memory-mapped (copy-on-write), so only the tensors actually used are read from disk
+    """
+
+    def __init__(self, dirpath, map_location=None):
+        """
+        :param dirpath:
+        :param map_location: device (or device name) for every tensor, or a dict mapping saved devices to new ones.
+            None puts each one back on the device it was saved from. Tensors on the cpu stay backed by the mapped file
+        """
+        self.dirpath = dirpath
+        self.map_location = map_location
+
+        with open(os.path.join(dirpath, METADATA_NAME)) as f:
+            self.metadata = json.load(f)
+
+        if self.metadata['version'] > FORMAT_VERSION:
+            raise ValueError('{} was written by a newer version (format {})'.format(dirpath, self.metadata['version']))
+
+        self.index = self.metadata['tensors']
+        self.shards = {}
+
+    def __shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.dirpath, _shard_name(shard)), dtype=np.uint8, mode='c')
+        return self.shards[shard]
+
+    def tensor(self, i):
+        """
+        Tensor i of the index, viewing the mapped shard without a copy when it stays on the cpu
+        :param i:
+        :return:
+        """
+        entry = self.index[i]
+        dtype = getattr(torch, entry['dtype'])
+
+        if entry['nbytes'] == 0:
+            tensor = torch.empty(entry['shape'], dtype=dtype)
+        else:
+            data = self.__shard(entry['shard'])[entry['offset']:entry['offset'] + entry['nbytes']]
+            tensor = torch.from_numpy(data).view(dtype).reshape(entry['shape'])
+
+        return tensor.to(_target_device(entry['device'], self.map_location))
+
+    def __select(self, root, prefix=''):
+        # {name: tensor} of the tensors under checkpoint[root] whose name starts with prefix (removed from the name)
+        tensors = {}
+        for i, entry in enumerate(self.index):
+            path = entry['path']
+            if len(path) == 2 and path[0] == root and str(path[1]).startswith(prefix):
+                tensors[str(path[1])[len(prefix):]] = self.tensor(i)
+        return tensors
+
+    def state_dict(self, prefix=''):
+        """
+        Model weights only. Nothing else is read
+        :param prefix: only the weights of this submodule (ie: 'encoder.'), with the prefix removed from the names
+            so they load straight into the submodule
+        :return:
+        """
+        return self.__select('state_dict', prefix)
+
+    def skeleton(self):
+        return torch.load(os.path.join(self.dirpath, SKELETON_NAME))
+
+    def optimizer_states(self):
+        """
+        Optimizer states only. The model weights aren't read
+        :return: list with the state_dict of each optimizer
+        """
+        skeleton = self.skeleton()
+        return _fill_tensors(skeleton.get('optimizer_states', []), self.tensor)
+
+    def load(self):
+        """
+        The whole checkpoint, as torch.load would return it for a single file checkpoint
+        :return:
+        """
+        return _fill_tensors(self.skeleton(), self.tensor)
+
+
+def load_checkpoint(path, map_location=None):
+    """
+    Load a single file (torch.save or compressed) or a sharded directory checkpoint
+    :param path:
+    :param map_location: same as torch.load for single files. Sharded checkpoints take a device, a dict or None
+    :return:
+    """
+    if os.path.isdir(path):
+        if callable(map_location):
+            # the callables lightning passes only move storages to the cpu
+            map_location = 'cpu'
+        checkpoint = ShardedCheckpoint(path, map_location=map_location).load()
+    elif is_compressed_checkpoint(path):
+        if callable(map_location):
+            map_location = 'cpu'
+        checkpoint = CompressedCheckpoint(path, map_location=map_location).load()
+    else:
+        checkpoint = torch.load(path, map_location=map_location)
+
+    # frozen weights saved once in a separate base file
+    dirpath = os.path.dirname(os.path.abspath(path))
+    return merge_frozen_base(checkpoint, dirpath, map_location=map_location)
+
+
+def load_weights(path):
+    """
+    Model weights only, memory-mapped on the cpu: nothing is read from disk until a tensor is used
+    (compressed checkpoints can't be mapped, they're decompressed). Optimizer states and everything else in the
+    checkpoint are never loaded
+    :param path: single file, compressed or sharded checkpoint
+    :return: state_dict
+    """
+    dirpath = os.path.dirname(os.path.abspath(path))
+    if os.path.isdir(path):
+        reader = ShardedCheckpoint(path, map_location='cpu')
+        checkpoint = {'state_dict': reader.state_dict()}
+        frozen_base = reader.skeleton().get(FROZEN_BASE_KEY)
+        if frozen_base is not None:
+            checkpoint[FROZEN_BASE_KEY] = frozen_base
+        return merge_frozen_base(checkpoint, dirpath, map_location='cpu', mmap=True)['state_dict']
+
+    if is_compressed_checkpoint(path):
+        # can't be mapped, but only the weights are decompressed
+        reader = CompressedCheckpoint(path, map_location='cpu')
+        checkpoint = {'state_dict': reader.state_dict()}
+        frozen_base = reader.skeleton().get(FROZEN_BASE_KEY)
+        if frozen_base is not None:
+            checkpoint[FROZEN_BASE_KEY] = frozen_base
+        return merge_frozen_base(checkpoint, dirpath, map_location='cpu', mmap=True)['state_dict']
+
+    try:
+        # torch >= 2.1. The other entries are mapped too, but never touched
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+        mmap = True
+    except (TypeError, RuntimeError):
+        # TypeError: no mmap argument. RuntimeError: legacy (non zipfile) checkpoints can't be mapped
+        checkpoint = torch.load(path, map_location='cpu')
+        mmap = False
+    return merge_frozen_base(checkpoint, dirpath, map_location='cpu', mmap=mmap)['state_dict']
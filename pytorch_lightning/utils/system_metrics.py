@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+import warnings
+
+import torch
+
+"""
+Samples process level system metrics in a background thread so the training loop only reads the latest snapshot.
+Everything is read from /proc, so only linux reports the process metrics. Other platforms just skip them.
+"""
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_MB = 1024 * 1024
+
+
+def _rss_mb(pid='self'):
+    # 2nd field of statm is the resident set size in pages
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE / _MB
+
+
+def _child_pids():
+    pid = os.getpid()
+    try:
+        children = []
+        for tid in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/{}/children'.format(tid)) as f:
+                children.extend(int(x) for x in f.read().split())
+        return children
+    except (IOError, OSError):
+        pass
+
+    # kernels without CONFIG_PROC_CHILDREN: look for processes whose parent is us
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # the process name (2nd field) can contain spaces, so split after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+    return children
+
+
+def process_memory():
+    return {'rss_mb': _rss_mb()}
+
+
+def open_file_descriptors():
+    return {'open_fds': len(os.listdir('/proc/self/fd'))}
+
+
+def worker_memory():
+    """
+    Memory of child processes (ie: dataloader workers)
+    :return:
+    """
+    total = 0.
+    nb_workers = 0
+    for pid in _child_pids():
+        try:
+            total += _rss_mb(pid)
+            nb_workers += 1
+        except (IOError, OSError):
+            # the worker exited in the meantime
+            continue
+
+    return {'worker_rss_mb': total, 'nb_workers': nb_workers}
+
+
+def accelerator_memory():
+    """
+    Memory reported by the cuda caching allocator of this process. Only when cuda was already initialized
+    :return:
+    """
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return {}
+
+    # memory_cached was renamed memory_reserved in torch 1.4
+    memory_reserved = getattr(torch.cuda, 'memory_reserved', None) or torch.cuda.memory_cached
+
+    metrics = {}
+    for i in range(torch.cuda.device_count()):
+        metrics['gpu_{}_allocated_mb'.format(i)] = torch.cuda.memory_allocated(i) / _MB
+        metrics['gpu_{}_reserved_mb'.format(i)] = memory_reserved(i) / _MB
+    return metrics
+
+
+class CpuUtilization(object):
+    """
+    Cpu time of this process over wall time since the previous call, in percent (can go over 100 with threads)
+    """
+
+    def __init__(self):
+        self.last = None
+
+    def __call__(self):
+        times = os.times()
+        now = (time.monotonic(), times.user + times.system)
+
+        metrics = {}
+        if self.last is not None and now[0] > self.last[0]:
+            metrics['cpu_percent'] = 100. * (now[1] - self.last[1]) / (now[0] - self.last[0])
+
+        self.last = now
+        return metrics
+
+
+def default_samplers():
+    samplers = [CpuUtilization(), accelerator_memory]
+    if os.path.exists('/proc/self/statm'):
+        samplers = [process_memory, open_file_descriptors, worker_memory] + samplers
+    return samplers
+
+
+class SystemMetricsSampler(object):
+    """
+    Calls every sampler each `period` seconds in a background thread.
+    A sampler is any callable returning a dict of scalars. One that raises gets dropped with a warning.
+    """
+
+    def __init__(self, period=1.0, samplers=None):
+        self.period = period
+        self.samplers = default_samplers() if samplers is None else list(samplers)
+        self.snapshot = {}
+
+        self.stop_event = None
+        self.thread = None
+
+    def sample(self):
+        snapshot = {}
+        for sampler in list(self.samplers):
+            try:
+                snapshot.update(sampler())
+            except Exception as e:
+                self.samplers.remove(sampler)
+                warnings.warn('system metrics sampler {} failed and was removed: {}'.format(sampler, e))
+
+        # replacing the whole dict means readers never see a half updated snapshot
+        self.snapshot = snapshot
+        return snapshot
+
+    def latest(self):
+        """
+        Most recent snapshot. Doesn't sample anything
+        :return:
+        """
+        return dict(self.snapshot)
+
+    def __run(self, stop_event):
+        while not stop_event.is_set():
+            self.sample()
+            stop_event.wait(self.period)
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, args=(self.stop_event,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
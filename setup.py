@@ -17,7 +17,7 @@ setup(
     keywords=["deep learning", "pytorch", "AI"],
     python_requires=">=3.5",
     install_requires=[
-        "torch>=1.1.0",
+        "torch>=1.2.0",
         "tqdm",
         "test-tube>=0.6.7.1",
     ],
@@ -7,12 +7,40 @@ from test_tube import Experiment
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from pytorch_lightning.utils.debugging import MisconfigurationException
 from pytorch_lightning.root_module import memory
-from pytorch_lightning.models.trainer import reduce_distributed_output
+from pytorch_lightning.models.trainer import reduce_distributed_output, metrics_to_scalars
+from pytorch_lightning.root_module.grads import grad_norms, clip_grad_norms
+from pytorch_lightning.root_module.model_saving import skip_init_weights, assign_state_dict
+from pytorch_lightning.utils.running_stats import TensorRunningMean, RunningMean
+from pytorch_lightning.utils.prefetch import BatchPrefetcher
+from pytorch_lightning.utils.metrics_writer import MetricsWriter
+from pytorch_lightning.utils.system_metrics import SystemMetricsSampler
+from pytorch_lightning.utils.checkpoint_io import AsyncCheckpointWriter, CheckpointManifest
+from pytorch_lightning.utils.sharded_checkpoint import save_sharded_checkpoint, load_checkpoint, ShardedCheckpoint, \
+    load_weights
+from pytorch_lightning.utils.frozen_weights import FrozenWeightsBase
+from pytorch_lightning.utils.compressed_checkpoint import save_compressed_checkpoint, CompressedCheckpoint, \
+    is_compressed_checkpoint
+from pytorch_lightning.pt_overrides.override_data_parallel import LightningDistributedDataParallel
+from pytorch_lightning.metrics import Sum, Mean, Accuracy, ConfusionMatrix, AUC
+from pytorch_lightning.profiler import Profiler, PassThroughProfiler
+from benchmarks import trainer_overhead
 import numpy as np
+import json
+import pickle
+import contextlib
+import copy
+import csv
+import importlib
+import threading
+import time
 import warnings
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import os
 import shutil
+import subprocess
+import sys
 
 SEED = 2334
 torch.manual_seed(SEED)
@@ -43,6 +71,36 @@ def test_dp_output_reduce():
     assert reduced['b']['c'] == out['b']['c']
 
 
+def test_metrics_to_scalars():
+    """
+    Make sure batching the host transfer gives the same values as calling .item() on each tensor
+    :return:
+    """
+    metrics = {
+        'loss': torch.tensor(0.1234567, dtype=torch.float32),
+        'half': torch.tensor([0.3], dtype=torch.float16),
+        'count': torch.tensor(7),
+        'flag': torch.tensor(True),
+        'lr': 0.01,
+        'tng_loss': '0.123',
+        'batch_nb': torch.tensor(3),
+        'grads': {'layer_1': torch.tensor(2.5), 'deeper': {'layer_2': torch.tensor(1e-8)}},
+    }
+
+    scalars = metrics_to_scalars(metrics, blacklist={'batch_nb'})
+
+    assert scalars['loss'] == metrics['loss'].item()
+    assert scalars['half'] == metrics['half'].item()
+    assert scalars['count'] == 7 and type(scalars['count']) is int
+    assert scalars['flag'] is True
+    assert scalars['lr'] == 0.01
+    assert scalars['tng_loss'] == '0.123'
+    assert scalars['grads/layer_1'] == 2.5
+    assert scalars['grads/deeper/layer_2'] == torch.tensor(1e-8).item()
+    assert 'batch_nb' not in scalars
+    assert 'grads' not in scalars
+
+
 def test_amp_gpu_ddp_slurm_managed():
     """
     Make sure DDP + AMP work
@@ -146,6 +204,1758 @@ def test_early_stopping_cpu_model():
     model.unfreeze()
 
 
+def test_running_loss_stays_on_device():
+    """
+    Make sure the training loss is only synced at logging boundaries
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir)
+    )
+    result = trainer.fit(model)
+    assert result == 1, 'cpu model failed to complete'
+
+    # losses are tracked as tensors and only converted when the tqdm dic is built
+    assert type(trainer.running_loss.mean()) is torch.Tensor
+    expected = trainer.running_loss.mean().item()
+    tng_loss = trainer.tng_tqdm_dic['tng_loss']
+    assert tng_loss == '{0:.3f}'.format(expected)
+    assert trainer.avg_loss == pytest.approx(expected)
+
+    clear_save_dir()
+
+
+def test_tensor_running_mean():
+    """
+    Make sure the running loss window keeps a constant size
+    :return:
+    """
+    tracker = TensorRunningMean(window_length=3)
+    assert tracker.mean() is None
+
+    values = [4.0, 2.0, 6.0, 10.0, 1.0]
+    for i, v in enumerate(values):
+        tracker.append(torch.tensor(v, dtype=torch.float64))
+        expected = np.mean(values[max(0, i - 2): i + 1])
+        assert tracker.mean().item() == pytest.approx(expected)
+        assert tracker.last().item() == v
+
+    assert len(tracker) == 3
+    assert tracker.memory.numel() == 3
+
+    # a nan only counts while it's in the window
+    tracker = TensorRunningMean(window_length=3)
+    running_mean = RunningMean(window_length=3)
+    for i, v in enumerate([1., float('nan'), 1., 1., 1., 1.]):
+        tracker.append(torch.tensor(v))
+        running_mean.append(v)
+        assert np.isnan(tracker.mean().item()) == (1 <= i <= 3)
+        assert np.isnan(running_mean.mean()) == (1 <= i <= 3)
+    assert tracker.mean().item() == 1.
+    assert running_mean.mean() == 1.
+
+    # same result as summing the window, with inf and -inf too
+    tracker = TensorRunningMean(window_length=3)
+    running_mean = RunningMean(window_length=3)
+    values = [float('inf'), 2., -float('inf'), 3., 4., 5., 0.1, 0.2, 0.3, 0.4]
+    for i, v in enumerate(values):
+        tracker.append(torch.tensor(v, dtype=torch.float64))
+        running_mean.append(v)
+        expected = np.mean(values[max(0, i - 2): i + 1])
+        assert tracker.mean().item() == pytest.approx(expected, nan_ok=True)
+        assert running_mean.mean() == pytest.approx(expected, nan_ok=True)
+
+    with pytest.raises(ValueError):
+        TensorRunningMean(window_length=0)
+
+
+def test_model_hooks_dispatch():
+    """
+    Make sure only overridden hooks are dispatched and on_batch_end runs once per batch
+    :return:
+    """
+
+    class HookedModel(LightningTemplateModel):
+        nb_batch_ends = 0
+
+        def on_batch_end(self):
+            self.nb_batch_ends += 1
+
+    save_dir = init_save_dir()
+    hparams = get_hparams()
+    model = HookedModel(hparams)
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir)
+    )
+    trainer.fit(model)
+
+    assert list(trainer.model_hooks.keys()) == ['on_batch_end']
+    # the loop runs batches 0..nb_tng_batches (inclusive)
+    assert model.nb_batch_ends == trainer.nb_tng_batches + 1
+
+    clear_save_dir()
+
+
+def test_batch_prefetcher():
+    """
+    Make sure the prefetcher yields the same batches and stops cleanly
+    :return:
+    """
+    dataset = torch.utils.data.TensorDataset(torch.arange(20).float())
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4)
+    prefetcher = BatchPrefetcher(loader, nb_batches=2)
+
+    # forwards to the wrapped loader
+    assert len(prefetcher) == len(loader)
+    assert prefetcher.batch_size == 4
+
+    expected = [batch[0] for batch in loader]
+    fetched = [batch[0] for batch in prefetcher]
+    assert len(fetched) == len(expected)
+    assert all(torch.equal(a, b) for a, b in zip(fetched, expected))
+    assert prefetcher.nb_fetched == len(loader)
+
+    # breaking early shuts the worker down
+    for batch_i, batch in enumerate(prefetcher):
+        if batch_i == 1:
+            break
+
+    # errors in the worker surface in the training loop
+    def broken_loader():
+        yield torch.zeros(1)
+        raise ValueError('broken batch')
+
+    class BrokenLoader(object):
+        def __iter__(self):
+            return broken_loader()
+
+    with pytest.raises(ValueError):
+        for _ in BatchPrefetcher(BrokenLoader()):
+            pass
+
+
+def test_cpu_model_with_prefetch():
+    """
+    Make sure model trains on CPU with background prefetching
+    :return:
+    """
+
+    trainer_options = dict(
+        progress_bar=False,
+        experiment=get_exp(),
+        max_nb_epochs=1,
+        train_percent_check=0.2,
+        val_percent_check=0.2,
+        prefetch_batches=2
+    )
+
+    model, hparams = get_model()
+
+    run_gpu_model_test(trainer_options, model, hparams, on_gpu=False)
+
+
+def test_step_based_training_with_iterable_dataset():
+    """
+    Make sure training runs for a number of steps on a dataloader without a length
+    :return:
+    """
+
+    class StreamingMNIST(torch.utils.data.IterableDataset):
+        def __init__(self, dataset):
+            self.dataset = dataset
+
+        def __iter__(self):
+            # never ends
+            while True:
+                for x in self.dataset:
+                    yield x
+
+    class StreamingModel(LightningTemplateModel):
+        @property
+        def tng_dataloader(self):
+            if self._tng_dataloader is None:
+                dataset = StreamingMNIST(super(StreamingModel, self).val_dataloader.dataset)
+                self._tng_dataloader = torch.utils.data.DataLoader(dataset, batch_size=self.hparams.batch_size)
+            return self._tng_dataloader
+
+    save_dir = init_save_dir()
+    hparams = get_hparams()
+    model = StreamingModel(hparams)
+
+    trainer_options = dict(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir)
+    )
+
+    # an unsized loader needs step based validation
+    trainer = Trainer(**trainer_options)
+    with pytest.raises(MisconfigurationException):
+        trainer.fit(model)
+
+    trainer = Trainer(max_steps=25, val_check_every_n_steps=10, **trainer_options)
+    result = trainer.fit(model)
+    assert result == 1, 'step based training failed to complete'
+
+    assert trainer.global_step == 25
+    assert trainer.nb_tng_batches == float('inf')
+
+    # checkpoints are named after the step they were saved at
+    checkpoints = sorted(x for x in os.listdir(save_dir) if '.ckpt' in x)
+    assert checkpoints == ['_ckpt_step_10.ckpt', '_ckpt_step_20.ckpt']
+
+    clear_save_dir()
+
+
+def test_step_based_validation_with_iterable_dataset():
+    """
+    Make sure validation on a dataloader without a length stops after max_val_batches
+    :return:
+    """
+
+    class StreamingMNIST(torch.utils.data.IterableDataset):
+        def __init__(self, dataset):
+            self.dataset = dataset
+
+        def __iter__(self):
+            # never ends
+            while True:
+                for x in self.dataset:
+                    yield x
+
+    class StreamingValModel(LightningTemplateModel):
+        nb_val_steps = 0
+
+        @property
+        def val_dataloader(self):
+            if self._val_dataloader is None:
+                dataset = StreamingMNIST(super(StreamingValModel, self).val_dataloader.dataset)
+                self._val_dataloader = torch.utils.data.DataLoader(dataset, batch_size=self.hparams.batch_size)
+            return self._val_dataloader
+
+        def validation_step(self, data_batch, batch_i):
+            self.nb_val_steps += 1
+            return super(StreamingValModel, self).validation_step(data_batch, batch_i)
+
+    trainer_options = dict(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        max_steps=20,
+        val_check_every_n_steps=10,
+        nb_sanity_val_steps=2
+    )
+
+    # an unsized val loader needs a number of batches
+    trainer = Trainer(**trainer_options)
+    with pytest.raises(MisconfigurationException):
+        trainer.fit(StreamingValModel(get_hparams()))
+
+    model = StreamingValModel(get_hparams())
+    trainer = Trainer(max_val_batches=3, **trainer_options)
+    result = trainer.fit(model)
+    assert result == 1, 'step based validation failed to complete'
+
+    # sanity check + 2 validation runs
+    assert trainer.nb_val_batches == 3
+    assert model.nb_val_steps == 2 + 2 * 3
+
+
+def test_ddp_no_sync_accumulation():
+    """
+    Make sure gradients are only all-reduced on the micro-batch that steps the optimizer.
+    Runs 2 processes with the gloo backend on CPU
+    :return:
+    """
+    if not dist.is_available():
+        warnings.warn('test_ddp_no_sync_accumulation cannot run. torch.distributed is not available')
+        return
+    if not hasattr(LightningDistributedDataParallel, '_sync_params'):
+        pytest.skip('LightningDistributedDataParallel needs the torch 1.x DistributedDataParallel internals')
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(np.random.randint(12000, 19000, 1)[0])
+
+    save_dir = init_save_dir()
+    mp.spawn(_ddp_no_sync_worker, nprocs=2, args=(2, save_dir))
+
+    grads = [torch.load(os.path.join(save_dir, 'grads_{}.pt'.format(rank))) for rank in range(2)]
+
+    # accumulation step: each process only has its own gradients
+    assert torch.allclose(grads[0]['local'], torch.full((1, 4), 2.))
+    assert torch.allclose(grads[1]['local'], torch.full((1, 4), 4.))
+
+    # optimizer step: the accumulated gradients get averaged across processes once
+    for rank_grads in grads:
+        assert torch.allclose(rank_grads['synced'], torch.full((1, 4), 6.))
+
+    clear_save_dir()
+
+
+def test_ddp_no_sync_trainer_micro_batches():
+    """
+    Make sure the trainer only runs the micro-batches that don't step the optimizer under no_sync
+    :return:
+    """
+    class MockDDP(torch.nn.Module):
+        # stands in for LightningDistributedDataParallel, records if each forward ran under no_sync
+        def __init__(self, module):
+            super(MockDDP, self).__init__()
+            self.module = module
+            self.syncing = True
+            self.synced_batches = []
+
+        @contextlib.contextmanager
+        def no_sync(self):
+            self.syncing = False
+            try:
+                yield
+            finally:
+                self.syncing = True
+
+        def forward(self, data_batch, batch_nb):
+            self.synced_batches.append(self.syncing)
+            return self.module.training_step(data_batch, batch_nb)
+
+    model, hparams = get_model()
+    accumulate_grad_batches = 3
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        accumulate_grad_batches=accumulate_grad_batches
+    )
+
+    model.trainer = trainer
+    data_batch = next(iter(model.tng_dataloader))
+
+    trainer.use_ddp = True
+    trainer.model = MockDDP(model)
+    trainer.optimizers = model.configure_optimizers()
+    trainer.batch_loss_value = 0
+
+    for batch_nb in range(2 * accumulate_grad_batches):
+        trainer.batch_nb = batch_nb
+        assert trainer._Trainer__run_tng_batch(data_batch, batch_nb) == 0
+
+    # micro-batches 1..k-1 accumulate locally, batch k all-reduces
+    expected = ([False] * (accumulate_grad_batches - 1) + [True]) * 2
+    assert trainer.model.synced_batches == expected
+    assert len(trainer.running_loss) == 2
+
+
+def _ddp_no_sync_worker(rank, world_size, save_dir):
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    torch.manual_seed(SEED)
+    model = LightningDistributedDataParallel(torch.nn.Linear(4, 1))
+    x = torch.full((2, 4), float(rank + 1))
+
+    # same pattern the trainer uses with accumulate_grad_batches=2
+    with model.no_sync():
+        model(x).sum().backward()
+    local = model.module.weight.grad.clone()
+
+    model(x).sum().backward()
+    synced = model.module.weight.grad.clone()
+
+    torch.save({'local': local, 'synced': synced}, os.path.join(save_dir, 'grads_{}.pt'.format(rank)))
+    dist.destroy_process_group()
+
+
+def test_metric_accumulators():
+    """
+    Make sure accumulators give the same result as reducing the full list of outputs
+    :return:
+    """
+    y_hat = torch.rand(50, 3)
+    y = torch.randint(0, 3, (50,))
+    losses = torch.rand(50)
+    outputs = [{'y_hat': y_hat[i:i + 7], 'y': y[i:i + 7], 'loss': losses[i:i + 7]} for i in range(0, 50, 7)]
+
+    accumulators = {
+        'sum': Sum('loss'),
+        'mean': Mean('loss'),
+        'acc': Accuracy(),
+        'cm': ConfusionMatrix(nb_classes=3),
+    }
+    for output in outputs:
+        for accumulator in accumulators.values():
+            accumulator.update(output)
+
+    labels_hat = y_hat.argmax(dim=1)
+    assert accumulators['sum'].compute() == pytest.approx(losses.sum().item(), rel=1e-5)
+    assert accumulators['mean'].compute() == pytest.approx(losses.mean().item(), rel=1e-5)
+    assert accumulators['acc'].compute() == pytest.approx((labels_hat == y).float().mean().item())
+
+    cm = accumulators['cm'].compute()
+    assert cm.sum() == 50
+    for target, pred in zip(y.tolist(), labels_hat.tolist()):
+        cm[target, pred] -= 1
+    assert (cm == 0).all()
+
+    # exact auc: fraction of (pos, neg) pairs ranked correctly
+    scores = torch.rand(200)
+    target = (torch.rand(200) < 0.4).long()
+    auc = AUC(scores_key='scores', target_key='y', nb_bins=10000)
+    for i in range(0, 200, 32):
+        auc.update({'scores': scores[i:i + 32], 'y': target[i:i + 32]})
+
+    pos, neg = scores[target == 1], scores[target == 0]
+    expected = (pos.view(-1, 1) > neg.view(1, -1)).float().mean().item()
+    assert auc.compute() == pytest.approx(expected, abs=1e-3)
+
+
+def test_cpu_model_with_validation_accumulators():
+    """
+    Make sure validation can reduce outputs as it goes
+    :return:
+    """
+
+    class AccumulatorModel(LightningTemplateModel):
+        def validation_accumulators(self):
+            return {'val_loss': Mean('val_loss'), 'val_acc': Mean('val_acc')}
+
+        def validation_end(self, outputs):
+            # outputs are already reduced
+            assert type(outputs) is dict
+            return outputs
+
+    hparams = get_hparams()
+    model = AccumulatorModel(hparams)
+
+    trainer_options = dict(
+        progress_bar=False,
+        experiment=get_exp(),
+        max_nb_epochs=1,
+        train_percent_check=0.2,
+        val_percent_check=0.2
+    )
+
+    run_gpu_model_test(trainer_options, model, hparams, on_gpu=False)
+
+
+def test_cpu_model_validates_twice_with_same_accumulators():
+    """
+    Make sure accumulators kept on the model don't carry over from one validation run to the next
+    :return:
+    """
+
+    class PersistentAccumulatorModel(LightningTemplateModel):
+        def __init__(self, hparams):
+            super(PersistentAccumulatorModel, self).__init__(hparams)
+            self.accumulators = {'val_loss': Sum('val_loss'), 'val_acc': Mean('val_acc')}
+
+        def validation_accumulators(self):
+            return self.accumulators
+
+        def validation_end(self, outputs):
+            return outputs
+
+    hparams = get_hparams()
+    model = PersistentAccumulatorModel(hparams)
+
+    trainer = Trainer(
+        progress_bar=False,
+        experiment=get_exp(),
+        max_nb_epochs=1,
+        train_percent_check=0.2,
+        val_percent_check=0.2
+    )
+    result = trainer.fit(model)
+    assert result == 1, 'training failed to complete'
+
+    # the val dataloader shuffles, so both runs go over the same fixed batches
+    batches = [batch for _, batch in zip(range(5), trainer.val_dataloader)]
+    first = trainer.validate(model, batches, None)
+    second = trainer.validate(model, batches, None)
+    assert second['val_loss'] == pytest.approx(first['val_loss'], rel=1e-5)
+    assert second['val_acc'] == pytest.approx(first['val_acc'], rel=1e-5)
+
+
+def test_cpu_model_with_async_validation():
+    """
+    Make sure validation can run in a background process
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.2,
+        val_percent_check=0.2,
+        val_check_interval=0.5,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        async_validation=True
+    )
+    result = trainer.fit(model)
+    assert result == 1, 'async validation failed to complete'
+
+    # the worker is shut down and every validation got reported
+    assert trainer.async_val_worker is None
+    assert trainer.async_val_pending == 0
+    assert 'val_loss' in trainer.tng_tqdm_dic
+    assert_ok_acc(trainer)
+
+    checkpoints = [x for x in os.listdir(save_dir) if '.ckpt' in x]
+    assert len(checkpoints) > 0
+
+    clear_save_dir()
+
+
+def test_cpu_model_async_validation_forks_before_threads(monkeypatch):
+    """
+    Make sure the validation worker is forked before the trainer starts any background thread
+    :return:
+    """
+    model, hparams = get_model()
+    exp = get_exp(False)
+
+    # the experiment's own writer thread is there before fit
+    existing_threads = set(threading.enumerate())
+    threads_at_fork = []
+    start_async_validation = Trainer._Trainer__start_async_validation
+
+    def start(trainer, ref_model):
+        threads_at_fork.extend(t for t in threading.enumerate() if t not in existing_threads)
+        return start_async_validation(trainer, ref_model)
+    monkeypatch.setattr(Trainer, '_Trainer__start_async_validation', start)
+
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        system_metrics=True,
+        async_validation=True
+    )
+    result = trainer.fit(model)
+    assert result == 1, 'async validation failed to complete'
+    assert threads_at_fork == []
+
+    exp.close()
+
+
+def test_cpu_model_async_validation_checkpoints_validated_weights():
+    """
+    Make sure async validation checkpoints the weights that were validated, not the ones current when results arrive
+    :return:
+    """
+    class SnapshotModel(LightningTemplateModel):
+        def __init__(self, hparams):
+            super(SnapshotModel, self).__init__(hparams)
+            self.validated_weights = []
+            self.validated_optimizer_states = []
+
+        def on_pre_performance_check(self):
+            # same point the trainer snapshots the weights at
+            self.validated_weights.append({k: v.detach().clone() for k, v in self.state_dict().items()})
+            self.validated_optimizer_states.append(copy.deepcopy(self.trainer.optimizers[0].state_dict()))
+
+    save_dir = init_save_dir()
+    hparams = get_hparams()
+    model = SnapshotModel(hparams)
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        max_steps=25,
+        val_check_every_n_steps=10,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        async_validation=True
+    )
+    result = trainer.fit(model)
+    assert result == 1, 'async validation failed to complete'
+
+    checkpoints = sorted(x for x in os.listdir(save_dir) if '.ckpt' in x)
+    assert checkpoints == ['_ckpt_step_10.ckpt', '_ckpt_step_20.ckpt']
+    assert len(model.validated_weights) == 2
+
+    for filename, step, weights in zip(checkpoints, [10, 20], model.validated_weights):
+        checkpoint = torch.load(os.path.join(save_dir, filename), map_location='cpu')
+        assert checkpoint['global_step'] == step
+        for k, v in weights.items():
+            assert torch.equal(checkpoint['state_dict'][k], v), k
+
+    # the optimizer states are from the validated step too, not from when the results arrived
+    for filename, optimizer_state in zip(checkpoints, model.validated_optimizer_states):
+        saved_state = torch.load(os.path.join(save_dir, filename), map_location='cpu')['optimizer_states'][0]['state']
+        assert saved_state.keys() == optimizer_state['state'].keys()
+        for i, param_state in optimizer_state['state'].items():
+            for k, v in param_state.items():
+                assert torch.equal(torch.as_tensor(saved_state[i][k]), torch.as_tensor(v)), k
+
+    # training moved on after the last check
+    live = model.state_dict()
+    assert any(not torch.equal(live[k], v) for k, v in model.validated_weights[-1].items())
+
+    clear_save_dir()
+
+
+def test_profiler():
+    """
+    Make sure the profiler records each action
+    :return:
+    """
+    profiler = Profiler()
+    for _ in range(3):
+        with profiler.profile('a'):
+            pass
+
+    batches = list(profiler.profile_iterable(range(4), 'fetch'))
+    assert batches == [0, 1, 2, 3]
+
+    stats = profiler.stats()
+    assert stats['a']['count'] == 3
+    # one extra call for the StopIteration
+    assert stats['fetch']['count'] == 5
+    assert stats['a']['p50'] <= stats['a']['p99']
+    assert 'fetch' in profiler.summary()
+
+    with pytest.raises(ValueError):
+        profiler.stop('never_started')
+
+    # disabled profiler does nothing
+    passthrough = PassThroughProfiler()
+    with passthrough.profile('a'):
+        pass
+    data = [1, 2]
+    assert passthrough.profile_iterable(data, 'fetch') is data
+    assert passthrough.stats() == {}
+
+    # ddp sends the trainer (and its profiler) to the spawned processes
+    restored = pickle.loads(pickle.dumps(profiler))
+    assert restored.stats()['a']['count'] == 3
+    with restored.profile('b'):
+        pass
+    assert restored.stats()['b']['count'] == 1
+
+
+def test_cpu_model_with_profiler():
+    """
+    Make sure each stage of training gets profiled
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        gradient_clip=1.0,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        profiler=True
+    )
+    trainer.fit(model)
+
+    stats = trainer.profiler.stats()
+    for action in ['get_tng_batch', 'training_step', 'backward', 'optimizer_step', 'clip_gradients',
+                   'get_val_batch', 'validation_step', 'validation_end', 'experiment_log', 'checkpoint']:
+        assert stats[action]['count'] > 0, '{} was not profiled'.format(action)
+
+    assert stats['training_step']['count'] == trainer.nb_tng_batches + 1
+
+    clear_save_dir()
+
+
+def test_running_mean():
+    """
+    Make sure the host side running mean only averages the window
+    :return:
+    """
+    running_mean = RunningMean(window_length=3)
+    assert running_mean.mean() is None
+
+    for x in [1., 2., 3., 4., 5.]:
+        running_mean.append(x)
+
+    assert len(running_mean) == 3
+    assert running_mean.mean() == 4.
+    assert running_mean.total == 12.
+
+
+def test_cpu_model_throughput_metrics():
+    """
+    Make sure throughput and ETA show up in the progress bar metrics and the batch size is inferred
+    :return:
+    """
+    model, hparams = get_model()
+
+    batch = (torch.zeros(7, 3), [torch.zeros(2)])
+    assert model.get_batch_size(batch) == 7
+    assert model.get_batch_size({'x': torch.zeros(5, 1)}) == 5
+    assert model.get_batch_size(['not a tensor']) is None
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        throughput_window=5
+    )
+    trainer.fit(model)
+
+    tqdm_dic = trainer.tng_tqdm_dic
+    for key in ['samples_per_sec', 'batches_per_sec', 'step_time_ms', 'epoch_eta_s']:
+        assert key in tqdm_dic, '{} missing from the progress bar'.format(key)
+        assert float(tqdm_dic[key]) >= 0
+
+    assert len(trainer.step_samples) == 5
+    assert trainer.step_samples.mean() == hparams.batch_size
+
+
+def test_trainer_overhead_benchmark():
+    """
+    Make sure the overhead benchmark runs and can be compared against a baseline
+    :return:
+    """
+    sizes = {'tiny': dict(in_features=8, hidden_dim=8, nb_layers=1)}
+    results = trainer_overhead.run_benchmark(model_sizes=sizes, nb_steps=12, warmup_steps=2, repeats=1)
+
+    case = results['cases']['tiny']
+    for loop_name in ['raw', 'lightning']:
+        assert case[loop_name]['nb_steps'] == 9
+        assert case[loop_name]['us_per_step'] > 0
+        assert case[loop_name]['peak_rss_mb'] > 0
+
+    # results must survive a json round trip to be used as a baseline
+    baseline = json.loads(json.dumps(results))
+    comparison = trainer_overhead.compare_to_baseline(results, baseline)
+    assert comparison['tiny']['delta_us_per_step'] == 0
+    assert not comparison['tiny']['regressed']
+
+
+def test_metrics_writer():
+    """
+    Make sure rows get appended in the background and everything is written on close
+    :return:
+    """
+    save_dir = init_save_dir()
+    path = os.path.join(save_dir, 'metrics.jsonl')
+
+    writer = MetricsWriter(path, flush_interval=60)
+    for i in range(5):
+        writer.write({'loss': i * 0.5, 'step': torch.tensor(i)})
+
+    # explicit flush writes before the interval is up
+    writer.flush()
+    for _ in range(100):
+        if writer.nb_rows_written == 5:
+            break
+        time.sleep(0.01)
+    assert writer.nb_rows_written == 5
+
+    writer.write({'loss': 10.})
+    writer.close()
+
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    assert len(rows) == 6
+    assert rows[3] == {'loss': 1.5, 'step': 3}
+    assert rows[-1] == {'loss': 10.}
+
+    with pytest.raises(ValueError):
+        writer.write({'loss': 0.})
+
+    # reopening appends
+    writer = MetricsWriter(path)
+    writer.write({'loss': 11.})
+    writer.close()
+    with open(path) as f:
+        assert len(f.readlines()) == 7
+
+    # the csv gets rewritten from the thread while rows keep coming, with every column seen so far
+    csv_path = os.path.join(save_dir, 'metrics.csv')
+    writer = MetricsWriter(path, flush_interval=0.01, csv_path=csv_path)
+    writer.write({'loss': 1., 'step': torch.tensor(0)})
+    writer.write({'loss': 2., 'val_loss': 3.})
+    for _ in range(500):
+        if os.path.exists(csv_path):
+            break
+        time.sleep(0.01)
+    assert os.path.exists(csv_path)
+    writer.close()
+
+    with open(csv_path) as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [{'loss': '1.0', 'step': '0', 'val_loss': ''}, {'loss': '2.0', 'step': '', 'val_loss': '3.0'}]
+
+    clear_save_dir()
+
+
+def test_cpu_model_with_metrics_writer():
+    """
+    Make sure logged rows end up in metrics.jsonl and the experiment gets saved at the end
+    :return:
+    """
+    model, hparams = get_model()
+    exp = get_exp(False)
+
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        add_log_row_interval=2
+    )
+    trainer.fit(model)
+    assert trainer.metrics_writer is None
+
+    exp_path = exp.get_data_path(exp.name, exp.version)
+    with open(os.path.join(exp_path, 'metrics.jsonl')) as f:
+        rows = [json.loads(line) for line in f]
+
+    assert len(rows) == len(exp.metrics)
+    assert all('tng_loss' in row and 'global_step' in row for row in rows)
+    assert os.path.exists(os.path.join(exp_path, 'metrics.csv'))
+
+
+def test_system_metrics_sampler():
+    """
+    Make sure the sampler records process metrics on cpu only linux and drops samplers that fail
+    :return:
+    """
+    def broken_sampler():
+        raise RuntimeError('no such device')
+
+    sampler = SystemMetricsSampler(period=0.01)
+    assert sampler.latest() == {}
+
+    sampler.samplers.append(broken_sampler)
+    with warnings.catch_warnings(record=True):
+        warnings.simplefilter('always')
+        snapshot = sampler.sample()
+    assert broken_sampler not in sampler.samplers
+
+    if os.path.exists('/proc/self/statm'):
+        assert snapshot['rss_mb'] > 0
+        assert snapshot['open_fds'] > 0
+        assert snapshot['nb_workers'] >= 0
+
+    # a second sample is needed to get a cpu percentage
+    sampler.start()
+    for _ in range(100):
+        if 'cpu_percent' in sampler.latest():
+            break
+        time.sleep(0.01)
+    sampler.stop()
+    assert sampler.latest()['cpu_percent'] >= 0
+    assert sampler.thread is None
+
+
+def test_cpu_model_with_system_metrics():
+    """
+    Make sure the sampled system metrics get logged
+    :return:
+    """
+    model, hparams = get_model()
+    exp = get_exp(False)
+
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        add_log_row_interval=1,
+        system_metrics=SystemMetricsSampler(period=0.01, samplers=[lambda: {'custom_metric': 1.0}])
+    )
+    trainer.fit(model)
+
+    assert trainer.system_metrics.thread is None
+    assert any(row.get('custom_metric') == 1.0 for row in exp.metrics)
+
+    trainer = Trainer(experiment=get_exp(), system_metrics=False)
+    assert trainer.system_metrics is None
+
+    # off unless asked for
+    trainer = Trainer(experiment=get_exp())
+    assert trainer.system_metrics is None
+
+
+def test_grad_norm():
+    """
+    Make sure the batched grad norms match norms computed one parameter at a time
+    :return:
+    """
+    model, hparams = get_model()
+    assert model.grad_norm(2) == {'grad_2_norm_total': 0.0}
+
+    x = torch.rand(4, hparams.in_features)
+    y = torch.tensor([0, 1, 2, 3])
+    model.loss(y, model(x)).backward()
+
+    params = list(model.parameters())
+    for norm_type in [1, 2, float('inf')]:
+        norms = model.grad_norm(norm_type)
+        expected = [p.grad.norm(norm_type) for p in params]
+        for i, norm in enumerate(expected):
+            assert abs(norms['grad_{}_norm_{}'.format(norm_type, i)] - norm.item()) < 1e-3
+
+        total = torch.stack(expected).norm(norm_type).item()
+        assert abs(norms['grad_{}_norm_total'.format(norm_type)] - total) < 1e-3
+
+    # one norm per module
+    grouped = model.grad_norm(2, group_depth=1)
+    c_d1 = torch.stack([model.c_d1.weight.grad.norm(), model.c_d1.bias.grad.norm()]).norm().item()
+    assert abs(grouped['grad_2_norm_c_d1'] - c_d1) < 1e-3
+    assert set(grouped.keys()) == {'grad_2_norm_c_d1', 'grad_2_norm_c_d1_bn', 'grad_2_norm_c_d2',
+                                   'grad_2_norm_total'}
+    assert grouped['grad_2_norm_total'] == model.grad_norm(2)['grad_2_norm_total']
+
+
+def test_clip_grad_norms():
+    """
+    Make sure clipping with the shared norms matches torch.nn.utils.clip_grad_norm_
+    :return:
+    """
+    model, hparams = get_model()
+    x = torch.rand(4, hparams.in_features)
+    y = torch.tensor([0, 1, 2, 3])
+    model.loss(y, model(x)).backward()
+
+    expected = copy.deepcopy(model)
+    for p, expected_p in zip(model.parameters(), expected.parameters()):
+        expected_p.grad = p.grad.clone()
+    expected_total = torch.nn.utils.clip_grad_norm_(expected.parameters(), 0.01)
+
+    norms = grad_norms(model.named_parameters(), 2)
+    assert torch.allclose(norms.total, expected_total)
+
+    clip_grad_norms(model.parameters(), norms.total, 0.01)
+    for p, expected_p in zip(model.parameters(), expected.parameters()):
+        assert torch.allclose(p.grad, expected_p.grad)
+
+
+def test_fp16_grad_norms():
+    """
+    Make sure half precision gradients don't overflow the total norm, clipping or the non finite check
+    :return:
+    """
+    layer = torch.nn.Linear(100, 100).half()
+    expected = copy.deepcopy(layer)
+    for p, expected_p in zip(layer.parameters(), expected.parameters()):
+        p.grad = torch.full_like(p, 30)
+        expected_p.grad = torch.full_like(p, 30)
+
+    # norms of 3000 and 300, squaring them overflows fp16
+    expected_total = torch.nn.utils.clip_grad_norm_(expected.parameters(), 1e9)
+    norms = grad_norms(layer.named_parameters(), 2)
+    assert torch.isfinite(norms.total)
+    assert norms.total.item() == pytest.approx(expected_total.item(), rel=1e-3)
+    assert norms.to_dict(group_depth=1)['grad_2_norm_total'] == pytest.approx(3014.963, rel=1e-3)
+
+    # not skipped as non finite
+    trainer = Trainer(experiment=get_exp(), progress_bar=False, skip_nonfinite_grads=True)
+    assert not trainer._Trainer__check_nonfinite_grads(norms)
+    assert trainer.nb_skipped_steps == 0
+
+    # clipped, not zeroed
+    clip_grad_norms(layer.parameters(), norms.total, 1.0)
+    clipped = grad_norms(layer.named_parameters(), 2).total
+    assert clipped.item() == pytest.approx(1.0, rel=1e-2)
+
+
+def test_cpu_model_grad_norms_computed_once():
+    """
+    Make sure clipping, logging and the hook share a single grad norm pass per optimizer step
+    :return:
+    """
+
+    class NormHookModel(LightningTemplateModel):
+        totals = []
+
+        def on_grad_norms(self, grad_norms):
+            self.totals.append(grad_norms.total.item())
+
+    hparams = get_hparams()
+    model = NormHookModel(hparams)
+    exp = get_exp(False)
+
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        gradient_clip=1.0,
+        track_grad_norm=2,
+        accumulate_grad_batches=2,
+        add_log_row_interval=2,
+        profiler=True
+    )
+    trainer.fit(model)
+
+    nb_steps = (trainer.nb_tng_batches + 1) // 2
+    stats = trainer.profiler.stats()
+    assert stats['clip_gradients']['count'] == nb_steps
+
+    # one pass per step for clipping + the hook, plus one host transfer per logged row
+    nb_logged = len([row for row in exp.metrics if 'grad_2_norm_total' in row])
+    assert stats['grad_norm']['count'] == nb_steps + nb_logged
+    assert len(model.totals) == nb_steps
+    assert nb_logged > 0
+    assert exp.metrics[1]['grad_2_norm_total'] == round(model.totals[0], 3)
+
+
+def test_cpu_model_skips_nonfinite_grads():
+    """
+    Make sure a step with nan gradients is skipped and counted
+    :return:
+    """
+
+    class NanGradModel(LightningTemplateModel):
+        def on_after_backward(self):
+            # poison the gradients of every third batch
+            if self.trainer.batch_nb % 3 == 0:
+                self.c_d2.bias.grad[0] = float('nan')
+
+    hparams = get_hparams()
+    model = NanGradModel(hparams)
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        gradient_clip=1.0,
+        skip_nonfinite_grads=True
+    )
+    trainer.fit(model)
+
+    nb_batches = trainer.nb_tng_batches + 1
+    assert trainer.nb_skipped_steps == len(range(0, nb_batches, 3))
+    assert trainer.tng_tqdm_dic['skipped_steps'] == str(trainer.nb_skipped_steps)
+
+    # the poisoned steps never reach the weights
+    for param in model.parameters():
+        assert torch.isfinite(param).all()
+
+    class NanLossModel(LightningTemplateModel):
+        def training_step(self, data_batch, batch_i):
+            output = super(NanLossModel, self).training_step(data_batch, batch_i)
+            if batch_i % 3 == 1:
+                output['loss'] = output['loss'] * float('nan')
+            return output
+
+    model = NanLossModel(hparams)
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        skip_nonfinite_grads=True
+    )
+    trainer.fit(model)
+
+    # the loss of skipped steps isn't averaged into the progress bar loss
+    assert trainer.nb_skipped_steps > 0
+    assert np.isfinite(float(trainer.tng_tqdm_dic['tng_loss']))
+
+
+def test_model_summary():
+    """
+    Make sure the summary follows the real forward pass of a non sequential model
+    :return:
+    """
+
+    class ResidualModel(LightningTemplateModel):
+        def __init__(self, hparams):
+            super(ResidualModel, self).__init__(hparams)
+            self.example_input_array = torch.rand(4, 8)
+            self.encoder = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU())
+            self.shared = torch.nn.Linear(16, 16)
+            self.head = torch.nn.Linear(16, 2)
+
+        def forward(self, x):
+            h = self.encoder(x)
+            # skip connection + a module used twice, neither works when feeding layers one after another
+            h = h + self.shared(self.shared(h))
+            return self.head(h)
+
+    model = ResidualModel(get_hparams())
+    model.train()
+    summary = memory.ModelSummary(model, batch_size=8)
+    assert model.training
+
+    index = {name: i for i, name in enumerate(summary.layer_names)}
+    assert summary.in_sizes[index['head']] == [4, 16]
+    assert summary.out_sizes[index['head']] == [4, 2]
+    assert summary.out_sizes[index['encoder']] == [4, 16]
+
+    # the shared layer runs twice
+    assert summary.flops[index['shared']] == 2 * (2 * 16 * 4 * 16)
+    assert summary.flops[index['encoder']] == summary.flops[index['encoder.0']] + summary.flops[index['encoder.1']]
+    assert summary.param_nums[index['encoder']] == 8 * 16 + 16
+    assert summary.act_bytes[index['head']] == 4 * 2 * 4
+
+    # activations scale with the batch size
+    small = summary.peak_memory_estimate(batch_size=4)
+    large = summary.peak_memory_estimate(batch_size=8)
+    assert large - small == summary.total_act_bytes
+    assert 'Estimated peak training memory (batch of 8)' in str(summary)
+
+
+def test_model_summary_without_gelu(monkeypatch):
+    """
+    Make sure the summary works on torch versions without nn.GELU
+    :return:
+    """
+    monkeypatch.delattr(torch.nn, 'GELU')
+    try:
+        importlib.reload(memory)
+        relu = torch.nn.ReLU()
+        x = torch.rand(4, 8)
+        assert memory.estimate_flops(relu, (x,), relu(x)) == 4 * 8
+
+        model, hparams = get_model()
+        summary = memory.ModelSummary(model)
+        assert len(summary.layer_names) > 0
+    finally:
+        monkeypatch.undo()
+        importlib.reload(memory)
+
+
+def test_async_checkpoint_writer():
+    """
+    Make sure background writes snapshot the weights, are atomic and report errors
+    :return:
+    """
+    save_dir = init_save_dir()
+
+    weights = torch.zeros(3)
+    writer = AsyncCheckpointWriter(max_in_flight=1)
+    for i in range(3):
+        writer.submit({'state_dict': {'w': weights}, 'step': i}, os.path.join(save_dir, 'ckpt_{}.ckpt'.format(i)))
+
+        # training keeps updating the live weights
+        weights += 1
+        assert len(writer.pending) <= 1
+
+    writer.flush()
+    for i in range(3):
+        checkpoint = torch.load(os.path.join(save_dir, 'ckpt_{}.ckpt'.format(i)))
+        assert checkpoint['step'] == i
+        assert torch.equal(checkpoint['state_dict']['w'], torch.full((3,), float(i)))
+
+    # no temp files left behind
+    assert sorted(os.listdir(save_dir)) == ['ckpt_0.ckpt', 'ckpt_1.ckpt', 'ckpt_2.ckpt']
+
+    # a failed write surfaces on flush
+    writer.submit({'step': 0}, os.path.join(save_dir, 'missing_dir', 'ckpt.ckpt'))
+    with pytest.raises(FileNotFoundError):
+        writer.flush()
+
+    writer.close()
+    assert writer.executor is None
+
+    clear_save_dir()
+
+
+def test_cpu_model_with_async_checkpoint():
+    """
+    Make sure every checkpoint is on disk when fit returns
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=2,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir, save_best_only=False),
+        async_checkpoint=True
+    )
+    trainer.fit(model)
+    assert trainer.checkpoint_writer.executor is None
+
+    checkpoints = sorted(os.listdir(save_dir))
+    assert checkpoints == ['_ckpt_epoch_1.ckpt', '_ckpt_epoch_2.ckpt']
+
+    checkpoint = torch.load(os.path.join(save_dir, checkpoints[-1]))
+    assert checkpoint['epoch'] == 1
+    assert checkpoint['state_dict'].keys() == model.state_dict().keys()
+
+    clear_save_dir()
+
+
+def test_model_checkpoint_save_top_k():
+    """
+    Make sure only the k best checkpoints are kept and a new callback resumes from the manifest
+    :return:
+    """
+    save_dir = init_save_dir()
+
+    # not a checkpoint of this callback, must survive
+    open(os.path.join(save_dir, 'other.ckpt'), 'w').close()
+
+    def save_function(filepath):
+        open(filepath, 'w').close()
+
+    checkpoint = ModelCheckpoint(save_dir, save_top_k=2)
+    checkpoint.save_function = save_function
+
+    for epoch, val_loss in enumerate([5., 3., 4., 6., 1.]):
+        checkpoint.on_epoch_end(epoch, logs={'val_loss': val_loss})
+
+    checkpoints = sorted(x for x in os.listdir(save_dir) if '.ckpt' in x)
+    assert checkpoints == ['_ckpt_epoch_2.ckpt', '_ckpt_epoch_5.ckpt', 'other.ckpt']
+    assert checkpoint.best == 1.
+
+    with open(checkpoint.manifest_path) as f:
+        manifest = json.load(f)
+    assert [x['metric'] for x in manifest['checkpoints']] == [1., 3.]
+    assert manifest['checkpoints'][0]['path'] == '{}/_ckpt_epoch_5.ckpt'.format(save_dir)
+
+    # a resumed run keeps ranking against the checkpoints already on disk
+    checkpoint = ModelCheckpoint(save_dir, save_top_k=2)
+    checkpoint.save_function = save_function
+    assert checkpoint.best == 1.
+
+    checkpoint.on_epoch_end(5, logs={'val_loss': 2.})
+    checkpoints = sorted(x for x in os.listdir(save_dir) if '.ckpt' in x)
+    assert checkpoints == ['_ckpt_epoch_5.ckpt', '_ckpt_epoch_6.ckpt', 'other.ckpt']
+
+    with pytest.raises(ValueError):
+        ModelCheckpoint(save_dir, save_top_k=0)
+
+    clear_save_dir()
+
+    # nan and inf rank last, so they never push out a real checkpoint
+    save_dir = init_save_dir()
+    checkpoint = ModelCheckpoint(save_dir, save_top_k=2)
+    checkpoint.save_function = save_function
+
+    for epoch, val_loss in enumerate([float('nan'), 3., float('inf'), 4., float('nan'), 5.]):
+        checkpoint.on_epoch_end(epoch, logs={'val_loss': val_loss})
+
+    checkpoints = sorted(x for x in os.listdir(save_dir) if '.ckpt' in x)
+    assert checkpoints == ['_ckpt_epoch_2.ckpt', '_ckpt_epoch_4.ckpt']
+    assert checkpoint.best == 3.
+
+    clear_save_dir()
+
+
+def test_hpc_checkpoint_manifest():
+    """
+    Make sure the latest hpc checkpoint comes from the manifest, ignoring other checkpoints in the folder
+    :return:
+    """
+    save_dir = init_save_dir()
+    manifest = CheckpointManifest(save_dir)
+
+    # checkpoints saved before there was a manifest are picked up by a scan
+    for name in ['hpc_ckpt_1.ckpt', 'hpc_ckpt_2.ckpt', '_ckpt_epoch_30.ckpt', 'hpc_ckpt_9.ckpt.tmp']:
+        with open(os.path.join(save_dir, name), 'w') as f:
+            f.write('x')
+    assert not os.path.exists(manifest.path)
+    assert manifest.latest()['seq'] == 2
+    assert os.path.exists(manifest.path)
+
+    filepath = manifest.checkpoint_path(manifest.next_seq())
+    with open(filepath, 'w') as f:
+        f.write('xyz')
+    manifest.append(filepath, step=100)
+    assert manifest.latest() == {'seq': 3, 'path': 'hpc_ckpt_3.ckpt', 'size': 3, 'step': 100}
+
+    with pytest.raises(ValueError):
+        manifest.append(os.path.join(save_dir, '_ckpt_epoch_30.ckpt'))
+
+    # a half written line is recovered from
+    with open(manifest.path, 'a') as f:
+        f.write('{"seq": 4, "pa')
+    assert manifest.latest()['seq'] == 3
+
+    # so is an entry whose checkpoint was removed
+    os.remove(filepath)
+    assert manifest.latest()['seq'] == 2
+
+    clear_save_dir()
+
+    # the trainer saves and resumes through the manifest
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+    exp = get_exp(False)
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir)
+    )
+    trainer.fit(model)
+
+    trainer.hpc_save(save_dir, exp)
+    trainer.hpc_save(save_dir, exp)
+    assert trainer.max_ckpt_in_folder(save_dir) == 2
+
+    trainer.global_step = 0
+    trainer.hpc_load(save_dir, on_gpu=False)
+    assert trainer.global_step == CheckpointManifest(save_dir).latest()['step']
+
+    clear_save_dir()
+
+
+def test_sharded_checkpoint():
+    """
+    Make sure a sharded checkpoint loads back whole or in parts
+    :return:
+    """
+    save_dir = init_save_dir()
+    dirpath = os.path.join(save_dir, 'sharded.ckpt')
+
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.randn(5, 4)).sum().backward()
+    optimizer.step()
+
+    checkpoint = {
+        'epoch': 3,
+        'state_dict': model.state_dict(),
+        'optimizer_states': [optimizer.state_dict()],
+        'mask': torch.tensor([True, False, True]),
+        'ids': torch.arange(5, dtype=torch.int64),
+        'half': torch.randn(2, 2).to(torch.bfloat16),
+        'empty': torch.zeros(0, 3),
+    }
+
+    # small shards, so several are written in parallel
+    save_sharded_checkpoint(checkpoint, dirpath, shard_size=64, nb_workers=3)
+    reader = ShardedCheckpoint(dirpath)
+    assert reader.metadata['nb_shards'] > 1
+    assert os.listdir(save_dir) == ['sharded.ckpt']
+
+    loaded = load_checkpoint(dirpath)
+    assert loaded['epoch'] == 3
+    for key in ['mask', 'ids', 'half', 'empty']:
+        assert loaded[key].dtype == checkpoint[key].dtype
+        assert torch.equal(loaded[key], checkpoint[key])
+    for k, v in model.state_dict().items():
+        assert torch.equal(loaded['state_dict'][k], v)
+
+    # weights only, one submodule
+    weights = reader.state_dict(prefix='1.')
+    assert sorted(weights.keys()) == ['bias', 'weight']
+    model[1].load_state_dict(weights)
+
+    # optimizer only
+    opt_states = reader.optimizer_states()
+    assert opt_states[0]['param_groups'] == optimizer.state_dict()['param_groups']
+    assert torch.equal(opt_states[0]['state'][0]['exp_avg'], optimizer.state_dict()['state'][0]['exp_avg'])
+
+    # overwriting keeps the folder consistent
+    checkpoint['epoch'] = 4
+    save_sharded_checkpoint(checkpoint, dirpath)
+    assert load_checkpoint(dirpath)['epoch'] == 4
+    assert os.listdir(save_dir) == ['sharded.ckpt']
+
+    clear_save_dir()
+
+
+def test_cpu_model_with_sharded_checkpoint():
+    """
+    Make sure the trainer writes sharded checkpoints that load like regular ones
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    with pytest.raises(MisconfigurationException):
+        Trainer(experiment=get_exp(), checkpoint_format='zip')
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        async_checkpoint=True,
+        checkpoint_format='sharded'
+    )
+    trainer.fit(model)
+
+    dirpath = os.path.join(save_dir, '_ckpt_epoch_1.ckpt')
+    assert os.path.isdir(dirpath)
+
+    checkpoint = load_checkpoint(dirpath, map_location=lambda storage, loc: storage)
+    assert checkpoint['epoch'] == 0
+    assert len(checkpoint['optimizer_states']) == len(trainer.optimizers)
+    model.load_state_dict(checkpoint['state_dict'])
+
+    clear_save_dir()
+
+
+def test_load_from_metrics_mmap():
+    """
+    Make sure mmap loading gives the same weights without reading the checkpoint into memory
+    :return:
+    """
+    save_dir = init_save_dir()
+    hparams = get_hparams()
+    hparams.hidden_dim = 20000
+    model = LightningTemplateModel(hparams)
+
+    state_dict = model.state_dict()
+    weights_mb = sum(v.numel() * v.element_size() for v in state_dict.values()) / 1024 ** 2
+
+    # optimizer states as large as the weights, which shouldn't be loaded at all
+    optimizer_states = [{'state': {i: {'exp_avg': torch.ones_like(v)} for i, v in enumerate(state_dict.values())}}]
+    weights_path = os.path.join(save_dir, 'weights.ckpt')
+    torch.save({'state_dict': state_dict, 'optimizer_states': optimizer_states}, weights_path)
+
+    tags_csv = os.path.join(save_dir, 'meta_tags.csv')
+    with open(tags_csv, 'w') as f:
+        f.write('key,value\n')
+        for k, v in vars(hparams).items():
+            f.write('{},{}\n'.format(k, v))
+
+    # same weights, used straight from the mapped file
+    pretrained_model = LightningTemplateModel.load_from_metrics(weights_path, tags_csv, on_gpu=False, mmap=True)
+    for k, v in pretrained_model.state_dict().items():
+        assert torch.equal(v, state_dict[k])
+
+    # tensors built in __init__ that aren't weights are usable as they are
+    model.eval()
+    pretrained_model.eval()
+    assert torch.equal(pretrained_model(model.example_input_array), model(model.example_input_array))
+    pretrained_model(pretrained_model.example_input_array)
+
+    # peak rss of a fresh process loading the model
+    script = '''
+import sys
+from pytorch_lightning.examples.new_project_templates.lightning_module_template import LightningTemplateModel
+
+def peak_rss_mb():
+    with open('/proc/self/status') as f:
+        return [int(l.split()[1]) / 1024 for l in f if l.startswith('VmHWM')][0]
+
+before = peak_rss_mb()
+LightningTemplateModel.load_from_metrics(sys.argv[1], sys.argv[2], on_gpu=False, mmap=sys.argv[3] == '1')
+print(peak_rss_mb() - before)
+'''
+    if os.path.exists('/proc/self/status'):
+        root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+        def peak_rss_mb(mmap):
+            out = subprocess.check_output([sys.executable, '-c', script, weights_path, tags_csv, str(int(mmap))],
+                                          cwd=root_dir)
+            return float(out.decode().strip().split('\n')[-1])
+
+        assert peak_rss_mb(mmap=True) < 0.25 * weights_mb
+        assert peak_rss_mb(mmap=False) > weights_mb
+
+    clear_save_dir()
+
+
+def test_skip_init_weights_other_threads():
+    """
+    Make sure skipping the init while loading doesn't leak into models built by other threads
+    :return:
+    """
+    entered, built = threading.Event(), threading.Event()
+
+    def load():
+        with skip_init_weights():
+            entered.set()
+            built.wait(10)
+
+    loader = threading.Thread(target=load)
+    loader.start()
+    entered.wait(10)
+
+    torch.manual_seed(SEED)
+    layer = torch.nn.Linear(4, 3)
+    built.set()
+    loader.join()
+
+    torch.manual_seed(SEED)
+    expected = torch.nn.Linear(4, 3)
+    assert not layer.weight.is_meta
+    assert torch.equal(layer.weight, expected.weight)
+
+    # the skipped model still ends up with the loaded weights
+    with skip_init_weights():
+        skipped = torch.nn.Linear(4, 3)
+        skipped.weight.requires_grad_(False)
+        extra = torch.zeros(3).fill_(2)
+    assign_state_dict(skipped, expected.state_dict())
+    assert torch.equal(skipped.weight, expected.weight)
+
+    # only the init of the parameters is skipped
+    assert not skipped.weight.requires_grad
+    assert torch.equal(extra, torch.full((3,), 2.))
+
+
+def test_frozen_weights_base():
+    """
+    Make sure frozen weights are written once and put back when loading
+    :return:
+    """
+    save_dir = init_save_dir()
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+    for p in model[0].parameters():
+        p.requires_grad = False
+
+    frozen_weights = FrozenWeightsBase()
+
+    def save(filepath):
+        checkpoint, base_path, base = frozen_weights.split({'state_dict': model.state_dict()}, model, save_dir)
+        if base is not None:
+            torch.save(base, base_path)
+        torch.save(checkpoint, filepath)
+        return checkpoint, base
+
+    checkpoint, base = save(os.path.join(save_dir, 'a.ckpt'))
+    assert list(checkpoint['state_dict'].keys()) == ['1.weight', '1.bias']
+    assert base is not None
+
+    # same frozen weights: nothing new to write
+    checkpoint, base = save(os.path.join(save_dir, 'b.ckpt'))
+    assert base is None
+    assert len([x for x in os.listdir(save_dir) if x.startswith('frozen_')]) == 1
+
+    loaded = load_checkpoint(os.path.join(save_dir, 'b.ckpt'))
+    assert 'frozen_base' not in loaded
+    assert list(loaded['state_dict'].keys()) == list(model.state_dict().keys())
+    for k, v in model.state_dict().items():
+        assert torch.equal(loaded['state_dict'][k], v)
+    assert load_weights(os.path.join(save_dir, 'b.ckpt')).keys() == model.state_dict().keys()
+
+    # changing a frozen weight gives a new base
+    with torch.no_grad():
+        model[0].weight.add_(1)
+    checkpoint, base = save(os.path.join(save_dir, 'c.ckpt'))
+    assert base is not None
+    assert len([x for x in os.listdir(save_dir) if x.startswith('frozen_')]) == 2
+    assert torch.equal(load_checkpoint(os.path.join(save_dir, 'c.ckpt'))['state_dict']['0.weight'], model[0].weight)
+
+    clear_save_dir()
+
+
+def test_load_weights_without_mmap(monkeypatch):
+    """
+    Make sure sharded and compressed checkpoints with a frozen base load on torch versions without torch.load(mmap)
+    :return:
+    """
+    save_dir = init_save_dir()
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+    for p in model[0].parameters():
+        p.requires_grad = False
+
+    checkpoint, base_path, base = FrozenWeightsBase().split({'state_dict': model.state_dict()}, model, save_dir)
+    torch.save(base, base_path)
+    sharded_path = os.path.join(save_dir, 'sharded.ckpt')
+    save_sharded_checkpoint(checkpoint, sharded_path)
+    compressed_path = os.path.join(save_dir, 'compressed.ckpt')
+    save_compressed_checkpoint(checkpoint, compressed_path)
+
+    # torch < 2.1
+    torch_load = torch.load
+
+    def load(*args, **kwargs):
+        if 'mmap' in kwargs:
+            raise TypeError("load() got an unexpected keyword argument 'mmap'")
+        return torch_load(*args, **kwargs)
+    monkeypatch.setattr(torch, 'load', load)
+
+    for path in [sharded_path, compressed_path]:
+        weights = load_weights(path)
+        assert list(weights.keys()) == list(model.state_dict().keys())
+        for k, v in model.state_dict().items():
+            assert torch.equal(weights[k], v)
+
+    clear_save_dir()
+
+
+def test_cpu_model_with_frozen_weights():
+    """
+    Make sure checkpoints of a partially frozen model only hold the trained weights
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+    for p in model.c_d1.parameters():
+        p.requires_grad = False
+
+    trainer = Trainer(
+        experiment=get_exp(),
+        progress_bar=False,
+        max_nb_epochs=2,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        dedup_frozen_weights=True
+    )
+    trainer.fit(model)
+
+    files = sorted(os.listdir(save_dir))
+    assert len([x for x in files if x.startswith('frozen_')]) == 1
+    assert [x for x in files if x.endswith('.ckpt')] == ['_ckpt_epoch_1.ckpt', '_ckpt_epoch_2.ckpt']
+
+    filepath = os.path.join(save_dir, '_ckpt_epoch_2.ckpt')
+    assert 'c_d1.weight' not in torch.load(filepath)['state_dict']
+
+    checkpoint = load_checkpoint(filepath)
+    assert torch.equal(checkpoint['state_dict']['c_d1.weight'], model.c_d1.weight)
+    model.load_state_dict(checkpoint['state_dict'])
+
+    clear_save_dir()
+
+
+def test_compressed_checkpoint():
+    """
+    Make sure compressed checkpoints load back exactly, and regular ones still load
+    :return:
+    """
+    save_dir = init_save_dir()
+    model = torch.nn.Sequential(torch.nn.Linear(64, 32), torch.nn.Linear(32, 2))
+    checkpoint = {
+        'epoch': 3,
+        'state_dict': model.state_dict(),
+        'optimizer_states': [{'state': {0: {'exp_avg': torch.zeros(256, 64)}}, 'param_groups': [{'lr': 0.1}]}],
+        'mask': torch.tensor([True, False]),
+        'half': torch.randn(3).to(torch.bfloat16),
+        'empty': torch.zeros(0),
+    }
+
+    for codec in ['zlib', 'bz2', 'lzma']:
+        filepath = os.path.join(save_dir, '{}.ckpt'.format(codec))
+
+        # small chunks, so tensors are split across threads
+        stats = save_compressed_checkpoint(checkpoint, filepath, codec=codec, chunk_size=4096, nb_workers=3)
+        assert stats['ckpt_compression_ratio'] > 1
+        assert stats['ckpt_write_mb_per_s'] > 0
+
+        loaded = load_checkpoint(filepath)
+        assert loaded['epoch'] == 3
+        assert loaded['optimizer_states'][0]['param_groups'] == [{'lr': 0.1}]
+        assert torch.equal(loaded['optimizer_states'][0]['state'][0]['exp_avg'], torch.zeros(256, 64))
+        for key in ['mask', 'half', 'empty']:
+            assert loaded[key].dtype == checkpoint[key].dtype
+            assert torch.equal(loaded[key], checkpoint[key])
+
+        # weights only
+        weights = load_weights(filepath)
+        assert list(weights.keys()) == list(model.state_dict().keys())
+        for k, v in model.state_dict().items():
+            assert torch.equal(weights[k], v)
+
+    # a truncated file is detected
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    with open(filepath, 'wb') as f:
+        f.write(data[:-4])
+    with pytest.raises(ValueError):
+        CompressedCheckpoint(filepath)
+
+    # plain torch.save checkpoints load as before
+    filepath = os.path.join(save_dir, 'plain.ckpt')
+    torch.save(checkpoint, filepath)
+    assert load_checkpoint(filepath)['epoch'] == 3
+
+    with pytest.raises(MisconfigurationException):
+        Trainer(experiment=get_exp(), checkpoint_compression='zip')
+
+    clear_save_dir()
+
+
+def test_cpu_model_with_compressed_checkpoint():
+    """
+    Make sure the trainer writes compressed checkpoints and logs how well they compress
+    :return:
+    """
+    save_dir = init_save_dir()
+    model, hparams = get_model()
+
+    exp = get_exp(False)
+    trainer = Trainer(
+        experiment=exp,
+        progress_bar=False,
+        max_nb_epochs=2,
+        train_percent_check=0.2,
+        val_percent_check=0.1,
+        add_log_row_interval=1,
+        checkpoint_callback=ModelCheckpoint(save_dir),
+        async_checkpoint=True,
+        checkpoint_compression='zlib'
+    )
+    trainer.fit(model)
+
+    assert trainer.last_checkpoint_stats['ckpt_compression_ratio'] > 0
+    assert any('ckpt_compression_ratio' in row for row in exp.metrics)
+
+    filepath = os.path.join(save_dir, '_ckpt_epoch_2.ckpt')
+    assert is_compressed_checkpoint(filepath)
+    model.load_state_dict(load_checkpoint(filepath)['state_dict'])
+
+    clear_save_dir()
+
+
+def test_cpu_model_progress_bar_with_accumulation(monkeypatch):
+    """
+    Make sure the training loss in the progress bar refreshes when optimizer steps don't line up with log rows
+    :return:
+    """
+    import tqdm
+
+    calls = []
+    set_postfix = tqdm.tqdm.set_postfix
+
+    def record_set_postfix(bar, *args, **kwargs):
+        if sys._getframe(1).f_code.co_name == '__run_tng_batch':
+            calls.append(kwargs['tng_loss'])
+        return set_postfix(bar, *args, **kwargs)
+
+    monkeypatch.setattr(tqdm.tqdm, 'set_postfix', record_set_postfix)
+
+    model, hparams = get_model()
+    trainer = Trainer(
+        experiment=get_exp(),
+        max_nb_epochs=1,
+        train_percent_check=0.1,
+        val_percent_check=0.1,
+        accumulate_grad_batches=2
+    )
+    trainer.fit(model)
+
+    # one refresh per log row boundary (add_log_row_interval=10), even though every optimizer step is on an odd batch
+    assert len(calls) == len(range(0, trainer.nb_tng_batches + 1, 10))
+    assert len(calls) > 1
+
+
 def test_cpu_model_with_amp():
     """
     Make sure model trains on CPU